@@ -5,7 +5,7 @@ import os
 import json
 from collections import Counter
 import argparse
-from DecAF.Preprocess.linearize import load_nameid_dict
+from DecAF.Knowledge.name_index import load_nameid_index
 from DecAF.Datasets.QA.utils import execute_vanilla_s_expr, revise_only_name
 from collections import defaultdict
 
@@ -19,7 +19,7 @@ args = parser.parse_args()
 
 if __name__ == "__main__":
     name_dir = f"{DATA_DIR}/knowledge_source/Freebase/id2name_parts_disamb"
-    name2id_dict, id2name_dict = load_nameid_dict(name_dir, lower=False)
+    name2id_dict, id2name_dict = load_nameid_index(name_dir, lower=False)
 
     # Only keep the training data with correct excution results
     if not os.path.exists(os.path.join(args.data_dir, "raw/ComplexWebQuestions_train_filtered.expr.json")):
@@ -4,7 +4,7 @@
 import os
 import json
 import argparse
-from DecAF.Preprocess.linearize import load_nameid_dict
+from DecAF.Knowledge.name_index import load_nameid_index
 from DecAF.Datasets.QA.utils import revise_only_name
 from collections import defaultdict
 import logging
@@ -19,7 +19,7 @@ args = parser.parse_args()
 
 if __name__ == "__main__":
     name_dir = f"{DATA_DIR}/knowledge_source/Freebase/id2name_parts_disamb"
-    name2id_dict, id2name_dict = load_nameid_dict(name_dir, lower=False)
+    name2id_dict, id2name_dict = load_nameid_index(name_dir, lower=False)
 
     data_dict = defaultdict(list)
     ID2LFs = defaultdict(list)
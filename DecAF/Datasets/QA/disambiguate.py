@@ -21,7 +21,7 @@ import os
 import json
 from tqdm import tqdm
 import argparse
-from DecAF.Preprocess.linearize import load_nameid_dict
+from DecAF.Knowledge.name_index import load_nameid_index
 import logging
 logging.basicConfig(level=logging.INFO)
 
@@ -36,7 +36,7 @@ if __name__ == "__main__":
     # load id2name mapping
     logging.info("Loading id2name mapping")
     name_dir = f"{DATA_DIR}/knowledge_source/Freebase/id2name_parts_disamb"
-    name2id_dict, id2name_dict = load_nameid_dict(name_dir, lower=False)
+    name2id_dict, id2name_dict = load_nameid_index(name_dir, lower=False)
 
     # load original QA dataset
     for split in ["dev", "test", "train"]:
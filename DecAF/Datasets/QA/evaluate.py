@@ -20,10 +20,8 @@
 import os
 import json
 import argparse
-from DecAF.Knowledge.linearize import (
-    load_nameid_dict,
-    get_raw_name,
-)
+from DecAF.Knowledge.linearize import get_raw_name
+from DecAF.Knowledge.name_index import load_nameid_index
 from DecAF.Datasets.QA.utils import (
     Prefix_to_id_all, 
     answer_ensemble, 
@@ -64,10 +62,10 @@ if args.dataset == "FreebaseQA":
     exit()
 
 name_dir = DATA_DIR + "/knowledge_source/Freebase/id2name_parts_disamb"
-name2id_dict, id2name_dict = load_nameid_dict(name_dir, lower=False)
+name2id_dict, id2name_dict = load_nameid_index(name_dir, lower=False)
 
 name_dir = DATA_DIR + "/knowledge_source/Freebase/id2name_parts"
-name2id_dict_orig, id2name_dict_orig = load_nameid_dict(name_dir, lower=False)
+name2id_dict_orig, id2name_dict_orig = load_nameid_index(name_dir, lower=False)
 
 logging.info("parse generation results to answers")
 save_file_path_all = Prefix_to_id_all(result_path, name2id_dict)
@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+microbenchmark of triple parsing and linearization on a sample shard
+
+    python DecAF/Knowledge/benchmark_linearize.py \
+        --triple_file ${DATA_DIR}/knowledge_source/Freebase/triple_edges_parts/triples-00000 \
+        --name_dir ${DATA_DIR}/knowledge_source/Freebase/id2name_parts_disamb
+'''
+
+import os
+import csv
+import time
+import argparse
+from itertools import islice
+from tqdm import tqdm
+from DecAF.Knowledge.linearize import parse_triple, linearize_triples
+
+
+# the parsing loop of process_freebase before the __slots__ / single split version
+class LegacyRelation:
+    def __init__(self, line):
+        e1, rel, e2 = line.strip().split("\t")
+        self.subj = e1
+        self.rel = rel
+        self.obj = e2
+
+    def should_ignore(self, id2name_dict):
+        return self.rel == "type.object.name"
+
+
+def legacy_convert_relation_to_text(relation, entity_names):
+    subj, rel, obj = relation.subj, relation.rel, relation.obj
+    subj_surface = entity_names[subj] if subj in entity_names else subj
+    obj_surface = entity_names[obj] if obj in entity_names else obj
+    rel_surface = rel.replace('.', ' ')
+    rel_surface = rel_surface.replace('_', ' ')
+    return ' '.join([subj_surface, rel_surface, obj_surface, '.'])
+
+
+def legacy_relation_texts(rows, id2name_dict):
+    for row in rows:
+        if len(row.strip().split("\t")) != 3:
+            continue
+        triple = LegacyRelation(row)
+        if triple.should_ignore(id2name_dict):
+            continue
+        if triple.obj.startswith("m") and triple.obj not in id2name_dict:
+            continue
+        subj = triple.subj
+        if triple.subj not in id2name_dict:
+            triple.subj = ""
+        yield subj, legacy_convert_relation_to_text(triple, id2name_dict)
+
+
+def run(name, relation_texts, rows, id2name_dict, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        outputs = list(relation_texts(rows, id2name_dict))
+        best = min(best, time.perf_counter() - start_time)
+    print("{:<8} {:>12.0f} triples/s ({:.3f}s for {} lines)".format(name, len(rows) / best, best, len(rows)))
+    return outputs, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark triple linearization')
+    parser.add_argument('--triple_file', type=str, required=True, help="one triple_edges_parts file")
+    parser.add_argument('--name_dir', type=str, default=None, help="id2name_parts_disamb, names are empty if not given")
+    parser.add_argument('--num_lines', type=int, default=1000000, help="number of lines to read, -1 for all")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.triple_file, "r") as rf:
+        rows = list(rf) if args.num_lines == -1 else list(islice(rf, args.num_lines))
+
+    # only keep the names of entities in the sample
+    id2name_dict = {}
+    if args.name_dir is not None:
+        entities = set()
+        for row in rows:
+            triple = parse_triple(row)
+            if triple is not None:
+                entities.add(triple[0])
+                entities.add(triple[2])
+        for file_name in tqdm(os.listdir(args.name_dir)):
+            with open(os.path.join(args.name_dir, file_name), 'r') as rf:
+                for row in csv.reader(rf, delimiter="\t"):
+                    if row[0] in entities:
+                        id2name_dict[row[0]] = row[2]
+
+    legacy_outputs, legacy_time = run("legacy", legacy_relation_texts, rows, id2name_dict, args.repeat)
+    fast_outputs, fast_time = run("fast", linearize_triples, rows, id2name_dict, args.repeat)
+    assert legacy_outputs == fast_outputs, "outputs differ"
+    print("speedup: {:.2f}x".format(legacy_time / fast_time))
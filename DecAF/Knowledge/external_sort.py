@@ -0,0 +1,54 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+bounded-memory external sort for records made of strings
+'''
+
+import os
+import heapq
+import tempfile
+
+
+def _write_run(records, tmp_dir):
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+    with os.fdopen(fd, "w") as wf:
+        for record in records:
+            wf.write("\t".join(record) + "\n")
+    return path
+
+
+def _read_run(path):
+    with open(path, "r") as rf:
+        for line in rf:
+            yield tuple(line[:-1].split("\t"))
+
+
+def external_sort(records, key, buffer_size, tmp_dir=None):
+    '''
+    Stable sort of an iterable of string tuples, at most buffer_size records are held in memory.
+    Fields must not contain tabs or newlines. Full buffers are sorted and spilled to run files
+    which are then merged lazily, so the sorted records are produced as a generator.
+    '''
+    runs = []
+    buffer = []
+    try:
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= buffer_size:
+                buffer.sort(key=key)
+                runs.append(_write_run(buffer, tmp_dir))
+                buffer = []
+        buffer.sort(key=key)
+        if len(runs) == 0:
+            yield from buffer
+            return
+        if len(buffer) > 0:
+            runs.append(_write_run(buffer, tmp_dir))
+            buffer = []
+        # heapq.merge breaks ties by run order, so the sort stays stable
+        yield from heapq.merge(*[_read_run(path) for path in runs], key=key)
+    finally:
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
@@ -6,11 +6,15 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import sys
 import csv
+import itertools
 from tqdm import tqdm
 from collections import defaultdict
 
 class Relation:
+    __slots__ = ("subj", "rel", "obj")
+
     def __init__(self, line):
         if line is None:
             self.subj = self.rel = self.obj = None
@@ -19,15 +23,12 @@ class Relation:
         self.subj = e1
         self.rel = rel
         self.obj = e2
-    
+
     def __hash__(self):
         return hash((self.subj, self.rel, self.obj))
         
     def _filter_relation(self):
-        relation = self.rel
-        if relation == "type.object.name":
-            return True
-        return False
+        return should_ignore_relation(self.rel)
 
     def should_ignore(self, id2name_dict):
         if self._filter_relation():
@@ -38,6 +39,32 @@ class Relation:
         return f"Subj: {self.subj}; Rel: {self.rel}; Obj: {self.obj}"
 
 
+def parse_triple(line):
+    # split a tsv line once, returns (subj, rel, obj) or None for malformed lines
+    fields = line.strip().split("\t")
+    if len(fields) != 3:
+        return None
+    return fields
+
+
+def should_ignore_relation(rel):
+    return rel == "type.object.name"
+
+
+# surface form of each distinct predicate, computed once per process
+_relation_surfaces = {}
+
+
+def relation_surface(rel):
+    # e.g. film.film.other_crew
+    # replace '.' and '_' with ' '
+    surface = _relation_surfaces.get(rel)
+    if surface is None:
+        surface = sys.intern(rel.replace('.', ' ').replace('_', ' '))
+        _relation_surfaces[sys.intern(rel)] = surface
+    return surface
+
+
 def convert_relation_to_text(relation, entity_names):
     if isinstance(relation, Relation):
         subj, rel, obj = relation.subj, relation.rel, relation.obj
@@ -57,14 +84,89 @@ def convert_relation_to_text(relation, entity_names):
         obj_surface = obj
             
     # relation
-    # e.g. film.film.other_crew
-    # replace '.' and '_' with ' '
-    rel_surface = rel.replace('.', ' ')
-    rel_surface = rel_surface.replace('_', ' ')
+    rel_surface = relation_surface(rel)
     
     return ' '.join([subj_surface, rel_surface, obj_surface, '.'])
 
 
+def linearize_triples(rows, entity_names, stats=None):
+    # yields (subject, relation text) for the triples kept in the passages, same
+    # text as convert_relation_to_text with one split and one lookup per entity.
+    # triples whose object looks like an entity id without a name are dropped and
+    # subjects without a name get an empty surface
+    get_name = entity_names.get
+    for row in rows:
+        triple = parse_triple(row)
+        if triple is None:
+            continue
+        if stats is not None:
+            stats["triples"] += 1
+        subj, rel, obj = triple
+        if should_ignore_relation(rel):
+            continue
+        obj_name = get_name(obj)
+        if obj_name is None:
+            if obj.startswith("m"):
+                continue
+            obj_name = obj
+        subj_name = get_name(subj)
+        if subj_name is None:
+            subj_name = ""
+        yield subj, " ".join([subj_name, relation_surface(rel), obj_name, "."])
+
+
+def iter_passage_chunks(pieces, chunk_size=100):
+    # same chunks as splitting " ".join(pieces) by chunk_size words,
+    # without building the whole passage in memory
+    words = []
+    for piece in pieces:
+        words.extend(piece.split(" "))
+        while len(words) >= chunk_size:
+            yield " ".join(words[:chunk_size])
+            del words[:chunk_size]
+    if len(words) > 0:
+        yield " ".join(words)
+
+
+def clean_text(text):
+    return text.replace("\t", " ").replace("\n", " ")
+
+
+def linearize_entity(key, name, relation_texts, topics=None, chunk_size=100):
+    # yields (title, contents chunk) of the passages of one subject: its relation
+    # texts followed by its topics, split by chunk_size words each chunk.
+    # name is None for subjects without a name, topics is None if it has no topic entry
+    if name is not None:
+        name_key = name
+        title = name_key + " " + key
+    else:
+        name_key = ""
+        title = key
+    pieces = [relation_texts]
+    # add topic information
+    if topics is not None:
+        topics = [name_key + " " + topic + " ." for topic in topics]
+        pieces.append([" ".join(topics)])
+    title = clean_text(title)
+    contents = (clean_text(text) for text in itertools.chain.from_iterable(pieces))
+    for contents_chunk in iter_passage_chunks(contents, chunk_size):
+        yield title, contents_chunk
+
+
+def should_ignore_topic(rel):
+    return "web" in rel or "type.object.name" in rel
+
+
+def topic_labels(rel, value):
+    # e.g. common.topic.notable_types, music.artist -> ("notable types", "music artist")
+    return rel.split(".")[-1].replace('.', ' ').replace('_', ' '), value.replace('.', ' ').replace('_', ' ')
+
+
+def convert_topic_to_text(rel, value):
+    type_label, value_label = topic_labels(rel, value)
+    return type_label + " : " + value_label
+
+
 # replace "{name} v2" to "{name}"
 def get_raw_name(name_wversion):
     dict_name = name_wversion.split(" ")
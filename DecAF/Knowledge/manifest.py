@@ -0,0 +1,219 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+build manifest for incremental Freebase passage generation
+
+The manifest records a content hash of every input part and, for each
+processed/document shard, the hash of its triple part and of the name and
+topic parts it looked entities up in. The name and topic parts also record the
+range of the entity ids they hold, and a shard depends on a part when it
+looked up an id inside that range. A rerun only regenerates the shards whose
+triple part or dependent parts changed; a new table part, or a part whose id
+range grew, may hold an id of any shard and regenerates all of them.
+'''
+
+import os
+import json
+import hashlib
+from functools import partial
+import numpy as np
+
+MANIFEST_VERSION = 2
+
+
+def file_digest(path, chunk_size=1 << 24):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as rf:
+        for chunk in iter(partial(rf.read, chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def table_part_digest(path):
+    # sha1 and [first, last] entity id of a tsv part keyed by its first column, the range is None if it is empty
+    sha1 = hashlib.sha1()
+    first, last = None, None
+    with open(path, "rb") as rf:
+        for line in rf:
+            sha1.update(line)
+            entity_id = line.split(b"\t", 1)[0].rstrip(b"\n").decode("utf-8")
+            if first is None or entity_id < first:
+                first = entity_id
+            if last is None or entity_id > last:
+                last = entity_id
+    return sha1.hexdigest(), [first, last] if first is not None else None
+
+
+def fingerprint_parts(part_dir, previous=None, pool=None, id_ranges=False):
+    # {file_name: {"size", "mtime_ns", "sha1"}} plus "ids" with id_ranges,
+    # hashes are reused when size and mtime did not change
+    previous = previous or {}
+    fingerprints, to_hash = {}, []
+    for file_name in sorted(os.listdir(part_dir)):
+        stat = os.stat(os.path.join(part_dir, file_name))
+        fingerprints[file_name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        old = previous.get(file_name)
+        if (old is not None and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns
+                and (not id_ranges or "ids" in old)):
+            fingerprints[file_name]["sha1"] = old["sha1"]
+            if id_ranges:
+                fingerprints[file_name]["ids"] = old["ids"]
+        else:
+            to_hash.append(file_name)
+    paths = [os.path.join(part_dir, file_name) for file_name in to_hash]
+    digest_fn = table_part_digest if id_ranges else file_digest
+    digests = pool.map(digest_fn, paths) if pool is not None else map(digest_fn, paths)
+    for file_name, digest in zip(to_hash, digests):
+        if id_ranges:
+            fingerprints[file_name]["sha1"], fingerprints[file_name]["ids"] = digest
+        else:
+            fingerprints[file_name]["sha1"] = digest
+    return fingerprints
+
+
+def table_digest(fingerprints):
+    # one hash for a table made of several parts
+    sha1 = hashlib.sha1()
+    for file_name in sorted(fingerprints):
+        sha1.update(f"{file_name}\t{fingerprints[file_name]['sha1']}\n".encode("utf-8"))
+    return sha1.hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {"version": MANIFEST_VERSION, "tables": {}, "shards": {}}
+    with open(path, "r") as rf:
+        manifest = json.load(rf)
+    if manifest.get("version") != MANIFEST_VERSION:
+        print(f"manifest version mismatch in {path}, rebuilding everything")
+        return {"version": MANIFEST_VERSION, "tables": {}, "shards": {}}
+    return manifest
+
+
+def save_manifest(path, manifest):
+    # write to a temporary file first so an interrupted run keeps the old manifest
+    with open(path + ".tmp", "w") as wf:
+        json.dump(manifest, wf, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def shard_output_name(file_name, output_format="jsonl"):
+    # jsonl documents, or the zstd shard of the passage store
+    return file_name + (".zst" if output_format == "zstd" else ".jsonl")
+
+
+class PartDependencies:
+    # table parts whose id range holds an entity id looked up by a shard, the ids are
+    # buffered and checked against the ranges of all parts in sorted batches
+    def __init__(self, table_fingerprints, buffer_size=100000):
+        self.ranges = [(table, file_name, fingerprint["ids"][0], fingerprint["ids"][1])
+                       for table, parts in table_fingerprints.items()
+                       for file_name, fingerprint in parts.items() if fingerprint["ids"] is not None]
+        self.hit = [False] * len(self.ranges)
+        self.buffer = []
+        self.buffer_size = buffer_size
+
+    def add(self, entity_id):
+        self.buffer.append(entity_id)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        ids = np.unique(np.array(self.buffer))
+        for i, (_, _, first, last) in enumerate(self.ranges):
+            if not self.hit[i]:
+                pos = np.searchsorted(ids, first)
+                self.hit[i] = bool(pos < len(ids) and ids[pos] <= last)
+        self.buffer = []
+
+    def parts(self):
+        # {table: [file names]}
+        self.flush()
+        parts = {}
+        for (table, file_name, _, _), hit in zip(self.ranges, self.hit):
+            if hit:
+                parts.setdefault(table, []).append(file_name)
+        return parts
+
+
+class RecordingLookup:
+    # entity_names.get of linearize_triples that records every looked up id
+    def __init__(self, mapping, dependencies):
+        self.mapping = mapping
+        self.dependencies = dependencies
+
+    def get(self, key, default=None):
+        self.dependencies.add(key)
+        return self.mapping.get(key, default)
+
+
+def widened_parts(old_parts, new_parts):
+    # parts that may hold ids outside the ranges the shards were checked against
+    widened = []
+    for file_name, fingerprint in new_parts.items():
+        old = old_parts.get(file_name)
+        if fingerprint["ids"] is None or old is not None and old["sha1"] == fingerprint["sha1"]:
+            continue
+        if old is None or old.get("ids") is None:
+            widened.append(file_name)
+        elif fingerprint["ids"][0] < old["ids"][0] or fingerprint["ids"][1] > old["ids"][1]:
+            widened.append(file_name)
+    return widened
+
+
+def plan_rebuild(manifest, triple_fingerprints, table_fingerprints, save_dir, output_format="jsonl"):
+    # returns {file_name: reason} for the shards to regenerate and the list of removed parts
+    widened = ["{} {}".format(table, file_name) for table, parts in table_fingerprints.items()
+               for file_name in widened_parts(manifest["tables"].get(table, {}).get("parts", {}), parts)]
+    stale = {}
+    for file_name, fingerprint in triple_fingerprints.items():
+        shard = manifest["shards"].get(file_name)
+        changed = []
+        if shard is not None:
+            # the parts the shard looked up that changed or were removed
+            changed = ["{} {}".format(table, part) for table, parts in shard["tables"].items()
+                       for part, digest in parts.items()
+                       if table_fingerprints[table].get(part, {}).get("sha1") != digest]
+        if shard is None:
+            stale[file_name] = "new"
+        elif shard["triples"] != fingerprint["sha1"]:
+            stale[file_name] = "triples changed"
+        elif len(changed) > 0:
+            stale[file_name] = "{} changed".format(", ".join(changed))
+        elif len(widened) > 0:
+            stale[file_name] = "{} added or widened".format(", ".join(widened))
+        elif shard.get("output", shard_output_name(file_name)) != shard_output_name(file_name, output_format):
+            stale[file_name] = "output format changed"
+        elif not os.path.exists(os.path.join(save_dir, shard_output_name(file_name, output_format))):
+            stale[file_name] = "output missing"
+    removed = [file_name for file_name in manifest["shards"] if file_name not in triple_fingerprints]
+    return stale, removed
+
+
+def stale_indexes(index_root, document_dir, changed_documents):
+    # indexes under index_root, or the shards of a sharded index, built from one of the changed document files
+    changed_documents = set(changed_documents)
+    if len(changed_documents) == 0 or not os.path.exists(index_root):
+        return []
+    document_dir = os.path.abspath(document_dir)
+    stale = []
+    for index_name in sorted(os.listdir(index_root)):
+        index_dir = os.path.join(index_root, index_name)
+        if os.path.exists(os.path.join(index_dir, "shards.json")):
+            with open(os.path.join(index_dir, "shards.json"), "r") as rf:
+                shards = json.load(rf)
+            if shards["document_dir"] == document_dir:
+                stale += [index_name + "/" + shard["name"] for shard in shards["shards"]
+                          if not changed_documents.isdisjoint(shard["files"])]
+        elif os.path.exists(os.path.join(index_dir, "csr_index.json")):
+            with open(os.path.join(index_dir, "csr_index.json"), "r") as rf:
+                meta = json.load(rf)
+            if meta["document_dir"] == document_dir and not changed_documents.isdisjoint(meta["document_files"]):
+                stale.append(index_name)
+        elif os.path.isdir(index_dir):
+            # a single index built from the whole document directory
+            stale.append(index_name)
+    return stale
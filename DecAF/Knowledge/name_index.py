@@ -0,0 +1,329 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+memory-mapped Freebase name index
+
+A one-time build step turns the id2name tsv parts into flat binary files:
+    ids.npy                  sorted entity ids (fixed width bytes)
+    names.bin/.offsets.npy   utf-8 names aligned with ids
+    raw_name_len.npy         byte length of get_raw_name(name), a prefix of name
+    keys.bin/.offsets.npy    sorted unique names
+    postings_offsets.npy     name -> slice of postings
+    postings.npy             positions into ids, in file order
+    meta.json                counts, and size and mtime of every source part
+At runtime the files are opened with mmap so loading is near-instant and the
+pages are shared by every process reading the same index. An index whose
+source parts changed since the build is rebuilt when it is loaded.
+'''
+
+import os
+import csv
+import json
+import mmap
+import argparse
+from abc import abstractmethod
+from collections.abc import Mapping
+import numpy as np
+from tqdm import tqdm
+from DecAF.Knowledge.linearize import get_raw_name
+
+INDEX_VERSION = 1
+
+
+def write_string_column(path, strings):
+    # a string column is a utf-8 blob plus int64 offsets (length n + 1)
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    pos = 0
+    with open(path + ".bin", "wb") as wf:
+        for i, string in enumerate(strings):
+            data = string.encode("utf-8")
+            wf.write(data)
+            pos += len(data)
+            offsets[i + 1] = pos
+    np.save(path + ".offsets.npy", offsets)
+
+
+def find_sorted_id(ids, entity_id):
+    # position of entity_id in a sorted fixed width bytes array, or -1
+    key = entity_id.encode("utf-8")
+    if len(ids) == 0 or len(key) > ids.dtype.itemsize:
+        return -1
+    pos = int(np.searchsorted(ids, key))
+    if pos < len(ids) and ids[pos] == key:
+        return pos
+    return -1
+
+
+class StringColumn:
+    def __init__(self, path):
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+        with open(path + ".bin", "rb") as rf:
+            if os.fstat(rf.fileno()).st_size > 0:
+                self.blob = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # mmap does not accept empty files
+                self.blob = b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_bytes(self, i):
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def __getitem__(self, i):
+        return self.get_bytes(i).decode("utf-8")
+
+
+def source_signature(name_dir):
+    # {file_name: [size, mtime_ns]} of the tsv parts an index is built from
+    signature = {}
+    for file_name in sorted(os.listdir(name_dir)):
+        stat = os.stat(os.path.join(name_dir, file_name))
+        signature[file_name] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def read_name_rows(name_dir, lower):
+    ids, names = [], []
+    for file_name in tqdm(sorted(os.listdir(name_dir))):
+        with open(os.path.join(name_dir, file_name), 'r') as rf:
+            data_input = csv.reader(rf, delimiter="\t")
+            for row in data_input:
+                ids.append(row[0])
+                names.append(row[2].lower() if lower else row[2])
+    return ids, names
+
+
+def build_name_index(name_dir, index_dir, lower=False):
+    print(f"Building name index for {name_dir} ...")
+    # taken before reading, a part changed during the build makes the index stale
+    sources = source_signature(name_dir)
+    ids, names = read_name_rows(name_dir, lower)
+    num_rows = len(ids)
+    os.makedirs(index_dir, exist_ok=True)
+
+    # id -> name, the last row wins for duplicated ids as in load_nameid_dict
+    id_array = np.array([entity_id.encode("utf-8") for entity_id in ids], dtype=bytes)
+    order = np.argsort(id_array, kind="stable")
+    sorted_ids = id_array[order]
+    is_new = np.ones(num_rows, dtype=bool)
+    is_new[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    is_last = np.ones(num_rows, dtype=bool)
+    is_last[:-1] = is_new[1:]
+    row_to_uid = np.empty(num_rows, dtype=np.int64)
+    row_to_uid[order] = np.cumsum(is_new) - 1
+    id_rows = order[is_last]
+    del id_array, sorted_ids, is_new, is_last
+
+    id_names = [names[row] for row in id_rows]
+    np.save(os.path.join(index_dir, "ids.npy"), np.array([ids[row].encode("utf-8") for row in id_rows], dtype=bytes))
+    write_string_column(os.path.join(index_dir, "names"), id_names)
+    # get_raw_name only strips a trailing " v<num>", so the raw name is a prefix
+    raw_name_len = np.array([len(get_raw_name(name).encode("utf-8")) for name in id_names], dtype=np.int32)
+    np.save(os.path.join(index_dir, "raw_name_len.npy"), raw_name_len)
+    del id_names, raw_name_len
+
+    # name -> ids, every row is kept and ids keep their file order per name
+    name_order = sorted(range(num_rows), key=lambda row: names[row].encode("utf-8"))
+    keys = []
+    postings_offsets = [0]
+    for i, row in enumerate(name_order):
+        if i == 0 or names[row] != names[name_order[i - 1]]:
+            if i > 0:
+                postings_offsets.append(i)
+            keys.append(names[row])
+    if num_rows > 0:
+        postings_offsets.append(num_rows)
+    write_string_column(os.path.join(index_dir, "keys"), keys)
+    np.save(os.path.join(index_dir, "postings_offsets.npy"), np.array(postings_offsets, dtype=np.int64))
+    np.save(os.path.join(index_dir, "postings.npy"), row_to_uid[np.array(name_order, dtype=np.int64)])
+
+    with open(os.path.join(index_dir, "meta.json"), "w") as wf:
+        json.dump({
+            "version": INDEX_VERSION,
+            "name_dir": os.path.abspath(name_dir),
+            "lower": lower,
+            "num_rows": num_rows,
+            "num_ids": len(id_rows),
+            "num_names": len(keys),
+            "sources": sources,
+        }, wf, indent=2)
+    print(f"number of ids: {len(id_rows)}, number of names: {len(keys)}")
+
+
+class NameIndex:
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "meta.json"), "r") as rf:
+            self.meta = json.load(rf)
+        self.ids = np.load(os.path.join(index_dir, "ids.npy"), mmap_mode="r")
+        self.names = StringColumn(os.path.join(index_dir, "names"))
+        self.raw_name_len = np.load(os.path.join(index_dir, "raw_name_len.npy"), mmap_mode="r")
+        self.keys = StringColumn(os.path.join(index_dir, "keys"))
+        self.postings_offsets = np.load(os.path.join(index_dir, "postings_offsets.npy"), mmap_mode="r")
+        self.postings = np.load(os.path.join(index_dir, "postings.npy"), mmap_mode="r")
+
+    def find_id(self, entity_id):
+        return find_sorted_id(self.ids, entity_id)
+
+    def find_name(self, name):
+        # position of name in keys, or -1
+        key = name.encode("utf-8")
+        lo, hi = 0, len(self.keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.keys.get_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.keys) and self.keys.get_bytes(lo) == key:
+            return lo
+        return -1
+
+    def get_id(self, pos):
+        return self.ids[pos].decode("utf-8")
+
+    def get_name(self, pos, raw=False):
+        name = self.names.get_bytes(pos)
+        if raw:
+            name = name[:int(self.raw_name_len[pos])]
+        return name.decode("utf-8")
+
+    def get_ids(self, key_pos):
+        start, end = int(self.postings_offsets[key_pos]), int(self.postings_offsets[key_pos + 1])
+        return [self.get_id(pos) for pos in self.postings[start:end]]
+
+
+class _OverlayMapping(Mapping):
+    # read-only index lookups plus a small in-memory overlay for writes,
+    # e.g. revise_only_name caches labels fetched from the SPARQL server.
+    # Mapping is an abstract base class, subclasses must implement the index accessors
+    def __init__(self, index):
+        self.index = index
+        self.overlay = {}
+
+    @abstractmethod
+    def _lookup(self, key):
+        # value of key in the index, None if it is missing
+        pass
+
+    @abstractmethod
+    def _index_keys(self):
+        pass
+
+    @abstractmethod
+    def _index_len(self):
+        pass
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        value = self._lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.overlay[key] = value
+
+    def __contains__(self, key):
+        return key in self.overlay or self._lookup(key) is not None
+
+    def __iter__(self):
+        for key in self._index_keys():
+            yield key
+        for key in self.overlay:
+            if self._lookup(key) is None:
+                yield key
+
+    def __len__(self):
+        return self._index_len() + sum(1 for key in self.overlay if self._lookup(key) is None)
+
+
+class Id2NameMapping(_OverlayMapping):
+    def __init__(self, index, raw=False):
+        super().__init__(index)
+        self.raw = raw
+
+    def _lookup(self, entity_id):
+        pos = self.index.find_id(entity_id)
+        if pos < 0:
+            return None
+        return self.index.get_name(pos, raw=self.raw)
+
+    def _index_keys(self):
+        return (self.index.get_id(pos) for pos in range(len(self.index.ids)))
+
+    def _index_len(self):
+        return len(self.index.ids)
+
+
+class Name2IdMapping(_OverlayMapping):
+    def _lookup(self, name):
+        pos = self.index.find_name(name)
+        if pos < 0:
+            return None
+        return self.index.get_ids(pos)
+
+    def _index_keys(self):
+        return (self.index.keys[pos] for pos in range(len(self.index.keys)))
+
+    def _index_len(self):
+        return len(self.index.keys)
+
+
+def get_index_dir(name_dir, lower=False):
+    return name_dir.rstrip("/") + ("_index_lower" if lower else "_index")
+
+
+def stale_reason(name_dir, index_dir, lower=False):
+    # why the index in index_dir does not match the parts in name_dir, None if it does
+    meta_path = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return "missing"
+    with open(meta_path, "r") as rf:
+        meta = json.load(rf)
+    if meta.get("version") != INDEX_VERSION or meta.get("lower") != lower:
+        return "built by another version or with another lower"
+    if not os.path.isdir(name_dir):
+        # an index copied without its parts is used as is
+        return None
+    sources, old_sources = source_signature(name_dir), meta.get("sources", {})
+    if sources != old_sources:
+        changed = sorted(file_name for file_name in set(sources) | set(old_sources)
+                         if sources.get(file_name) != old_sources.get(file_name))
+        return "parts changed: {}".format(", ".join(changed[:5]) + (" ..." if len(changed) > 5 else ""))
+    return None
+
+
+def load_nameid_index(name_dir, lower=False, index_dir=None):
+    # drop-in replacement for load_nameid_dict, builds the index on first use and
+    # rebuilds it when the size or mtime of a part no longer matches meta.json
+    if index_dir is None:
+        index_dir = get_index_dir(name_dir, lower)
+    reason = stale_reason(name_dir, index_dir, lower)
+    if reason is not None:
+        if reason != "missing":
+            print(f"name index {index_dir} is stale ({reason}), rebuilding")
+        build_name_index(name_dir, index_dir, lower=lower)
+    print(f"Loading name index from {index_dir} ...")
+    index = NameIndex(index_dir)
+    return Name2IdMapping(index), Id2NameMapping(index)
+
+
+if __name__ == "__main__":
+    DATA_DIR = os.environ['DATA_DIR']
+
+    parser = argparse.ArgumentParser(description='build memory-mapped name index')
+    parser.add_argument('--data_dir', type=str, default=f'{DATA_DIR}/knowledge_source/Freebase')
+    parser.add_argument('--lower', action='store_true', help="lower-case names as load_nameid_dict(lower=True)")
+    parser.add_argument('--overwrite', action='store_true', help="rebuild existing indexes")
+    args = parser.parse_args()
+
+    for name_part in ["id2name_parts_disamb", "id2name_parts"]:
+        name_dir = os.path.join(args.data_dir, name_part)
+        index_dir = get_index_dir(name_dir, args.lower)
+        if stale_reason(name_dir, index_dir, args.lower) is None and not args.overwrite:
+            print(f"{index_dir} is up to date, skip")
+            continue
+        build_name_index(name_dir, index_dir, lower=args.lower)
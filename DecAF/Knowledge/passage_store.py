@@ -0,0 +1,228 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+zstd-compressed passage shards with an offset index
+
+Each document shard {name} is stored as
+    {name}.zst           independent zstd frames of block_size json lines
+    {name}.offsets.npy   byte offset of every frame (length num_blocks + 1)
+    {name}.json          file id, number of passages and block size
+Passage ids follow process_freebase, "freebase-file{file_id}doc{data_id}", so
+a passage is found in O(1): shard from file_id, frame from data_id // block_size.
+Only that frame is read through mmap and decompressed.
+
+    # convert existing jsonl documents
+    python DecAF/Knowledge/passage_store.py build --document_dir ${Freebase}/processed/document --store_dir ${Freebase}/processed/passage_store
+    # jsonl for indexing with pyserini
+    python DecAF/Knowledge/passage_store.py export --store_dir ${Freebase}/processed/passage_store --document_dir ${Freebase}/processed/document
+'''
+
+import os
+import re
+import json
+import mmap
+import argparse
+import threading
+from functools import lru_cache, partial
+from multiprocessing import Pool
+import jsonlines
+import numpy as np
+import zstandard
+from tqdm import tqdm
+
+STORE_VERSION = 1
+DOCID_PATTERN = re.compile(r"^freebase-file(\d+)doc(\d+)$")
+
+
+def parse_docid(docid):
+    # (file_id, data_id) of a passage id
+    match = DOCID_PATTERN.match(docid)
+    if match is None:
+        raise KeyError(docid)
+    return int(match.group(1)), int(match.group(2))
+
+
+class PassageShardWriter:
+    # same write/close interface as a jsonlines writer, passages must be written in data_id order
+    def __init__(self, path_prefix, file_id, block_size=32, level=3):
+        self.path_prefix = path_prefix
+        self.file_id = file_id
+        self.block_size = block_size
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.wf = open(path_prefix + ".zst", "wb")
+        self.offsets = [0]
+        self.block = []
+        self.num_passages = 0
+
+    def write(self, passage):
+        self.block.append(json.dumps(passage, ensure_ascii=False))
+        self.num_passages += 1
+        if len(self.block) >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self.block) == 0:
+            return
+        frame = self.compressor.compress("\n".join(self.block).encode("utf-8"))
+        self.wf.write(frame)
+        self.offsets.append(self.offsets[-1] + len(frame))
+        self.block = []
+
+    def close(self):
+        self._flush()
+        self.wf.close()
+        np.save(self.path_prefix + ".offsets.npy", np.array(self.offsets, dtype=np.int64))
+        with open(self.path_prefix + ".json", "w") as wf:
+            json.dump({
+                "version": STORE_VERSION,
+                "file_id": self.file_id,
+                "num_passages": self.num_passages,
+                "block_size": self.block_size,
+            }, wf, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Shard:
+    def __init__(self, path_prefix, meta):
+        self.path_prefix = path_prefix
+        self.num_passages = meta["num_passages"]
+        self.block_size = meta["block_size"]
+        self.offsets = np.load(path_prefix + ".offsets.npy", mmap_mode="r")
+        with open(path_prefix + ".zst", "rb") as rf:
+            if os.fstat(rf.fileno()).st_size > 0:
+                self.data = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b""
+
+    def frame(self, block_id):
+        return self.data[int(self.offsets[block_id]):int(self.offsets[block_id + 1])]
+
+
+class PassageStore:
+    def __init__(self, store_dir, cache_size=4096):
+        self.store_dir = store_dir
+        self.shards = {}
+        for file_name in os.listdir(store_dir):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(store_dir, file_name), "r") as rf:
+                meta = json.load(rf)
+            self.shards[meta["file_id"]] = (os.path.join(store_dir, file_name[:-len(".json")]), meta)
+        self._opened = {}
+        self._lock = threading.Lock()
+        # zstd decompression contexts must not be shared between threads
+        self._local = threading.local()
+        self._read_block = lru_cache(maxsize=cache_size)(self._read_block_uncached)
+
+    def _shard(self, file_id):
+        shard = self._opened.get(file_id)
+        if shard is None:
+            with self._lock:
+                shard = self._opened.get(file_id)
+                if shard is None:
+                    if file_id not in self.shards:
+                        raise KeyError(file_id)
+                    shard = _Shard(*self.shards[file_id])
+                    self._opened[file_id] = shard
+        return shard
+
+    def _decompressor(self):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = zstandard.ZstdDecompressor()
+            self._local.decompressor = decompressor
+        return decompressor
+
+    def _read_block_uncached(self, file_id, block_id):
+        frame = self._shard(file_id).frame(block_id)
+        return self._decompressor().decompress(frame).decode("utf-8").split("\n")
+
+    def get_raw(self, docid):
+        # json string of a passage, like the raw field stored in the lucene index
+        file_id, data_id = parse_docid(docid)
+        shard = self._shard(file_id)
+        if data_id >= shard.num_passages:
+            raise KeyError(docid)
+        return self._read_block(file_id, data_id // shard.block_size)[data_id % shard.block_size]
+
+    def get(self, docid):
+        return json.loads(self.get_raw(docid))
+
+    def __getitem__(self, docid):
+        return self.get(docid)
+
+    def __contains__(self, docid):
+        try:
+            file_id, data_id = parse_docid(docid)
+        except KeyError:
+            return False
+        return file_id in self.shards and data_id < self.shards[file_id][1]["num_passages"]
+
+    def __len__(self):
+        return sum(meta["num_passages"] for _, meta in self.shards.values())
+
+    def iter_shard(self, file_id):
+        shard = self._shard(file_id)
+        for block_id in range(len(shard.offsets) - 1):
+            for line in self._read_block_uncached(file_id, block_id):
+                yield json.loads(line)
+
+    def file_ids(self):
+        return sorted(self.shards)
+
+
+def build_shard(file_name, document_dir, store_dir, block_size):
+    name = file_name[:-len(".jsonl")]
+    with jsonlines.open(os.path.join(document_dir, file_name), "r") as rf:
+        passages = iter(rf)
+        first = next(passages, None)
+        if first is None:
+            return 0
+        file_id, _ = parse_docid(first["id"])
+        with PassageShardWriter(os.path.join(store_dir, name), file_id, block_size) as wf:
+            wf.write(first)
+            for passage in passages:
+                wf.write(passage)
+    return wf.num_passages
+
+
+def export_shard(file_id, store_dir, document_dir):
+    store = PassageStore(store_dir)
+    name = os.path.basename(store.shards[file_id][0])
+    num_passages = 0
+    with jsonlines.open(os.path.join(document_dir, name + ".jsonl"), "w") as wf:
+        for passage in store.iter_shard(file_id):
+            wf.write(passage)
+            num_passages += 1
+    return num_passages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='zstd-compressed passage store')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="convert jsonl documents into the store")
+    export_parser = subparsers.add_parser("export", help="write the store back as jsonl documents")
+    for sub_parser in [build_parser, export_parser]:
+        sub_parser.add_argument('--document_dir', type=str, required=True)
+        sub_parser.add_argument('--store_dir', type=str, required=True)
+        sub_parser.add_argument('--num_process', type=int, default=os.cpu_count())
+    build_parser.add_argument('--block_size', type=int, default=32, help="number of passages in each zstd frame")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        os.makedirs(args.store_dir, exist_ok=True)
+        file_list = [file_name for file_name in os.listdir(args.document_dir) if file_name.endswith(".jsonl")]
+        build = partial(build_shard, document_dir=args.document_dir, store_dir=args.store_dir, block_size=args.block_size)
+    else:
+        os.makedirs(args.document_dir, exist_ok=True)
+        file_list = PassageStore(args.store_dir).file_ids()
+        build = partial(export_shard, store_dir=args.store_dir, document_dir=args.document_dir)
+    with Pool(args.num_process) as pool:
+        num_passages = sum(tqdm(pool.imap_unordered(build, file_list), total=len(file_list)))
+    print(f"{num_passages} passages")
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: CC-BY-NC-4.0
 
 import os
+import json
 import jsonlines
 import csv
 from tqdm import tqdm
@@ -9,142 +10,344 @@ from collections import defaultdict
 from multiprocessing import Pool
 from functools import partial
 import argparse
-from DecAF.Knowledge.linearize import Relation, convert_relation_to_text
+import shutil
+import time
+import itertools
+from operator import itemgetter
+from DecAF.Knowledge.linearize import (
+    linearize_triples,
+    linearize_entity,
+    clean_text,
+)
+from DecAF.Knowledge.external_sort import external_sort
+from DecAF.Knowledge.passage_store import PassageShardWriter
+from DecAF.Knowledge import name_index, topic_index
+from DecAF.Knowledge.name_index import load_nameid_index
+from DecAF.Knowledge.topic_index import load_topic_index, build_topic_store
+from DecAF.Knowledge.manifest import (
+    load_manifest,
+    save_manifest,
+    fingerprint_parts,
+    table_digest,
+    plan_rebuild,
+    shard_output_name,
+    stale_indexes,
+    PartDependencies,
+    RecordingLookup,
+)
 
 DATA_DIR = os.environ['DATA_DIR']
 
 parser = argparse.ArgumentParser(description='process Freebase')
 parser.add_argument('--data_dir', type=str, default=f'{DATA_DIR}/knowledge_source/Freebase')
+parser.add_argument('--num_process', type=int, default=os.cpu_count(),
+                    help="number of worker processes, defaults to the number of CPUs")
+parser.add_argument('--shared_tables', action='store_true',
+                    help="keep entity names and topics in memory-mapped tables shared by all workers")
+parser.add_argument('--external_sort', action='store_true',
+                    help="group triples by subject with an on-disk sort, memory depends on --buffer_size instead of the shard size")
+parser.add_argument('--buffer_size', type=int, default=1000000,
+                    help="number of records each worker keeps in memory with --external_sort")
+parser.add_argument('--tmp_dir', type=str, default=None,
+                    help="directory for the sorted runs of --external_sort")
+parser.add_argument('--incremental', action='store_true',
+                    help="only regenerate the document shards whose inputs changed since the last run")
+parser.add_argument('--output_format', type=str, default="jsonl", choices=["jsonl", "zstd"],
+                    help="jsonl documents in processed/document, or zstd shards in processed/passage_store")
 args = parser.parse_args()
 
 
+# the manifest records the content hashes of the inputs of the last run
+manifest_path = os.path.join(args.data_dir, "processed/manifest.json")
+if args.incremental:
+    manifest = load_manifest(manifest_path)
+    name_dir = os.path.join(args.data_dir, "id2name_parts")
+    source_name_fingerprints = fingerprint_parts(name_dir, manifest["tables"].get("id2name_parts", {}).get("parts"))
+    source_name_digest = table_digest(source_name_fingerprints)
+    old_digest = manifest["tables"].get("id2name_parts", {}).get("digest")
+    output_dir = os.path.join(args.data_dir, "id2name_parts_disamb")
+    if old_digest is not None and old_digest != source_name_digest and os.path.exists(output_dir):
+        # a new name shifts the "v1" "v2" indicators of every later part, so redo the whole pass
+        print("id2name_parts changed, redo name disambiguation")
+        shutil.rmtree(output_dir)
+
+
 # disambuity for entity name
 # if the entity name has appeared in previous ids, we add indicator like "v1" "v2" to the name
+# the files are processed in parallel: count the names of each file, take the prefix sum of the
+# counts over the sorted files, then rewrite each file starting from its prefix counts. The
+# output is identical to processing the sorted files one by one with a single counter.
+def count_names(file_name, name_dir):
+    name_counts = defaultdict(int)
+    with open(os.path.join(name_dir, file_name), 'r') as rf:
+        data_input = csv.reader(rf, delimiter="\t")
+        for row in data_input:
+            name_counts[row[2]] += 1
+    return name_counts
+
+
+def disambiguate_names(file_name, name_offsets, name_dir, output_dir):
+    # name_offsets: number of times each name appeared in the previous files
+    name_num_dict = defaultdict(int, name_offsets)
+    id_name_list = []
+    with open(os.path.join(name_dir, file_name), 'r') as rf:
+        data_input = csv.reader(rf, delimiter="\t")
+        for row in data_input:
+            if row[2] not in name_num_dict:
+                id_name_list.append(row)
+                name_num_dict[row[2]] += 1
+            else:
+                new_row = row[:2] + [row[2] + " v" + str(name_num_dict[row[2]])]
+                id_name_list.append(new_row)
+                name_num_dict[row[2]] += 1
+    # save the list of rows to a new tsv file
+    with open(os.path.join(output_dir, file_name), 'w') as wf:
+        data_output = csv.writer(wf, delimiter="\t")
+        for row in id_name_list:
+            data_output.writerow(row)
+
+
 name_dir = os.path.join(args.data_dir, "id2name_parts")
 output_dir = os.path.join(args.data_dir, "id2name_parts_disamb")
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
-    name_num_dict = defaultdict(int)
     file_list = os.listdir(name_dir)
     file_list.sort()
-    for file_name in tqdm(file_list):
-        print(file_name)
-        id_name_list = []
+    with Pool(args.num_process) as pool:
+        # phase 1 and 2: per-file name counts in parallel, prefix sum in file order
+        name_num_dict = defaultdict(int)
+        file_name_offsets = []
+        count_names_part = partial(count_names, name_dir=name_dir)
+        for name_counts in tqdm(pool.imap(count_names_part, file_list), total=len(file_list)):
+            file_name_offsets.append({name: name_num_dict[name] for name in name_counts if name in name_num_dict})
+            for name, count in name_counts.items():
+                name_num_dict[name] += count
+        del name_num_dict
+        # phase 3: rewrite the files in parallel
+        disambiguate_names_part = partial(disambiguate_names, name_dir=name_dir, output_dir=output_dir)
+        pool.starmap(disambiguate_names_part, zip(file_list, file_name_offsets))
+
+
+# load Freebase entity name and topic information
+name_dir = os.path.join(args.data_dir, "id2name_parts_disamb")
+topic_dir = os.path.join(args.data_dir, "topic_entities_parts")
+
+
+def load_id2name_dict(name_dir):
+    id2name_dict = {}
+    for file_name in tqdm(os.listdir(name_dir)):
         with open(os.path.join(name_dir, file_name), 'r') as rf:
             data_input = csv.reader(rf, delimiter="\t")
             for row in data_input:
-                if row[2] not in name_num_dict:
-                    id_name_list.append(row)
-                    name_num_dict[row[2]] += 1
-                else:
-                    new_row = row[:2] + [row[2] + " v" + str(name_num_dict[row[2]])]
-                    id_name_list.append(new_row)
-                    name_num_dict[row[2]] += 1
-        # save the list of rows to a new tsv file
-        with open(os.path.join(output_dir, file_name), 'w') as wf:    
-            data_output = csv.writer(wf, delimiter="\t")
-            for row in id_name_list:
-                data_output.writerow(row)
-
-
-# load Freebase entity name
-name_dir = os.path.join(args.data_dir, "id2name_parts_disamb")
-id2name_dict = {}
-for file_name in tqdm(os.listdir(name_dir)):
-    with open(os.path.join(name_dir, file_name), 'r') as rf:
-        data_input = csv.reader(rf, delimiter="\t")
-        for row in data_input:
-            id2name_dict[row[0]] = row[2]
-print("number of entities with names: ", len(id2name_dict))
+                id2name_dict[row[0]] = row[2]
+    return id2name_dict
 
 
-# load topic and type information from Freebase
-topic_dir = os.path.join(args.data_dir, "topic_entities_parts")
-id2topic_dict = defaultdict(set)
-file_list = os.listdir(topic_dir)
-# sort file list
-file_list.sort()
-for file_name in tqdm(file_list):
-    with open(os.path.join(topic_dir, file_name), 'r') as rf:
-        for row in rf:
-            row = row.strip().split("\t")
-            if len(row) != 3:
-                continue
-            if "web" in row[1] or "type.object.name" in row[1]:
-                continue
-            topic = row[1].split(".")[-1].replace('.', ' ').replace('_', ' ')
-            topic += " : " + row[2].replace('.', ' ').replace('_', ' ')
-            id2topic_dict[row[0]].add(topic)
-print("number of entities with topics: ", len(id2topic_dict))
+# open the memory-mapped tables in each worker, the pages are shared through
+# the page cache so the per-worker memory does not grow with the table size
+def attach_shared_tables(name_dir, topic_dir):
+    global id2name_dict, id2topic_dict
+    _, id2name_dict = load_nameid_index(name_dir)
+    id2topic_dict = load_topic_index(topic_dir, num_process=args.num_process)
+
+
+def entity_passages(key, relation_texts):
+    name = id2name_dict.get(key)
+    topics = id2topic_dict[key] if key in id2topic_dict else None
+    return linearize_entity(key, name, relation_texts, topics)
+
+
+# yields (subject, relation text) for every triple kept in the passages, the looked up
+# entities are recorded in dependencies (topics are only looked up for the subjects)
+def iter_relation_texts(file_path, stats, dependencies=None):
+    entity_names = id2name_dict if dependencies is None else RecordingLookup(id2name_dict, dependencies)
+    with open(file_path, "r") as rf:
+        yield from linearize_triples(rf, entity_names, stats)
+
+
+# group the triples of a shard in memory, subjects keep their order of first appearance
+def iter_passages_in_memory(file_path, stats, dependencies=None):
+    grouped_entity_triples = defaultdict(list)
+    for subj, relation_text in iter_relation_texts(file_path, stats, dependencies):
+        grouped_entity_triples[subj].append(relation_text)
+    for key in grouped_entity_triples:
+        yield from entity_passages(key, grouped_entity_triples[key])
+
+
+# same passages in the same order as iter_passages_in_memory with bounded memory:
+# sort the triples by subject on disk, linearize one subject at a time, then sort
+# the passages back by the position where their subject first appeared
+def iter_passages_external(file_path, stats, buffer_size, tmp_dir, dependencies=None):
+    def iter_records():
+        for pos, (subj, relation_text) in enumerate(iter_relation_texts(file_path, stats, dependencies)):
+            yield subj, str(pos), clean_text(relation_text)
+
+    def iter_subject_passages():
+        records = external_sort(iter_records(), itemgetter(0), buffer_size, tmp_dir)
+        for key, group in itertools.groupby(records, key=itemgetter(0)):
+            _, first_pos, relation_text = next(group)
+            relation_texts = itertools.chain([relation_text], (record[2] for record in group))
+            for title, contents_chunk in entity_passages(key, relation_texts):
+                yield first_pos, title, contents_chunk
+
+    for _, title, contents_chunk in external_sort(iter_subject_passages(), lambda record: int(record[0]), buffer_size, tmp_dir):
+        yield title, contents_chunk
 
 
 # transform each entity centric 1-hop subgraph (only out relations) as one passage
-def transform_triples_group_woid(process_idx, num_process, triple_dir, save_dir):
+def transform_triples_group_woid(file_name, triple_dir, save_dir):
     # do not keep CVT node id
-    for file_name in tqdm(os.listdir(triple_dir)):
-        file_id = int(file_name.split("-")[-1])
-        if file_id % num_process != process_idx:
-            continue
-        file_path = os.path.join(triple_dir, file_name)
-        grouped_entity_triples = defaultdict(list)
-        with open(file_path, "r") as rf:
-            for row in rf:
-                if len(row.strip().split("\t")) != 3:
-                    continue
-                triple = Relation(row)
-                if triple.should_ignore(id2name_dict):
-                    continue
-                if triple.obj.startswith("m") and triple.obj not in id2name_dict:
-                    continue
-                subj = triple.subj
-                if triple.subj not in id2name_dict:
-                    triple.subj = ""
-                grouped_entity_triples[subj].append(convert_relation_to_text(triple, id2name_dict))
-                
-        with jsonlines.open(os.path.join(save_dir, file_name) + ".jsonl", "w") as wf:
-            data_id = 0
-            for key in grouped_entity_triples:
-                if key in id2name_dict:
-                    name_key = id2name_dict[key]
-                    title = name_key + " " + key
-                else:
-                    name_key = ""
-                    title = key
-                contents = " ".join(grouped_entity_triples[key])
-                # add topic information
-                if key in id2topic_dict:
-                    topics = id2topic_dict[key]
-                    topics = [name_key + " " + topic + " ." for topic in topics]
-                    topics_contents = " ".join(topics)
-                    contents += " " + topics_contents
-                
-                contents = contents.replace("\t", " ").replace("\n", " ")
-                title = title.replace("\t", " ").replace("\n", " ")
-                # split contents by 100 words each chunk
-                contents_split = contents.split(" ")
-                contents_chunks = [" ".join(contents_split[i:i+100]) for i in range(0, len(contents_split), 100)]
-                for contents_chunk in contents_chunks:
-                    data_output_i = {"id": "freebase-file{}doc{}".format(file_id, data_id),
-                                    "contents": contents_chunk,
-                                    "title": title}
-                    wf.write(data_output_i)
-                    data_id += 1
+    start_time = time.time()
+    stats = {"triples": 0}
+    file_id = int(file_name.split("-")[-1])
+    file_path = os.path.join(triple_dir, file_name)
+    # the name and topic parts the shard depends on, recorded for the manifest
+    dependencies = PartDependencies(table_fingerprints) if args.incremental else None
+    if args.external_sort:
+        passages = iter_passages_external(file_path, stats, args.buffer_size, args.tmp_dir, dependencies)
+    else:
+        passages = iter_passages_in_memory(file_path, stats, dependencies)
+
+    if args.output_format == "zstd":
+        writer = PassageShardWriter(os.path.join(save_dir, file_name), file_id)
+    else:
+        writer = jsonlines.open(os.path.join(save_dir, shard_output_name(file_name)), "w")
+    with writer as wf:
+        for data_id, (title, contents_chunk) in enumerate(passages):
+            data_output_i = {"id": "freebase-file{}doc{}".format(file_id, data_id),
+                            "contents": contents_chunk,
+                            "title": title}
+            wf.write(data_output_i)
+
+    return {"pid": os.getpid(),
+            "file_name": file_name,
+            "bytes": os.path.getsize(file_path),
+            "triples": stats["triples"],
+            "tables": dependencies.parts() if dependencies is not None else None,
+            "seconds": time.time() - start_time}
+
+
+def log_worker_throughput(file_stats, wall_time):
+    worker_stats = defaultdict(lambda: {"files": 0, "bytes": 0, "triples": 0, "seconds": 0.0})
+    for stats in file_stats:
+        worker = worker_stats[stats["pid"]]
+        worker["files"] += 1
+        worker["bytes"] += stats["bytes"]
+        worker["triples"] += stats["triples"]
+        worker["seconds"] += stats["seconds"]
+    print("worker throughput (wall time {:.1f}s):".format(wall_time))
+    for pid, worker in sorted(worker_stats.items(), key=lambda item: -item[1]["seconds"]):
+        seconds = max(worker["seconds"], 1e-8)
+        print("  pid {:>8} files {:>5} busy {:>8.1f}s ({:>5.1f}%) {:>8.1f} MB/s {:>10.0f} triples/s".format(
+            pid, worker["files"], worker["seconds"], 100 * worker["seconds"] / max(wall_time, 1e-8),
+            worker["bytes"] / seconds / 1e6, worker["triples"] / seconds))
+    slowest = max(file_stats, key=lambda stats: stats["seconds"])
+    print("  slowest shard: {} ({:.1f}s, {:.1f} MB)".format(
+        slowest["file_name"], slowest["seconds"], slowest["bytes"] / 1e6))
 
 
 # Multi-process data processing
-def transform_triples_multip(triple_dir, save_dir):
-    num_process = 10
-    pool = Pool(num_process)
-    sampleData = [x for x in range(num_process)]
+# shards are handed out one at a time, largest first, so a worker that finishes
+# early takes the next shard instead of idling while one worker holds the tail
+def transform_triples_multip(triple_dir, save_dir, file_list):
+    num_process = min(args.num_process, len(file_list))
+    file_list = sorted(file_list, key=lambda file_name: os.path.getsize(os.path.join(triple_dir, file_name)), reverse=True)
+    if args.shared_tables:
+        pool = Pool(num_process, initializer=attach_shared_tables, initargs=(name_dir, topic_dir))
+    else:
+        pool = Pool(num_process)
     transform_triples_part = partial(transform_triples_group_woid, 
                                      triple_dir=triple_dir, 
-                                     num_process=num_process, 
                                      save_dir=save_dir)
-    pool.map(transform_triples_part, sampleData)
+    start_time = time.time()
+    file_stats = []
+    for stats in tqdm(pool.imap_unordered(transform_triples_part, file_list, chunksize=1), total=len(file_list)):
+        file_stats.append(stats)
     pool.close()
     pool.join()
+    log_worker_throughput(file_stats, time.time() - start_time)
+    return file_stats
 
 triple_dir = os.path.join(args.data_dir, "triple_edges_parts")
-save_dir = os.path.join(args.data_dir, "processed/document")
+if args.output_format == "zstd":
+    save_dir = os.path.join(args.data_dir, "processed/passage_store")
+else:
+    save_dir = os.path.join(args.data_dir, "processed/document")
 os.makedirs(save_dir, exist_ok=True)
-transform_triples_multip(triple_dir, save_dir)
\ No newline at end of file
+file_list = sorted(os.listdir(triple_dir))
+
+if args.incremental:
+    with Pool(args.num_process) as pool:
+        table_fingerprints = {
+            "names": fingerprint_parts(name_dir, manifest["tables"].get("names", {}).get("parts"), pool, id_ranges=True),
+            "topics": fingerprint_parts(topic_dir, manifest["tables"].get("topics", {}).get("parts"), pool, id_ranges=True),
+        }
+        triple_fingerprints = fingerprint_parts(triple_dir, manifest.get("triples"), pool)
+    table_digests = {table: table_digest(parts) for table, parts in table_fingerprints.items()}
+    # the memory-mapped tables are built once per directory, drop them when their inputs changed
+    for table, index_dir in [("names", name_index.get_index_dir(name_dir)), ("topics", topic_index.get_index_dir(topic_dir))]:
+        old_digest = manifest["tables"].get(table, {}).get("digest")
+        if old_digest is not None and old_digest != table_digests[table] and os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+
+    stale, removed = plan_rebuild(manifest, triple_fingerprints, table_fingerprints, save_dir, args.output_format)
+    removed_outputs = []
+    for file_name in removed:
+        output_name = manifest["shards"][file_name].get("output", shard_output_name(file_name))
+        removed_outputs.append(output_name)
+        output_dir = os.path.join(args.data_dir, "processed/passage_store" if output_name.endswith(".zst") else "processed/document")
+        output_paths = [os.path.join(output_dir, output_name)]
+        if output_name.endswith(".zst"):
+            output_paths += [os.path.join(output_dir, file_name + ".offsets.npy"), os.path.join(output_dir, file_name + ".json")]
+        for output_path in output_paths:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+    for file_name in sorted(stale):
+        print(f"{file_name}: {stale[file_name]}")
+    print(f"{len(stale)} shards to regenerate, {len(removed)} removed, {len(file_list) - len(stale)} unchanged")
+    file_list = sorted(stale)
+
+if len(file_list) > 0:
+    if args.shared_tables:
+        # builds the tables on first use
+        attach_shared_tables(name_dir, topic_dir)
+    else:
+        id2name_dict = load_id2name_dict(name_dir)
+        # topics are integer references into a label table, inherited by the workers
+        id2topic_dict = build_topic_store(topic_dir, args.num_process)
+    print("number of entities with names: ", len(id2name_dict))
+    print("number of entities with topics: ", len(id2topic_dict))
+    file_stats = transform_triples_multip(triple_dir, save_dir, file_list)
+else:
+    file_stats = []
+
+if args.incremental:
+    manifest["tables"] = {
+        "id2name_parts": {"digest": source_name_digest, "parts": source_name_fingerprints},
+        "names": {"digest": table_digests["names"], "parts": table_fingerprints["names"]},
+        "topics": {"digest": table_digests["topics"], "parts": table_fingerprints["topics"]},
+    }
+    manifest["triples"] = triple_fingerprints
+    for file_name in removed:
+        del manifest["shards"][file_name]
+    for stats in file_stats:
+        manifest["shards"][stats["file_name"]] = {
+            "triples": triple_fingerprints[stats["file_name"]]["sha1"],
+            # {table: {part: sha1}} of the parts holding an entity the shard looked up
+            "tables": {table: {part: table_fingerprints[table][part]["sha1"] for part in stats["tables"].get(table, [])}
+                       for table in table_fingerprints},
+            "output": shard_output_name(stats["file_name"], args.output_format),
+        }
+    save_manifest(manifest_path, manifest)
+
+    # only the indexes, or index shards, built from a regenerated or removed document
+    stale_documents = [shard_output_name(file_name, args.output_format) for file_name in file_list]
+    report = {
+        "regenerated": {file_name: stale[file_name] for file_name in file_list},
+        "removed": removed_outputs,
+        "stale_documents": stale_documents,
+        "stale_indexes": stale_indexes(os.path.join(args.data_dir, "processed/index"), save_dir, stale_documents + removed_outputs),
+    }
+    with open(os.path.join(args.data_dir, "processed/rebuild_report.json"), "w") as wf:
+        json.dump(report, wf, indent=2)
+    print("stale indexes: ", report["stale_indexes"])
@@ -0,0 +1,272 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+integer-encoded CSR snapshot of the Freebase triples
+
+`build` parses every triple_edges_parts file once. Each part becomes one
+directory of mmap-able NumPy arrays: terms (entity ids and literals) and
+predicates are dictionary-encoded per part, the triples are stored as a
+compressed sparse row graph keyed by subject, and the names and topics of the
+terms are resolved once from the name and topic indexes. The size and mtime of
+the name and topic parts are recorded in the meta.json of each part: `build`
+rebuilds a part whose tables changed, and `generate` refuses to use it.
+`generate` rebuilds the passages from the snapshot with other linearization
+settings (chunk size, topics, relation filters) without touching the TSVs.
+With the default settings the output is the same as `process_freebase.py`.
+
+    python DecAF/Knowledge/snapshot.py build --data_dir ${DATA_DIR}/knowledge_source/Freebase
+    python DecAF/Knowledge/snapshot.py generate --data_dir ${DATA_DIR}/knowledge_source/Freebase \
+        --output_dir ${DATA_DIR}/knowledge_source/Freebase/processed/document_chunk200 --chunk_size 200
+'''
+
+import os
+import json
+import array
+import argparse
+import jsonlines
+import numpy as np
+from tqdm import tqdm
+from functools import partial
+from multiprocessing import Pool
+from DecAF.Knowledge.linearize import (
+    parse_triple,
+    relation_surface,
+    linearize_entity,
+)
+from DecAF.Knowledge.name_index import write_string_column, StringColumn, load_nameid_index, source_signature
+from DecAF.Knowledge.topic_index import load_topic_index
+
+SNAPSHOT_VERSION = 1
+
+
+# the name and topic tables are memory-mapped and attached once per worker
+def attach_tables(name_dir, topic_dir):
+    global id2name_dict, id2topic_dict
+    _, id2name_dict = load_nameid_index(name_dir)
+    id2topic_dict = load_topic_index(topic_dir)
+
+
+def table_signatures(name_dir, topic_dir):
+    # source_signature of the name and topic parts the terms are resolved from
+    return {"names": source_signature(name_dir), "topics": source_signature(topic_dir)}
+
+
+def part_stale_reason(part_dir, tables):
+    # why the part in part_dir does not match the tables, None if it does
+    meta_path = os.path.join(part_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return "missing"
+    with open(meta_path, "r") as rf:
+        meta = json.load(rf)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        return "built by another version"
+    old_tables = meta.get("tables") or {}
+    changed = [table for table in sorted(tables) if tables[table] != old_tables.get(table)]
+    if len(changed) > 0:
+        return "{} parts changed".format(" and ".join(changed))
+    return None
+
+
+def build_part_snapshot(file_name, triple_dir, snapshot_dir, tables):
+    part_dir = os.path.join(snapshot_dir, file_name)
+    os.makedirs(part_dir, exist_ok=True)
+    terms, predicates = {}, {}
+    subj_ids, pred_ids, obj_ids = array.array("i"), array.array("i"), array.array("i")
+    with open(os.path.join(triple_dir, file_name), "r") as rf:
+        for row in rf:
+            triple = parse_triple(row)
+            if triple is None:
+                continue
+            subj, rel, obj = triple
+            subj_ids.append(terms.setdefault(subj, len(terms)))
+            pred_ids.append(predicates.setdefault(rel, len(predicates)))
+            obj_ids.append(terms.setdefault(obj, len(terms)))
+    subj_ids = np.frombuffer(subj_ids, dtype=np.int32)
+    pred_ids = np.frombuffer(pred_ids, dtype=np.int32)
+    obj_ids = np.frombuffer(obj_ids, dtype=np.int32)
+
+    # CSR keyed by subject, pos keeps the line order of every triple
+    order = np.argsort(subj_ids, kind="stable")
+    subjects, counts = np.unique(subj_ids[order], return_counts=True)
+    indptr = np.zeros(len(subjects) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    np.save(os.path.join(part_dir, "subjects.npy"), subjects.astype(np.int32))
+    np.save(os.path.join(part_dir, "indptr.npy"), indptr)
+    np.save(os.path.join(part_dir, "pred.npy"), pred_ids[order])
+    np.save(os.path.join(part_dir, "obj.npy"), obj_ids[order])
+    np.save(os.path.join(part_dir, "pos.npy"), order.astype(np.int64))
+
+    # terms, their names and the topics of the subjects
+    term_list = list(terms)
+    names = [id2name_dict.get(term) for term in term_list]
+    write_string_column(os.path.join(part_dir, "terms"), term_list)
+    write_string_column(os.path.join(part_dir, "term_names"), [name if name is not None else "" for name in names])
+    np.save(os.path.join(part_dir, "term_named.npy"), np.array([name is not None for name in names], dtype=bool))
+    np.save(os.path.join(part_dir, "term_is_mid.npy"), np.array([term.startswith("m") for term in term_list], dtype=bool))
+    write_string_column(os.path.join(part_dir, "predicates"), list(predicates))
+    topic_offsets = np.full(len(subjects) + 1, 0, dtype=np.int64)
+    has_topics = np.zeros(len(subjects), dtype=bool)
+    topics = []
+    for i, subj in enumerate(subjects):
+        term = term_list[subj]
+        if term in id2topic_dict:
+            has_topics[i] = True
+            topics.extend(id2topic_dict[term])
+        topic_offsets[i + 1] = len(topics)
+    write_string_column(os.path.join(part_dir, "topics"), topics)
+    np.save(os.path.join(part_dir, "topic_offsets.npy"), topic_offsets)
+    np.save(os.path.join(part_dir, "has_topics.npy"), has_topics)
+
+    with open(os.path.join(part_dir, "meta.json"), "w") as wf:
+        json.dump({
+            "version": SNAPSHOT_VERSION,
+            "file_name": file_name,
+            "num_triples": len(order),
+            "num_subjects": len(subjects),
+            "num_terms": len(term_list),
+            "num_predicates": len(predicates),
+            "tables": tables,
+        }, wf, indent=2)
+    return len(order)
+
+
+class PartSnapshot:
+    def __init__(self, part_dir):
+        with open(os.path.join(part_dir, "meta.json"), "r") as rf:
+            self.meta = json.load(rf)
+        load = lambda name: np.load(os.path.join(part_dir, name + ".npy"), mmap_mode="r")
+        self.subjects = load("subjects")
+        self.indptr = load("indptr")
+        self.pred = load("pred")
+        self.obj = load("obj")
+        self.pos = load("pos")
+        self.term_named = load("term_named")
+        self.term_is_mid = load("term_is_mid")
+        self.topic_offsets = load("topic_offsets")
+        self.has_topics = load("has_topics")
+        self.terms = StringColumn(os.path.join(part_dir, "terms"))
+        self.term_names = StringColumn(os.path.join(part_dir, "term_names"))
+        self.predicates = StringColumn(os.path.join(part_dir, "predicates"))
+        self.topics = StringColumn(os.path.join(part_dir, "topics"))
+
+
+def iter_snapshot_passages(part_dir, chunk_size=100, include_topics=True, exclude_relations=("type.object.name",)):
+    # yields (title, contents chunk) in the same order as process_freebase
+    snapshot = PartSnapshot(part_dir)
+    num_subjects = len(snapshot.subjects)
+    if num_subjects == 0:
+        return
+    predicates = [snapshot.predicates[i] for i in range(len(snapshot.predicates))]
+    pred_surfaces = [relation_surface(predicate) for predicate in predicates]
+    pred_keep = np.array([predicate not in exclude_relations for predicate in predicates], dtype=bool)
+    # same filters as linearize_triples: ignored relations and objects that look like unnamed entities
+    obj_drop = np.asarray(snapshot.term_is_mid) & ~np.asarray(snapshot.term_named)
+    pred, obj = np.asarray(snapshot.pred), np.asarray(snapshot.obj)
+    keep = pred_keep[pred] & ~obj_drop[obj]
+
+    # subjects are emitted in the order of their first kept triple
+    indptr = np.asarray(snapshot.indptr)
+    masked_pos = np.where(keep, np.asarray(snapshot.pos), np.iinfo(np.int64).max)
+    first_pos = np.minimum.reduceat(masked_pos, indptr[:-1])
+    subject_order = np.argsort(first_pos, kind="stable")
+    subject_order = subject_order[first_pos[subject_order] < np.iinfo(np.int64).max]
+
+    terms = [snapshot.terms[i] for i in range(len(snapshot.terms))]
+    term_named = np.asarray(snapshot.term_named)
+    names = [snapshot.term_names[i] if term_named[i] else None for i in range(len(terms))]
+    obj_surfaces = [name if name is not None else term for term, name in zip(terms, names)]
+
+    for i in subject_order:
+        start, end = int(indptr[i]), int(indptr[i + 1])
+        subj = int(snapshot.subjects[i])
+        subj_name = names[subj]
+        subj_surface = subj_name if subj_name is not None else ""
+        segment_keep = keep[start:end]
+        relation_texts = [" ".join([subj_surface, pred_surfaces[p], obj_surfaces[o], "."])
+                          for p, o in zip(pred[start:end][segment_keep].tolist(), obj[start:end][segment_keep].tolist())]
+        topics = None
+        if include_topics and snapshot.has_topics[i]:
+            topics = [snapshot.topics[j] for j in range(int(snapshot.topic_offsets[i]), int(snapshot.topic_offsets[i + 1]))]
+        yield from linearize_entity(terms[subj], subj_name, relation_texts, topics, chunk_size)
+
+
+def generate_part(file_name, snapshot_dir, output_dir, chunk_size, include_topics, exclude_relations):
+    file_id = int(file_name.split("-")[-1])
+    passages = iter_snapshot_passages(os.path.join(snapshot_dir, file_name), chunk_size, include_topics, exclude_relations)
+    num_passages = 0
+    with jsonlines.open(os.path.join(output_dir, file_name + ".jsonl"), "w") as wf:
+        for data_id, (title, contents_chunk) in enumerate(passages):
+            wf.write({"id": "freebase-file{}doc{}".format(file_id, data_id),
+                      "contents": contents_chunk,
+                      "title": title})
+            num_passages += 1
+    return num_passages
+
+
+if __name__ == "__main__":
+    DATA_DIR = os.environ['DATA_DIR']
+
+    parser = argparse.ArgumentParser(description='CSR snapshot of Freebase for passage generation')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="convert triple_edges_parts into the snapshot")
+    generate_parser = subparsers.add_parser("generate", help="generate passages from the snapshot")
+    for sub_parser in [build_parser, generate_parser]:
+        sub_parser.add_argument('--data_dir', type=str, default=f'{DATA_DIR}/knowledge_source/Freebase')
+        sub_parser.add_argument('--snapshot_dir', type=str, default=None,
+                                help="defaults to {data_dir}/processed/snapshot")
+        sub_parser.add_argument('--num_process', type=int, default=os.cpu_count())
+    build_parser.add_argument('--overwrite', action='store_true', help="rebuild existing parts")
+    generate_parser.add_argument('--output_dir', type=str, required=True)
+    generate_parser.add_argument('--chunk_size', type=int, default=100, help="number of words of each passage")
+    generate_parser.add_argument('--no_topics', action='store_true', help="do not add topic information")
+    generate_parser.add_argument('--exclude_relations', type=str, default="type.object.name",
+                                 help="relations to drop, split by comma")
+    args = parser.parse_args()
+
+    snapshot_dir = args.snapshot_dir or os.path.join(args.data_dir, "processed/snapshot")
+    if args.command == "build":
+        triple_dir = os.path.join(args.data_dir, "triple_edges_parts")
+        name_dir = os.path.join(args.data_dir, "id2name_parts_disamb")
+        topic_dir = os.path.join(args.data_dir, "topic_entities_parts")
+        # taken before the tables are loaded, a part changed meanwhile makes the snapshot stale
+        tables = table_signatures(name_dir, topic_dir)
+        file_list = []
+        for file_name in os.listdir(triple_dir):
+            reason = part_stale_reason(os.path.join(snapshot_dir, file_name), tables)
+            if reason not in [None, "missing"]:
+                print(f"{file_name}: {reason}, rebuilding")
+            if args.overwrite or reason is not None:
+                file_list.append(file_name)
+        # largest first, so the pool does not wait on one big part at the end
+        file_list = sorted(file_list, key=lambda file_name: -os.path.getsize(os.path.join(triple_dir, file_name)))
+        # build the shared tables once before the workers attach to them
+        load_nameid_index(name_dir)
+        load_topic_index(topic_dir)
+        with Pool(args.num_process, initializer=attach_tables, initargs=(name_dir, topic_dir)) as pool:
+            build_part = partial(build_part_snapshot, triple_dir=triple_dir, snapshot_dir=snapshot_dir, tables=tables)
+            num_triples = sum(tqdm(pool.imap_unordered(build_part, file_list), total=len(file_list)))
+        print(f"snapshot of {len(file_list)} parts, {num_triples} triples saved to {snapshot_dir}")
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        exclude_relations = tuple(relation for relation in args.exclude_relations.split(",") if len(relation) > 0)
+        file_list = [file_name for file_name in os.listdir(snapshot_dir)
+                     if os.path.exists(os.path.join(snapshot_dir, file_name, "meta.json"))]
+        name_dir = os.path.join(args.data_dir, "id2name_parts_disamb")
+        topic_dir = os.path.join(args.data_dir, "topic_entities_parts")
+        # a snapshot copied without the name and topic parts is used as is
+        if os.path.isdir(name_dir) and os.path.isdir(topic_dir):
+            tables = table_signatures(name_dir, topic_dir)
+            stale = {file_name: part_stale_reason(os.path.join(snapshot_dir, file_name), tables) for file_name in file_list}
+            stale = {file_name: reason for file_name, reason in stale.items() if reason is not None}
+            if len(stale) > 0:
+                for file_name in sorted(stale)[:10]:
+                    print(f"{file_name}: {stale[file_name]}")
+                exit(f"{len(stale)} snapshot parts are stale, run `snapshot.py build` first")
+        file_list = sorted(file_list, key=lambda file_name: -os.path.getsize(os.path.join(snapshot_dir, file_name, "pred.npy")))
+        with Pool(args.num_process) as pool:
+            generate = partial(generate_part, snapshot_dir=snapshot_dir, output_dir=args.output_dir,
+                               chunk_size=args.chunk_size, include_topics=not args.no_topics,
+                               exclude_relations=exclude_relations)
+            num_passages = sum(tqdm(pool.imap_unordered(generate, file_list), total=len(file_list)))
+        print(f"{num_passages} passages saved to {args.output_dir}")
@@ -0,0 +1,176 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+compact Freebase topic store
+
+The "type : value" topics of each entity from topic_entities_parts are stored
+as integer references into a deduplicated label table:
+    ids.npy                   sorted entity ids (fixed width bytes)
+    topic_offsets.npy         id -> slice of topic_type / topic_value
+    topic_type.npy            label id of the type, e.g. "notable types"
+    topic_value.npy           label id of the value, e.g. "music artist"
+    labels.bin/.offsets.npy   utf-8 labels
+The topic text is only formatted when it is looked up. The parts are parsed in
+parallel, and the store can be saved and opened with mmap so that worker
+processes share the same pages. meta.json records the size and mtime of the
+parts, a saved store whose parts changed is stale.
+'''
+
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+from functools import partial
+from multiprocessing import Pool
+from DecAF.Knowledge.linearize import should_ignore_topic, topic_labels
+from DecAF.Knowledge.name_index import write_string_column, StringColumn, find_sorted_id, source_signature
+
+INDEX_VERSION = 2
+
+
+def parse_topic_part(file_name, topic_dir):
+    # entity ids and local label ids of the topics of one part
+    labels = {}
+    entity_ids, topic_type, topic_value = [], [], []
+    with open(os.path.join(topic_dir, file_name), 'r') as rf:
+        for row in rf:
+            row = row.strip().split("\t")
+            if len(row) != 3:
+                continue
+            if should_ignore_topic(row[1]):
+                continue
+            type_label, value_label = topic_labels(row[1], row[2])
+            entity_ids.append(row[0].encode("utf-8"))
+            topic_type.append(labels.setdefault(type_label, len(labels)))
+            topic_value.append(labels.setdefault(value_label, len(labels)))
+    return (np.array(entity_ids, dtype=bytes),
+            list(labels),
+            np.array(topic_type, dtype=np.int32),
+            np.array(topic_value, dtype=np.int32))
+
+
+class TopicStore:
+    def __init__(self, ids, topic_offsets, topic_type, topic_value, labels, sources=None):
+        self.ids = ids
+        self.topic_offsets = topic_offsets
+        self.topic_type = topic_type
+        self.topic_value = topic_value
+        # the label table is small, keep it as python strings
+        self.labels = labels
+        # source_signature of the parts the store is built from
+        self.sources = sources
+
+    def __contains__(self, entity_id):
+        return find_sorted_id(self.ids, entity_id) >= 0
+
+    def __getitem__(self, entity_id):
+        pos = find_sorted_id(self.ids, entity_id)
+        if pos < 0:
+            raise KeyError(entity_id)
+        start, end = int(self.topic_offsets[pos]), int(self.topic_offsets[pos + 1])
+        labels = self.labels
+        return [labels[type_id] + " : " + labels[value_id]
+                for type_id, value_id in zip(self.topic_type[start:end].tolist(), self.topic_value[start:end].tolist())]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, "ids.npy"), self.ids)
+        np.save(os.path.join(index_dir, "topic_offsets.npy"), self.topic_offsets)
+        np.save(os.path.join(index_dir, "topic_type.npy"), self.topic_type)
+        np.save(os.path.join(index_dir, "topic_value.npy"), self.topic_value)
+        write_string_column(os.path.join(index_dir, "labels"), self.labels)
+        with open(os.path.join(index_dir, "meta.json"), "w") as wf:
+            json.dump({
+                "version": INDEX_VERSION,
+                "num_ids": len(self.ids),
+                "num_topics": len(self.topic_type),
+                "num_labels": len(self.labels),
+                "sources": self.sources,
+            }, wf, indent=2)
+
+    @classmethod
+    def load(cls, index_dir, topic_dir=None):
+        # with topic_dir, a store that does not match its parts is refused
+        if topic_dir is not None:
+            reason = stale_reason(topic_dir, index_dir)
+            if reason is not None:
+                raise ValueError(f"topic index {index_dir} is stale ({reason})")
+        with open(os.path.join(index_dir, "meta.json"), "r") as rf:
+            sources = json.load(rf).get("sources")
+        load = lambda name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r")
+        labels = StringColumn(os.path.join(index_dir, "labels"))
+        return cls(load("ids"), load("topic_offsets"), load("topic_type"), load("topic_value"),
+                   [labels[i] for i in range(len(labels))], sources)
+
+
+def build_topic_store(topic_dir, num_process=None):
+    print(f"Loading topics from {topic_dir} ...")
+    # taken before reading, a part changed during the build makes the store stale
+    sources = source_signature(topic_dir)
+    file_list = sorted(os.listdir(topic_dir))
+    labels = {}
+    entity_ids, topic_type, topic_value = [], [], []
+    with Pool(num_process) as pool:
+        parse_part = partial(parse_topic_part, topic_dir=topic_dir)
+        for part_ids, part_labels, part_type, part_value in tqdm(pool.imap(parse_part, file_list), total=len(file_list)):
+            # map the local label ids of the part to the global label table
+            label_map = np.array([labels.setdefault(label, len(labels)) for label in part_labels], dtype=np.int32)
+            entity_ids.append(part_ids)
+            topic_type.append(label_map[part_type])
+            topic_value.append(label_map[part_value])
+    entity_ids = np.concatenate(entity_ids) if len(entity_ids) > 0 else np.array([], dtype=bytes)
+    topic_type = np.concatenate(topic_type) if len(topic_type) > 0 else np.array([], dtype=np.int32)
+    topic_value = np.concatenate(topic_value) if len(topic_value) > 0 else np.array([], dtype=np.int32)
+
+    # group by entity and drop duplicated topics, topics are ordered by label id within an entity
+    order = np.lexsort((topic_value, topic_type, entity_ids))
+    entity_ids, topic_type, topic_value = entity_ids[order], topic_type[order], topic_value[order]
+    is_new = np.ones(len(entity_ids), dtype=bool)
+    is_new[1:] = (entity_ids[1:] != entity_ids[:-1]) | (topic_type[1:] != topic_type[:-1]) | (topic_value[1:] != topic_value[:-1])
+    entity_ids, topic_type, topic_value = entity_ids[is_new], topic_type[is_new], topic_value[is_new]
+    ids, starts = np.unique(entity_ids, return_index=True)
+    topic_offsets = np.append(starts, len(entity_ids)).astype(np.int64)
+    store = TopicStore(ids, topic_offsets, topic_type, topic_value, list(labels), sources)
+    print("number of entities with topics: ", len(ids))
+    return store
+
+
+def get_index_dir(topic_dir):
+    return topic_dir.rstrip("/") + "_index"
+
+
+def stale_reason(topic_dir, index_dir):
+    # why the store in index_dir does not match the parts in topic_dir, None if it does
+    meta_path = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return "missing"
+    with open(meta_path, "r") as rf:
+        meta = json.load(rf)
+    if meta.get("version") != INDEX_VERSION:
+        return "built by another version"
+    if not os.path.isdir(topic_dir):
+        # a store copied without its parts is used as is
+        return None
+    sources, old_sources = source_signature(topic_dir), meta.get("sources") or {}
+    if sources != old_sources:
+        changed = sorted(file_name for file_name in set(sources) | set(old_sources)
+                         if sources.get(file_name) != old_sources.get(file_name))
+        return "parts changed: {}".format(", ".join(changed[:5]) + (" ..." if len(changed) > 5 else ""))
+    return None
+
+
+def load_topic_index(topic_dir, index_dir=None, num_process=None):
+    # memory-mapped topic store, built and saved on first use and rebuilt
+    # when the size or mtime of a part no longer matches meta.json
+    if index_dir is None:
+        index_dir = get_index_dir(topic_dir)
+    reason = stale_reason(topic_dir, index_dir)
+    if reason is not None:
+        if reason != "missing":
+            print(f"topic index {index_dir} is stale ({reason}), rebuilding")
+        build_topic_store(topic_dir, num_process).save(index_dir)
+    return TopicStore.load(index_dir)
@@ -4,8 +4,10 @@
 import os
 import json
 import argparse
+import jsonlines
 from tqdm import tqdm
 from DecAF.Datasets.QA.utils import parse_answer
+from DecAF.Retrieval.passages import open_passages, hydrate_ctxs
 
 
 parser = argparse.ArgumentParser(description='Process the retrieved data to fit the format of FiD model')
@@ -13,20 +15,32 @@ parser.add_argument("--retrieval_data_path", type=str,
                     default='/home/ubuntu/data/KBQA/WebQSP/test.json')
 parser.add_argument("--mode", type=str, 
                     default='SPQA', help="SPQA or QA or SP")
+parser.add_argument("--passages", type=str, default=None,
+                    help="passage store, index directory or index name to look up compact results (search.py --compact)")
 args = parser.parse_args()
 
+passages = open_passages(args.passages) if args.passages is not None else None
+
 
 for split in ["dev", "train", "test"]:
 
+    # search.py writes jsonl, older results are json
     file_path = os.path.join(args.retrieval_data_path, f"{split}.json")
-    if not os.path.exists(file_path):
+    if os.path.exists(file_path + "l"):
+        with jsonlines.open(file_path + "l", "r") as rf:
+            data = list(rf)
+    elif os.path.exists(file_path):
+        with open(file_path, "r") as rf:
+            data = json.load(rf)
+    else:
         continue
-    with open(file_path, "r") as rf:
-        data = json.load(rf)
 
     new_data_qa = []
     new_data_sp = []
     for data_i in tqdm(data):
+        if passages is not None:
+            # the QA and SP examples share the looked up contexts
+            data_i["ctxs"] = hydrate_ctxs(data_i["ctxs"], passages)
         if args.mode != "QA":
             if "LF_processed" in data_i:
                 new_data_i = {
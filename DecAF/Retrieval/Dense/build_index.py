@@ -0,0 +1,107 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+build a compressed FAISS index over the passage embeddings of encode.py
+
+    python DecAF/Retrieval/Dense/build_index.py --index_name Freebase_IVFPQ --index_type ivfpq
+    python DecAF/Retrieval/Dense/build_index.py --index_name Freebase_HNSW --index_type hnsw
+
+IVF-PQ stores each passage in pq_m bytes (with 8 bit codes), HNSW keeps the
+float vectors and trades memory for latency. Inner product is used as in DPR.
+'''
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+from tqdm import tqdm
+from DecAF.Retrieval.Dense.utils import INDEX_MAP_DICT, EMBEDDING_DIR, iter_embedding_shards, unwrap_index
+
+
+def get_factory_string(args, dim):
+    if args.factory is not None:
+        return args.factory
+    if args.index_type == "ivfpq":
+        return "IVF{},PQ{}x{}".format(args.nlist, args.pq_m, args.pq_nbits)
+    elif args.index_type == "hnsw":
+        # HNSW does not support add_with_ids, the ids are kept in an IDMap
+        return "IDMap2,HNSW{}".format(args.hnsw_m)
+    return "IDMap2,Flat"
+
+
+def sample_training_vectors(embedding_dir, shards, train_size, seed=0):
+    # uniform sample over all shards
+    rng = np.random.default_rng(seed)
+    total = sum(meta["num_passages"] for _, meta in shards)
+    rate = min(1.0, train_size / max(total, 1))
+    vectors = []
+    for name, meta in tqdm(shards, desc="sampling"):
+        embeddings = np.load(os.path.join(embedding_dir, name + ".npy"), mmap_mode="r")
+        rows = np.flatnonzero(rng.random(meta["num_passages"]) < rate)
+        vectors.append(np.asarray(embeddings[rows], dtype=np.float32))
+    return np.concatenate(vectors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build a FAISS index')
+    parser.add_argument("--embedding_dir", type=str, default=EMBEDDING_DIR)
+    parser.add_argument("--index_name", type=str, default="Freebase_IVFPQ",
+                        help="name in INDEX_MAP_DICT of DecAF/Retrieval/Dense/utils.py")
+    parser.add_argument("--index_dir", type=str, default=None,
+                        help="output directory, overrides --index_name")
+    parser.add_argument("--index_type", type=str, default="ivfpq", choices=["ivfpq", "hnsw", "flat"])
+    parser.add_argument("--factory", type=str, default=None,
+                        help="faiss index_factory string, overrides --index_type")
+    parser.add_argument("--nlist", type=int, default=65536, help="number of IVF lists")
+    parser.add_argument("--pq_m", type=int, default=64, help="number of PQ sub-quantizers")
+    parser.add_argument("--pq_nbits", type=int, default=8, help="bits per PQ code")
+    parser.add_argument("--hnsw_m", type=int, default=32, help="number of HNSW neighbors")
+    parser.add_argument("--ef_construction", type=int, default=200)
+    parser.add_argument("--train_size", type=int, default=1000000,
+                        help="number of embeddings sampled to train the IVF-PQ quantizers")
+    parser.add_argument("--add_batch_size", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    index_dir = args.index_dir if args.index_dir is not None else INDEX_MAP_DICT[args.index_name]
+    os.makedirs(index_dir, exist_ok=True)
+    faiss.omp_set_num_threads(args.threads)
+
+    shards = list(iter_embedding_shards(args.embedding_dir))
+    if len(shards) == 0:
+        exit("no encoded shards in {}".format(args.embedding_dir))
+    dim = shards[0][1]["dim"]
+    encoder_name = shards[0][1]["encoder"]
+    factory = get_factory_string(args, dim)
+    print("index: ", factory)
+    index = faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT)
+    base_index = unwrap_index(index)
+    if hasattr(base_index, "hnsw"):
+        base_index.hnsw.efConstruction = args.ef_construction
+
+    start_time = time.time()
+    if not index.is_trained:
+        train_vectors = sample_training_vectors(args.embedding_dir, shards, args.train_size)
+        print("training on {} vectors".format(len(train_vectors)))
+        index.train(train_vectors)
+        del train_vectors
+
+    for name, meta in tqdm(shards, desc="adding"):
+        embeddings = np.load(os.path.join(args.embedding_dir, name + ".npy"), mmap_mode="r")
+        for start in range(0, meta["num_passages"], args.add_batch_size):
+            end = min(start + args.add_batch_size, meta["num_passages"])
+            data_ids = np.arange(start, end, dtype=np.int64)
+            index.add_with_ids(np.asarray(embeddings[start:end], dtype=np.float32), (meta["file_id"] << 32) | data_ids)
+
+    faiss.write_index(index, os.path.join(index_dir, "index.faiss"))
+    with open(os.path.join(index_dir, "meta.json"), "w") as wf:
+        json.dump({
+            "factory": factory,
+            "dim": dim,
+            "num_passages": index.ntotal,
+            "encoder": encoder_name,
+        }, wf, indent=2)
+    print("{} passages indexed in {:.1f}s, saved to {}".format(index.ntotal, time.time() - start_time, index_dir))
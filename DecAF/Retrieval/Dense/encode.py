@@ -0,0 +1,154 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+resumable CPU encoding of the Freebase passages
+
+    python DecAF/Retrieval/Dense/encode.py --passage_encoder ${YOUR_DPR_CTX_ENCODER} --num_process 8 --quantize
+
+Each document shard {name}.jsonl is encoded into {name}.npy, a float16
+(num_passages, dim) memmap in data_id order, and {name}.json with the number of
+passages encoded so far. The passages are encoded in checkpoints of
+--checkpoint_size passages; inside a checkpoint they are sorted by length so
+that each batch is padded to similar lengths. After every checkpoint the
+memmap is flushed and num_done updated, a killed job resumes from there.
+'''
+
+import os
+import json
+import time
+import argparse
+import itertools
+from functools import partial
+from multiprocessing import Pool
+import jsonlines
+import numpy as np
+import torch
+from tqdm import tqdm
+from DecAF.Retrieval.Dense.utils import EMBEDDING_DIR, INDEX_DIR
+from DecAF.Retrieval.Dense.encoder import Encoder
+from DecAF.Knowledge.passage_store import parse_docid
+
+# set in each worker by init_worker
+encoder = None
+
+
+def init_worker(model_name, max_length, quantize, threads):
+    global encoder
+    torch.set_num_threads(threads)
+    encoder = Encoder(model_name, kind="passage", max_length=max_length, quantize=quantize)
+
+
+def save_meta(path, meta):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as wf:
+        json.dump(meta, wf, indent=2)
+    os.replace(tmp_path, path)
+
+
+def shard_signature(document_path):
+    stat = os.stat(document_path)
+    return {"document_size": stat.st_size, "document_mtime_ns": stat.st_mtime_ns}
+
+
+def encode_chunk(passages, batch_size):
+    # longest passages first, batches are cut from the sorted order and written back in place
+    order = sorted(range(len(passages)), key=lambda i: -len(passages[i]["title"]) - len(passages[i]["contents"]))
+    embeddings = None
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        batch_embeddings = encoder.encode([passages[i]["contents"] for i in batch], [passages[i]["title"] for i in batch])
+        if embeddings is None:
+            embeddings = np.zeros((len(passages), batch_embeddings.shape[1]), dtype=np.float16)
+        embeddings[batch] = batch_embeddings
+    return embeddings
+
+
+def encode_shard(file_name, document_dir, embedding_dir, batch_size, checkpoint_size):
+    name = file_name[:-len(".jsonl")]
+    document_path = os.path.join(document_dir, file_name)
+    meta_path = os.path.join(embedding_dir, name + ".json")
+    embedding_path = os.path.join(embedding_dir, name + ".npy")
+    start_time = time.time()
+
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(embedding_path):
+        with open(meta_path, "r") as rf:
+            meta = json.load(rf)
+        # start over if the documents or the encoder changed
+        if (meta["encoder"], meta["max_length"], meta["quantize"]) != (encoder.model_name, encoder.max_length, encoder.quantize) \
+                or any(meta[key] != value for key, value in shard_signature(document_path).items()):
+            meta = None
+    if meta is not None and meta["num_done"] == meta["num_passages"]:
+        return name, 0, 0.0
+
+    with jsonlines.open(document_path, "r") as rf:
+        first = next(iter(rf), None)
+    if first is None:
+        return name, 0, 0.0
+    if meta is None:
+        with open(document_path, "r") as rf:
+            num_passages = sum(1 for _ in rf)
+        meta = {"file_id": parse_docid(first["id"])[0],
+                "num_passages": num_passages,
+                "num_done": 0,
+                "dim": int(encoder.encode(["dim"]).shape[1]),
+                "encoder": encoder.model_name,
+                "max_length": encoder.max_length,
+                "quantize": encoder.quantize}
+        meta.update(shard_signature(document_path))
+        embeddings = np.lib.format.open_memmap(embedding_path, mode="w+", dtype=np.float16,
+                                               shape=(meta["num_passages"], meta["dim"]))
+        save_meta(meta_path, meta)
+    else:
+        embeddings = np.load(embedding_path, mmap_mode="r+")
+
+    num_encoded = 0
+    with jsonlines.open(document_path, "r") as rf:
+        passages = itertools.islice(iter(rf), meta["num_done"], None)
+        while meta["num_done"] < meta["num_passages"]:
+            chunk = list(itertools.islice(passages, checkpoint_size))
+            start = meta["num_done"]
+            embeddings[start:start + len(chunk)] = encode_chunk(chunk, batch_size)
+            embeddings.flush()
+            meta["num_done"] = start + len(chunk)
+            save_meta(meta_path, meta)
+            num_encoded += len(chunk)
+    return name, num_encoded, time.time() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='encode the passages for dense retrieval')
+    parser.add_argument("--document_dir", type=str, default=f"{INDEX_DIR}/Freebase/processed/document")
+    parser.add_argument("--embedding_dir", type=str, default=EMBEDDING_DIR)
+    parser.add_argument("--passage_encoder", type=str, default="facebook/dpr-ctx_encoder-single-nq-base")
+    parser.add_argument("--max_length", type=int, default=256)
+    parser.add_argument("--quantize", action="store_true",
+                        help="int8 dynamic quantization of the linear layers")
+    parser.add_argument("--num_process", type=int, default=4,
+                        help="number of worker processes, each encodes one shard at a time")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch threads per worker, defaults to the number of CPUs divided by --num_process")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--checkpoint_size", type=int, default=8192,
+                        help="number of passages encoded between two checkpoints")
+    args = parser.parse_args()
+
+    os.makedirs(args.embedding_dir, exist_ok=True)
+    threads = args.threads if args.threads is not None else max(1, os.cpu_count() // args.num_process)
+    file_list = sorted(file_name for file_name in os.listdir(args.document_dir) if file_name.endswith(".jsonl"))
+    # largest shards first so that no worker is left with a large shard at the end
+    file_list.sort(key=lambda file_name: os.path.getsize(os.path.join(args.document_dir, file_name)), reverse=True)
+
+    start_time = time.time()
+    num_encoded = 0
+    encode_part = partial(encode_shard, document_dir=args.document_dir, embedding_dir=args.embedding_dir,
+                          batch_size=args.batch_size, checkpoint_size=args.checkpoint_size)
+    with Pool(args.num_process, initializer=init_worker,
+              initargs=(args.passage_encoder, args.max_length, args.quantize, threads)) as pool:
+        for name, num_shard_encoded, seconds in tqdm(pool.imap_unordered(encode_part, file_list, chunksize=1), total=len(file_list)):
+            if num_shard_encoded > 0:
+                print("{}: {} passages in {:.1f}s ({:.1f} passages/s)".format(
+                    name, num_shard_encoded, seconds, num_shard_encoded / max(seconds, 1e-8)))
+            num_encoded += num_shard_encoded
+    print("encoded {} passages in {:.1f}s".format(num_encoded, time.time() - start_time))
@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+query and passage encoders for dense retrieval
+
+DPR checkpoints (e.g. facebook/dpr-question_encoder-single-nq-base and
+facebook/dpr-ctx_encoder-single-nq-base) are loaded with their DPR classes,
+other checkpoints with AutoModel and the [CLS] vector as embedding. On CPU,
+quantize=True applies int8 dynamic quantization to the linear layers.
+'''
+
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoModel, AutoTokenizer, DPRQuestionEncoder, DPRContextEncoder
+
+
+class Encoder:
+    def __init__(self, model_name, kind="query", max_length=256, quantize=False):
+        self.model_name = model_name
+        self.kind = kind
+        self.max_length = max_length
+        self.quantize = quantize
+        config = AutoConfig.from_pretrained(model_name)
+        self.is_dpr = config.model_type == "dpr"
+        if self.is_dpr:
+            model_class = DPRQuestionEncoder if kind == "query" else DPRContextEncoder
+        else:
+            model_class = AutoModel
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = model_class.from_pretrained(model_name).eval()
+        if quantize:
+            # int8 weights for the linear layers, activations are quantized on the fly
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    @torch.no_grad()
+    def encode(self, texts, titles=None):
+        # passages are encoded as "title [SEP] text" like DPR
+        if titles is not None:
+            inputs = self.tokenizer(titles, texts, padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors="pt")
+        else:
+            inputs = self.tokenizer(texts, padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors="pt")
+        outputs = self.model(**inputs)
+        if self.is_dpr:
+            embeddings = outputs.pooler_output
+        else:
+            embeddings = outputs.last_hidden_state[:, 0]
+        return embeddings.float().numpy().astype(np.float32)
@@ -0,0 +1,120 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+dense retrieval over a FAISS index, with the same interface and output as Bm25Searcher
+
+    python DecAF/Retrieval/Dense/search.py --index_name Freebase_IVFPQ --query_data_path ${DATA_DIR}/tasks/QA/WebQSP/test.json --eval --save
+'''
+
+import os
+import json
+import argparse
+import faiss
+from DecAF.Retrieval.utils import get_ignore_list, clean_query, run_search
+from DecAF.Retrieval.Dense.utils import INDEX_MAP_DICT, PASSAGE_STORE_DIR, load_index, set_search_parameters, int_to_docid
+from DecAF.Retrieval.Dense.encoder import Encoder
+from DecAF.Knowledge.passage_store import PassageStore
+
+
+class DenseSearcher:
+    def __init__(self, index_dir, args):
+        self.index_dir = index_dir
+        self.args = args
+        with open(os.path.join(index_dir, "meta.json"), "r") as rf:
+            self.meta = json.load(rf)
+        self.index = load_index(index_dir, mmap=not args.no_mmap)
+        set_search_parameters(self.index, nprobe=args.nprobe, ef_search=args.ef_search)
+        if args.threads is not None:
+            faiss.omp_set_num_threads(args.threads)
+        self.encoder = Encoder(args.query_encoder, kind="query")
+        self.passage_store = PassageStore(args.passage_store)
+        self.ignore_list = get_ignore_list(args.ignore_string)
+        self.cache = None
+
+    def clean_query(self, query):
+        return clean_query(query, self.ignore_list)
+
+    def hydrate(self, scores, index_ids):
+        ctxs = []
+        for score, index_id in zip(scores.tolist(), index_ids.tolist()):
+            # -1 when the index returns less than top_k passages
+            if index_id < 0:
+                continue
+            docid = int_to_docid(index_id)
+            doc_dict = self.passage_store[docid]
+            ctxs.append({"id": docid, "title": doc_dict["title"], "text": doc_dict["contents"], "score": score})
+        return ctxs
+
+    def perform_batch_search(self, data, top_k, threads=None):
+        queries = [self.clean_query(data_i["Question"]) for data_i in data]
+        batch_size = self.args.query_batch_size
+        output_data = []
+        for start in range(0, len(queries), batch_size):
+            embeddings = self.encoder.encode(queries[start:start + batch_size])
+            scores, index_ids = self.index.search(embeddings, top_k)
+            for i, data_i in enumerate(data[start:start + batch_size]):
+                output_i = data_i.copy()
+                output_i["ctxs"] = self.hydrate(scores[i], index_ids[i])
+                output_data.append(output_i)
+        return output_data
+
+    def perform_search(self, data_i, top_k):
+        return self.perform_batch_search([data_i], top_k)[0]
+
+
+parser = argparse.ArgumentParser(description='Search with a FAISS index')
+parser.add_argument("--index_name", type=str, default='Freebase_IVFPQ',
+                    help="name in INDEX_MAP_DICT of DecAF/Retrieval/Dense/utils.py")
+parser.add_argument("--query_data_path", type=str, default='/home/ubuntu/data/KBQA/WebQSP/data/WebQSP_processed.test.json',
+                    help="json or jsonl file of the queries, jsonl files are streamed")
+parser.add_argument("--output_dir", type=str, default='/home/ubuntu/data/KBQA/GeneralKB/Retrieval/dense/search_results',
+                    help="directory to store the retrieved output")
+parser.add_argument("--query_encoder", type=str, default="facebook/dpr-question_encoder-single-nq-base",
+                    help="query encoder matching the passage encoder of the index")
+parser.add_argument("--passage_store", type=str, default=PASSAGE_STORE_DIR,
+                    help="passage store directory from process_freebase --output_format zstd")
+parser.add_argument("--nprobe", type=int, default=64,
+                    help="number of IVF lists visited per query")
+parser.add_argument("--ef_search", type=int, default=128,
+                    help="size of the HNSW search queue")
+parser.add_argument("--no_mmap", action="store_true",
+                    help="load the index into memory instead of memory-mapping it")
+parser.add_argument("--num_process", type=int, default=1,
+                    help="number of python threads when --batch_size is 0")
+parser.add_argument("--batch_size", type=int, default=1000,
+                    help="number of queries read and searched at a time")
+parser.add_argument("--query_batch_size", type=int, default=64,
+                    help="number of queries encoded and sent to faiss at once")
+parser.add_argument("--threads", type=int, default=None,
+                    help="number of faiss threads, defaults to all CPUs")
+parser.add_argument("--top_k", type=int, default=150,
+                    help="number of passages to be retrieved for each query")
+parser.add_argument("--ignore_string", type=str, default="",
+                    help="string to ignore in the query, split by comma")
+parser.add_argument("--num_queries", type=int, default=1000,
+                    help="number of queries to test")
+parser.add_argument("--save", action="store_true",
+                    help="whether to save the output")
+parser.add_argument("--sort_output", action="store_true",
+                    help="order the saved jsonl output by QuestionId instead of completion order")
+parser.add_argument("--compact", action="store_true",
+                    help="save only the id and score of the contexts, see DecAF/Retrieval/passages.py")
+parser.add_argument("--eval", action="store_true",
+                    help="whether to evaluate the output")
+parser.add_argument("--eval_workers", type=int, default=1,
+                    help="number of processes matching the answers during evaluation")
+parser.add_argument("--eval_dedup", action="store_true",
+                    help="match every distinct passage of the split once against all answers, keeps the split in memory")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.index_name in INDEX_MAP_DICT:
+        index_dir = INDEX_MAP_DICT[args.index_name]
+    else:
+        exit("no such index")
+    print("index dir: ", index_dir)
+    searcher = DenseSearcher(index_dir, args)
+
+    run_search(searcher, args)
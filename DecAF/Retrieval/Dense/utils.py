@@ -0,0 +1,66 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+import os
+import json
+import faiss
+from DecAF.Knowledge.passage_store import parse_docid
+
+INDEX_DIR = os.environ["DATA_DIR"] + "/knowledge_source"
+INDEX_MAP_DICT = {
+    "Freebase_IVFPQ": f"{INDEX_DIR}/Freebase/processed/index/faiss_ivfpq",
+    "Freebase_HNSW": f"{INDEX_DIR}/Freebase/processed/index/faiss_hnsw",
+}
+EMBEDDING_DIR = f"{INDEX_DIR}/Freebase/processed/embedding"
+PASSAGE_STORE_DIR = f"{INDEX_DIR}/Freebase/processed/passage_store"
+
+
+# faiss ids are int64, the passage id "freebase-file{file_id}doc{data_id}" is packed into one
+def docid_to_int(docid):
+    file_id, data_id = parse_docid(docid)
+    return (file_id << 32) | data_id
+
+
+def int_to_docid(index_id):
+    return "freebase-file{}doc{}".format(index_id >> 32, index_id & 0xffffffff)
+
+
+def iter_embedding_shards(embedding_dir):
+    # (name, meta) of the completely encoded shards of an embedding directory, see encode.py
+    # {name}.npy holds float16 (num_passages, dim) embeddings in data_id order and {name}.json
+    # the file_id, num_passages, dim, encoder name and the number of rows encoded so far (num_done)
+    for file_name in sorted(os.listdir(embedding_dir)):
+        if not file_name.endswith(".json"):
+            continue
+        with open(os.path.join(embedding_dir, file_name), "r") as rf:
+            meta = json.load(rf)
+        if meta["num_done"] == meta["num_passages"]:
+            yield file_name[:-len(".json")], meta
+
+
+def unwrap_index(index):
+    # the index under an IDMap wrapper
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def load_index(index_dir, mmap=True):
+    # memory-mapped loading keeps the codes in the page cache instead of the process heap
+    index_path = os.path.join(index_dir, "index.faiss")
+    if mmap:
+        try:
+            return faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            print("the index type does not support mmap, loading it into memory")
+    return faiss.read_index(index_path)
+
+
+def set_search_parameters(index, nprobe=None, ef_search=None):
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None and nprobe is not None:
+        ivf_index.nprobe = nprobe
+    base_index = unwrap_index(index)
+    if hasattr(base_index, "hnsw") and ef_search is not None:
+        base_index.hnsw.efSearch = ef_search
@@ -0,0 +1,172 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+hybrid BM25 + dense retrieval
+
+Both searchers run concurrently on each block of queries and their results are
+fused by reciprocal rank fusion (rrf) or by a weighted sum of min-max
+normalized scores (weighted). The fused contexts are written as "ctxs", the
+individual ones are only kept for evaluation unless --save_individual is set.
+
+    python DecAF/Retrieval/Hybrid/search.py --index_name Freebase --dense_index_name Freebase_IVFPQ \
+        --query_encoder ${YOUR_DPR_QUESTION_ENCODER} --query_data_path ${DATA_DIR}/tasks/QA/WebQSP/test.json --eval --save
+'''
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from DecAF.Retrieval.utils import run_search
+from DecAF.Retrieval.Pyserini.utils import INDEX_MAP_DICT
+from DecAF.Retrieval.Pyserini.search import load_bm25_searcher
+from DecAF.Retrieval.Dense.utils import INDEX_MAP_DICT as DENSE_INDEX_MAP_DICT, PASSAGE_STORE_DIR
+from DecAF.Retrieval.Dense.search import DenseSearcher
+
+INDIVIDUAL_KEYS = ["ctxs_bm25", "ctxs_dense"]
+
+
+def reciprocal_rank_fusion(ctxs_lists, weights, top_k, rrf_k=60):
+    scores = defaultdict(float)
+    ctx_by_id = {}
+    for ctxs, weight in zip(ctxs_lists, weights):
+        for rank, ctx in enumerate(ctxs):
+            scores[ctx["id"]] += weight / (rrf_k + rank + 1)
+            ctx_by_id.setdefault(ctx["id"], ctx)
+    return fused_ctxs(scores, ctx_by_id, top_k)
+
+
+def weighted_score_fusion(ctxs_lists, weights, top_k):
+    # scores of each retriever are min-max normalized per query, a passage missing from a list gets 0
+    scores = defaultdict(float)
+    ctx_by_id = {}
+    for ctxs, weight in zip(ctxs_lists, weights):
+        if len(ctxs) == 0:
+            continue
+        min_score = min(ctx["score"] for ctx in ctxs)
+        max_score = max(ctx["score"] for ctx in ctxs)
+        for ctx in ctxs:
+            scores[ctx["id"]] += weight * (ctx["score"] - min_score) / max(max_score - min_score, 1e-8)
+            ctx_by_id.setdefault(ctx["id"], ctx)
+    return fused_ctxs(scores, ctx_by_id, top_k)
+
+
+def fused_ctxs(scores, ctx_by_id, top_k):
+    # ties keep the order in which the passages were first seen
+    ranked = sorted(scores, key=lambda docid: -scores[docid])[:top_k]
+    return [{"id": docid, "title": ctx_by_id[docid]["title"], "text": ctx_by_id[docid]["text"], "score": scores[docid]}
+            for docid in ranked]
+
+
+class HybridSearcher:
+    def __init__(self, bm25_searcher, dense_searcher, args):
+        self.bm25_searcher = bm25_searcher
+        self.dense_searcher = dense_searcher
+        self.args = args
+        self.weights = [args.bm25_weight, args.dense_weight]
+        self.cache = bm25_searcher.cache
+        # lucene, torch and faiss release the GIL, two threads are enough to overlap them
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def fuse(self, ctxs_lists, top_k):
+        if self.args.fusion == "rrf":
+            return reciprocal_rank_fusion(ctxs_lists, self.weights, top_k, self.args.rrf_k)
+        return weighted_score_fusion(ctxs_lists, self.weights, top_k)
+
+    def perform_batch_search(self, data, top_k, threads):
+        candidate_k = max(top_k, self.args.candidate_k)
+        bm25_future = self.executor.submit(self.bm25_searcher.perform_batch_search, data, candidate_k, threads)
+        dense_future = self.executor.submit(self.dense_searcher.perform_batch_search, data, candidate_k)
+        output_data = []
+        for data_i, bm25_i, dense_i in zip(data, bm25_future.result(), dense_future.result()):
+            output_i = data_i.copy()
+            output_i["ctxs"] = self.fuse([bm25_i["ctxs"], dense_i["ctxs"]], top_k)
+            output_i["ctxs_bm25"] = bm25_i["ctxs"][:top_k]
+            output_i["ctxs_dense"] = dense_i["ctxs"][:top_k]
+            output_data.append(output_i)
+        return output_data
+
+    def perform_search(self, data_i, top_k):
+        return self.perform_batch_search([data_i], top_k, 1)[0]
+
+
+parser = argparse.ArgumentParser(description='Hybrid BM25 and dense search')
+parser.add_argument("--index_name", type=str, default='Freebase',
+                    help="BM25 index in INDEX_MAP_DICT of DecAF/Retrieval/Pyserini/utils.py")
+parser.add_argument("--dense_index_name", type=str, default='Freebase_IVFPQ',
+                    help="FAISS index in INDEX_MAP_DICT of DecAF/Retrieval/Dense/utils.py")
+parser.add_argument("--query_data_path", type=str, default='/home/ubuntu/data/KBQA/WebQSP/data/WebQSP_processed.test.json',
+                    help="json or jsonl file of the queries, jsonl files are streamed")
+parser.add_argument("--output_dir", type=str, default='/home/ubuntu/data/KBQA/GeneralKB/Retrieval/hybrid/search_results',
+                    help="directory to store the retrieved output")
+parser.add_argument("--fusion", type=str, default="rrf", choices=["rrf", "weighted"])
+parser.add_argument("--rrf_k", type=int, default=60,
+                    help="rank offset of reciprocal rank fusion")
+parser.add_argument("--bm25_weight", type=float, default=1.0)
+parser.add_argument("--dense_weight", type=float, default=1.0)
+parser.add_argument("--candidate_k", type=int, default=150,
+                    help="number of passages retrieved by each searcher before fusion")
+parser.add_argument("--top_k", type=int, default=100,
+                    help="number of fused passages kept for each query")
+# BM25
+parser.add_argument("--b", type=float, default=0.4,
+                    help="parameter of BM25")
+parser.add_argument("--k1", type=float, default=0.9,
+                    help="parameter of BM25")
+parser.add_argument("--cache", type=str, default=None,
+                    help="sqlite file caching the BM25 results")
+parser.add_argument("--shard_candidate_k", type=int, default=None,
+                    help="number of candidates first fetched from each shard of a sharded BM25 index, a shard is searched deeper when needed, defaults to --candidate_k")
+# dense
+parser.add_argument("--query_encoder", type=str, default="facebook/dpr-question_encoder-single-nq-base",
+                    help="query encoder matching the passage encoder of the index")
+parser.add_argument("--nprobe", type=int, default=64,
+                    help="number of IVF lists visited per query")
+parser.add_argument("--ef_search", type=int, default=128,
+                    help="size of the HNSW search queue")
+parser.add_argument("--no_mmap", action="store_true",
+                    help="load the FAISS index into memory instead of memory-mapping it")
+parser.add_argument("--query_batch_size", type=int, default=64,
+                    help="number of queries encoded and sent to faiss at once")
+# shared
+parser.add_argument("--passage_store", type=str, default=PASSAGE_STORE_DIR,
+                    help="passage store directory from process_freebase --output_format zstd")
+parser.add_argument("--ignore_string", type=str, default="",
+                    help="string to ignore in the query, split by comma")
+parser.add_argument("--num_process", type=int, default=10,
+                    help="number of java threads of the BM25 batch search")
+parser.add_argument("--batch_size", type=int, default=1000,
+                    help="number of queries searched by both searchers at a time")
+parser.add_argument("--threads", type=int, default=None,
+                    help="number of faiss threads, defaults to all CPUs")
+parser.add_argument("--num_queries", type=int, default=1000,
+                    help="number of queries to test")
+parser.add_argument("--save", action="store_true",
+                    help="whether to save the output")
+parser.add_argument("--save_individual", action="store_true",
+                    help="also save the contexts of each searcher as ctxs_bm25 and ctxs_dense")
+parser.add_argument("--sort_output", action="store_true",
+                    help="order the saved jsonl output by QuestionId instead of completion order")
+parser.add_argument("--compact", action="store_true",
+                    help="save only the id and score of the contexts, see DecAF/Retrieval/passages.py")
+parser.add_argument("--eval", action="store_true",
+                    help="whether to evaluate the fused and the individual results")
+parser.add_argument("--eval_workers", type=int, default=1,
+                    help="number of processes matching the answers during evaluation")
+parser.add_argument("--eval_dedup", action="store_true",
+                    help="match every distinct passage of the split once against all answers, keeps the split in memory")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.index_name not in INDEX_MAP_DICT or args.dense_index_name not in DENSE_INDEX_MAP_DICT:
+        exit("no such index")
+    print("index dirs: ", INDEX_MAP_DICT[args.index_name], DENSE_INDEX_MAP_DICT[args.dense_index_name])
+    dense_searcher = DenseSearcher(DENSE_INDEX_MAP_DICT[args.dense_index_name], args)
+    # the BM25 batch search uses --num_process java threads
+    bm25_args = argparse.Namespace(**vars(args))
+    bm25_args.threads = args.num_process
+    bm25_searcher = load_bm25_searcher(INDEX_MAP_DICT[args.index_name], bm25_args)
+    searcher = HybridSearcher(bm25_searcher, dense_searcher, bm25_args)
+
+    # the individual contexts are evaluated, and only saved with --save_individual
+    run_search(searcher, bm25_args, ctxs_keys=["ctxs"] + INDIVIDUAL_KEYS, drop_keys=[] if args.save_individual else INDIVIDUAL_KEYS)
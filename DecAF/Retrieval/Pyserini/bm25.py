@@ -0,0 +1,84 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+Lucene BM25 scoring with collection statistics given from outside
+
+Used to score the candidates of a sharded index with the statistics of the
+whole collection. Follows BM25Similarity of Lucene 8/9:
+    score = sum_t boost_t * idf_t * (1 - 1 / (1 + tf * norm_inverse))
+    idf_t = log(1 + (doc_count - df_t + 0.5) / (df_t + 0.5))
+    norm_inverse = 1 / (k1 * (1 - b + b * length / avgdl))
+where boost_t is the number of times t occurs in the query and length is the
+document length after the 1 byte norm quantization. Like in Lucene, the term
+scores are single precision and summed in double precision.
+'''
+
+import math
+import numpy as np
+
+
+def _long_to_int4(i):
+    num_bits = i.bit_length()
+    if num_bits < 4:
+        return i
+    shift = num_bits - 4
+    return ((i >> shift) & 0x07) | ((shift + 1) << 3)
+
+
+def _int4_to_long(i):
+    bits = i & 0x07
+    shift = (i >> 3) - 1
+    if shift == -1:
+        return bits
+    return (bits | 0x08) << shift
+
+
+# SmallFloat.intToByte4 / byte4ToInt
+_NUM_FREE_VALUES = 255 - _long_to_int4(2 ** 31 - 1)
+
+
+def int_to_byte4(i):
+    if i < _NUM_FREE_VALUES:
+        return i
+    return _NUM_FREE_VALUES + _long_to_int4(i - _NUM_FREE_VALUES)
+
+
+def byte4_to_int(b):
+    if b < _NUM_FREE_VALUES:
+        return b
+    return _NUM_FREE_VALUES + _int4_to_long(b - _NUM_FREE_VALUES)
+
+
+LENGTH_TABLE = np.array([byte4_to_int(i) for i in range(256)], dtype=np.float32)
+
+
+def quantized_length(length):
+    # the document length as seen by the similarity after it was stored as a 1 byte norm
+    return LENGTH_TABLE[int_to_byte4(length)]
+
+
+class GlobalBm25:
+    def __init__(self, doc_count, total_terms, k1, b):
+        self.doc_count = doc_count
+        self.total_terms = total_terms
+        self.k1 = np.float32(k1)
+        self.b = np.float32(b)
+        self.avgdl = np.float32(total_terms / doc_count)
+        # norm_inverse of every possible norm byte
+        self.norm_inverse = (np.float32(1) / (self.k1 * ((np.float32(1) - self.b) + self.b * LENGTH_TABLE / self.avgdl))).astype(np.float32)
+
+    def idf(self, df):
+        return np.float32(math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5)))
+
+    def score(self, query_terms, idfs, doc_vector):
+        # query_terms: {term: boost}, idfs: {term: idf}, doc_vector: {term: tf} of the document
+        norm_inverse = self.norm_inverse[int_to_byte4(sum(doc_vector.values()))]
+        score = 0.0
+        for term, boost in query_terms.items():
+            tf = doc_vector.get(term, 0)
+            if tf == 0:
+                continue
+            weight = np.float32(boost) * idfs[term]
+            score += float(weight - weight / (np.float32(1) + np.float32(tf) * norm_inverse))
+        return float(np.float32(score))
@@ -0,0 +1,93 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+build the BM25 index as several Lucene indexes, one per shard of the documents
+
+    python DecAF/Retrieval/Pyserini/build_index_sharded.py --num_shards 8 --threads 32
+
+The document files are split into --num_shards groups of similar size, each
+group is indexed by its own pyserini process into {index_dir}/shard-{i}, and
+{index_dir}/shards.json lists the files of every shard. The shards are searched
+together by ShardedBm25Searcher in search.py, which rescores the candidates of
+every shard with the statistics of the whole collection.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from DecAF.Retrieval.Pyserini.utils import INDEX_DIR
+
+
+def split_files(document_dir, num_shards):
+    # largest files first, each to the currently smallest shard
+    file_list = sorted(file_name for file_name in os.listdir(document_dir) if file_name.endswith(".jsonl"))
+    file_list.sort(key=lambda file_name: os.path.getsize(os.path.join(document_dir, file_name)), reverse=True)
+    shards = [[] for _ in range(num_shards)]
+    sizes = [0] * num_shards
+    for file_name in file_list:
+        i = sizes.index(min(sizes))
+        shards[i].append(file_name)
+        sizes[i] += os.path.getsize(os.path.join(document_dir, file_name))
+    return [(sorted(files), size) for files, size in zip(shards, sizes) if len(files) > 0]
+
+
+def index_command(input_dir, shard_index_dir, threads):
+    return [sys.executable, "-m", "pyserini.index.lucene",
+            "--collection", "JsonCollection",
+            "--input", input_dir,
+            "--index", shard_index_dir,
+            "--generator", "DefaultLuceneDocumentGenerator",
+            "--threads", str(threads),
+            "--storePositions", "--storeDocvectors", "--storeRaw"]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build a sharded BM25 index')
+    parser.add_argument("--document_dir", type=str, default=f"{INDEX_DIR}/Freebase/processed/document")
+    parser.add_argument("--index_dir", type=str, default=f"{INDEX_DIR}/Freebase/processed/index/pyserini_bm25_sharded")
+    parser.add_argument("--num_shards", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=10,
+                        help="total number of indexing threads, split between the shards")
+    args = parser.parse_args()
+
+    shards = split_files(args.document_dir, args.num_shards)
+    threads = max(1, args.threads // len(shards))
+    os.makedirs(args.index_dir, exist_ok=True)
+    # the index is only picked up as sharded once every shard is built
+    shards_path = os.path.join(args.index_dir, "shards.json")
+    if os.path.exists(shards_path):
+        os.remove(shards_path)
+
+    start_time = time.time()
+    processes = []
+    for i, (files, size) in enumerate(shards):
+        # pyserini indexes a directory, the files of the shard are linked into one
+        input_dir = os.path.join(args.index_dir, "input", "shard-{}".format(i))
+        os.makedirs(input_dir, exist_ok=True)
+        for file_name in os.listdir(input_dir):
+            os.remove(os.path.join(input_dir, file_name))
+        for file_name in files:
+            os.symlink(os.path.abspath(os.path.join(args.document_dir, file_name)), os.path.join(input_dir, file_name))
+        shard_index_dir = os.path.join(args.index_dir, "shard-{}".format(i))
+        print("shard-{}: {} files, {:.2f} GB".format(i, len(files), size / 1e9))
+        log_file = open(os.path.join(args.index_dir, "shard-{}.log".format(i)), "w")
+        processes.append((subprocess.Popen(index_command(input_dir, shard_index_dir, threads),
+                                           stdout=log_file, stderr=subprocess.STDOUT), log_file))
+
+    failed = []
+    for i, (process, log_file) in enumerate(processes):
+        if process.wait() != 0:
+            failed.append(i)
+        log_file.close()
+    if len(failed) > 0:
+        exit("indexing failed for shards {}, see the shard-*.log files in {}".format(failed, args.index_dir))
+
+    with open(shards_path, "w") as wf:
+        json.dump({"document_dir": os.path.abspath(args.document_dir),
+                   "shards": [{"name": "shard-{}".format(i), "files": files} for i, (files, _) in enumerate(shards)]},
+                  wf, indent=2)
+    print("indexed {} shards in {:.1f}s".format(len(shards), time.time() - start_time))
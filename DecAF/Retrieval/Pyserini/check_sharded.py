@@ -0,0 +1,77 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+check that a sharded index returns the results of the single index
+
+    python check_sharded.py --index_name Freebase_sharded --single_index_name Freebase \
+        --query_data_path ${DATA_DIR}/tasks/QA/WebQSP/test.json --top_k 100
+
+Both indexes must be built from the same documents. The queries are searched
+in both, and a query differs when the docids or the ranks of its top-k are not
+the same or a score is off by more than --tolerance. Exits with status 1 when
+any query differs.
+'''
+
+import argparse
+from tqdm import tqdm
+from DecAF.Retrieval.Pyserini.utils import INDEX_MAP_DICT
+from DecAF.Retrieval.utils import iter_queries, iter_blocks
+from DecAF.Retrieval.Pyserini.search import load_bm25_searcher
+
+
+def compare_hits(sharded_hits, single_hits, tolerance):
+    # None if the hits agree, else the first differing rank
+    for rank, (sharded_hit, single_hit) in enumerate(zip(sharded_hits, single_hits)):
+        if sharded_hit.docid != single_hit.docid or abs(sharded_hit.score - single_hit.score) > tolerance * max(1.0, abs(single_hit.score)):
+            return rank
+    if len(sharded_hits) != len(single_hits):
+        return min(len(sharded_hits), len(single_hits))
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare a sharded index with the single index')
+    parser.add_argument("--index_name", type=str, default='Freebase_sharded')
+    parser.add_argument("--single_index_name", type=str, default='Freebase')
+    parser.add_argument("--query_data_path", type=str, required=True,
+                        help="json or jsonl file of the queries")
+    parser.add_argument("--num_queries", type=int, default=-1,
+                        help="number of queries to test")
+    parser.add_argument("--top_k", type=int, default=100)
+    parser.add_argument("--k1", type=float, default=0.9)
+    parser.add_argument("--b", type=float, default=0.4)
+    parser.add_argument("--shard_candidate_k", type=int, default=None,
+                        help="number of candidates first fetched from each shard, defaults to --top_k")
+    parser.add_argument("--threads", type=int, default=10,
+                        help="number of java threads of the batch search")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--tolerance", type=float, default=1e-5,
+                        help="relative difference allowed between the scores")
+    parser.add_argument("--ignore_string", type=str, default="",
+                        help="string to ignore in the query, split by comma")
+    args = parser.parse_args()
+    args.cache = None
+    args.passage_store = None
+
+    sharded = load_bm25_searcher(INDEX_MAP_DICT[args.index_name], args)
+    single = load_bm25_searcher(INDEX_MAP_DICT[args.single_index_name], args)
+    num_queries, differing = 0, []
+    for block in tqdm(iter_blocks(iter_queries(args.query_data_path, args.num_queries), args.batch_size)):
+        queries = [sharded.clean_query(data_i["Question"]) for data_i in block]
+        qids = [str(num_queries + i) for i in range(len(block))]
+        sharded_hits = sharded.batch_search_hits(queries, qids, args.top_k, args.threads)
+        single_hits = single.batch_search_hits(queries, qids, args.top_k, args.threads)
+        for data_i, qid in zip(block, qids):
+            rank = compare_hits(sharded_hits[qid], single_hits[qid], args.tolerance)
+            if rank is not None:
+                differing.append((data_i["QuestionId"], rank))
+        num_queries += len(block)
+
+    if hasattr(sharded, "num_deepened"):
+        print("shards searched deeper in {} rounds".format(sharded.num_deepened))
+    for question_id, rank in differing[:20]:
+        print("{}: differs from rank {}".format(question_id, rank))
+    print("{} of {} queries differ".format(len(differing), num_queries))
+    if len(differing) > 0:
+        exit(1)
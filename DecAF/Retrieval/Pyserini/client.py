@@ -0,0 +1,68 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+thin client of server.py, with the same perform_search / perform_batch_search
+interface as Bm25Searcher so it can be used in place of in-process search
+'''
+
+import json
+import urllib.error
+import urllib.request
+from DecAF.Retrieval.utils import get_ignore_list, clean_query
+
+
+class SearchClient:
+    def __init__(self, server_url, args):
+        self.server_url = server_url.rstrip("/")
+        self.args = args
+        self.ignore_list = get_ignore_list(args.ignore_string)
+        # results are cached by the server
+        self.cache = None
+        self.info = self.health()
+        print("server: ", self.info)
+        if (self.info["index_name"], self.info["k1"], self.info["b"]) != (args.index_name, args.k1, args.b):
+            raise ValueError("server {} serves index {} with k1={} b={}, requested {} with k1={} b={}".format(
+                self.server_url, self.info["index_name"], self.info["k1"], self.info["b"],
+                args.index_name, args.k1, args.b))
+
+    def _request(self, path, payload=None):
+        if payload is None:
+            request = urllib.request.Request(self.server_url + path)
+        else:
+            request = urllib.request.Request(self.server_url + path, data=json.dumps(payload).encode("utf-8"),
+                                             headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            # the server reports bad requests and failed searches as {"error": ...}
+            try:
+                message = json.loads(e.read())["error"]
+            except (ValueError, KeyError, TypeError):
+                message = e.reason
+            raise RuntimeError("server {} returned {}: {}".format(self.server_url, e.code, message)) from None
+
+    def health(self):
+        return self._request("/health")
+
+    def clean_query(self, query):
+        return clean_query(query, self.ignore_list)
+
+    def search_ctxs(self, queries, top_k):
+        return self._request("/search", {"queries": queries, "top_k": top_k})["ctxs"]
+
+    def perform_search(self, data_i, top_k):
+        output_i = data_i.copy()
+        output_i["ctxs"] = self.search_ctxs([self.clean_query(data_i["Question"])], top_k)[0]
+        return output_i
+
+    def perform_batch_search(self, data, top_k, threads=None):
+        # the server searches with its own number of java threads
+        ctxs_list = self.search_ctxs([self.clean_query(data_i["Question"]) for data_i in data], top_k)
+        output_data = []
+        for data_i, ctxs in zip(data, ctxs_list):
+            output_i = data_i.copy()
+            output_i["ctxs"] = ctxs
+            output_data.append(output_i)
+        return output_data
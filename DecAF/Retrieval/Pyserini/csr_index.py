@@ -0,0 +1,191 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+in-process BM25 over a SciPy CSR term-document matrix, without a JVM
+
+For dataset-specific sub-KBs and tests. The "contents" of the jsonl documents
+are indexed like pyserini's JsonCollection, and a batch of queries is scored by
+one sparse product of the query term boosts with the BM25 weight matrix, the
+top-k of every query is then picked with a partial sort (np.partition). The weights follow
+bm25.py (Lucene's BM25 with quantized document lengths), but the analyzer only
+lower-cases, splits on non-word characters and removes Lucene's English stop
+words, it does not stem, so the rankings are close to but not the same as
+those of a Lucene index.
+
+    python DecAF/Retrieval/Pyserini/csr_index.py --document_dir ${Freebase_sub}/processed/document --index_dir ${Freebase_sub}/processed/index/scipy_bm25
+
+The whole matrix is held in memory, it is meant for collections of up to a few
+million passages, not for the full Freebase.
+
+The index directory holds
+    csr_index.json      number of documents and terms, total terms and document files
+    tf.npz              (num_terms, num_documents) term frequencies
+    vocab.json          terms in row order
+    docids.json         document ids in column order
+    doc_locations.npy   (file number, byte offset) of every document in the jsonl files
+'''
+
+import os
+import json
+import mmap
+import argparse
+from array import array
+from collections import Counter
+import numpy as np
+import regex as re
+import scipy.sparse as sp
+from tqdm import tqdm
+from DecAF.Retrieval.Pyserini.bm25 import LENGTH_TABLE
+
+# stop words of Lucene's EnglishAnalyzer
+STOP_WORDS = frozenset(["a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in", "into", "is", "it",
+                        "no", "not", "of", "on", "or", "such", "that", "the", "their", "then", "there", "these",
+                        "they", "this", "to", "was", "will", "with"])
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def analyze(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def is_csr_index(index_dir):
+    return os.path.exists(os.path.join(index_dir, "csr_index.json"))
+
+
+def build_index(document_dir, index_dir):
+    file_list = sorted(file_name for file_name in os.listdir(document_dir) if file_name.endswith(".jsonl"))
+    vocab = {}
+    docids = []
+    # postings of every file are packed into typed arrays, then kept as numpy chunks
+    indices_chunks, counts_chunks = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int32)]
+    doc_sizes_chunks, locations_chunks = [np.zeros(0, dtype=np.int64)], [np.zeros((0, 2), dtype=np.int64)]
+    for file_number, file_name in enumerate(tqdm(file_list)):
+        indices, counts, doc_sizes, offsets = array("i"), array("i"), array("q"), array("q")
+        with open(os.path.join(document_dir, file_name), "rb") as rf:
+            offset = 0
+            for line in rf:
+                doc = json.loads(line)
+                tf = Counter(analyze(doc["contents"]))
+                docids.append(doc["id"])
+                offsets.append(offset)
+                indices.extend(vocab.setdefault(term, len(vocab)) for term in tf)
+                counts.extend(tf.values())
+                doc_sizes.append(len(tf))
+                offset += len(line)
+        indices_chunks.append(np.array(indices, dtype=np.int32))
+        counts_chunks.append(np.array(counts, dtype=np.int32))
+        doc_sizes_chunks.append(np.array(doc_sizes, dtype=np.int64))
+        locations_chunks.append(np.stack([np.full(len(offsets), file_number, dtype=np.int64), np.array(offsets, dtype=np.int64)], axis=1))
+    indptr = np.zeros(len(docids) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(doc_sizes_chunks), out=indptr[1:])
+    locations = np.concatenate(locations_chunks)
+    # built by document, stored by term so that the rows of the query terms are contiguous
+    tf = sp.csr_matrix((np.concatenate(counts_chunks), np.concatenate(indices_chunks), indptr),
+                       shape=(len(docids), len(vocab))).T.tocsr()
+    del indices_chunks, counts_chunks
+    tf.sort_indices()
+    os.makedirs(index_dir, exist_ok=True)
+    sp.save_npz(os.path.join(index_dir, "tf.npz"), tf)
+    with open(os.path.join(index_dir, "vocab.json"), "w") as wf:
+        json.dump(sorted(vocab, key=vocab.get), wf)
+    with open(os.path.join(index_dir, "docids.json"), "w") as wf:
+        json.dump(docids, wf)
+    np.save(os.path.join(index_dir, "doc_locations.npy"), locations)
+    meta = {"num_documents": len(docids),
+            "num_terms": len(vocab),
+            "total_terms": int(tf.sum()),
+            "document_dir": os.path.abspath(document_dir),
+            "document_files": file_list}
+    with open(os.path.join(index_dir, "csr_index.json"), "w") as wf:
+        json.dump(meta, wf, indent=2)
+    return meta
+
+
+class CsrBm25Index:
+    # picklable, the document files are mapped again in every process that reads raw documents
+    def __init__(self, index_dir, k1=0.9, b=0.4):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "csr_index.json"), "r") as rf:
+            self.meta = json.load(rf)
+        self.tf = sp.load_npz(os.path.join(index_dir, "tf.npz")).tocsr()
+        with open(os.path.join(index_dir, "vocab.json"), "r") as rf:
+            self.vocab = {term: i for i, term in enumerate(json.load(rf))}
+        with open(os.path.join(index_dir, "docids.json"), "r") as rf:
+            self.docids = json.load(rf)
+        self.locations = np.load(os.path.join(index_dir, "doc_locations.npy"))
+        # rank of every docid in string order, ties are broken by docid like in Anserini
+        self.docid_rank = np.empty(len(self.docids), dtype=np.int64)
+        self.docid_rank[np.argsort(np.array(self.docids, dtype=object))] = np.arange(len(self.docids))
+        doc_lengths = np.asarray(self.tf.sum(axis=0)).ravel()
+        # int_to_byte4 rounds down to a value of LENGTH_TABLE
+        self.norm_bytes = (np.searchsorted(LENGTH_TABLE, doc_lengths, side="right") - 1).astype(np.uint8)
+        df = np.diff(self.tf.indptr)
+        self.doc_count = int(np.count_nonzero(doc_lengths))
+        self.idf = np.log(1 + (self.doc_count - df + 0.5) / (df + 0.5)).astype(np.float32)
+        self._files = None
+        self.set_bm25(k1, b)
+
+    def set_bm25(self, k1, b):
+        # weight of every (term, document): idf * (1 - 1 / (1 + tf * norm_inverse)), see bm25.py
+        k1, b = np.float32(k1), np.float32(b)
+        avgdl = np.float32(self.meta["total_terms"] / max(self.doc_count, 1))
+        norm_inverse = (np.float32(1) / (k1 * ((np.float32(1) - b) + b * LENGTH_TABLE / avgdl))).astype(np.float32)
+        doc_norm_inverse = norm_inverse[self.norm_bytes[self.tf.indices]]
+        term_idf = np.repeat(self.idf, np.diff(self.tf.indptr))
+        weights = term_idf - term_idf / (np.float32(1) + self.tf.data.astype(np.float32) * doc_norm_inverse)
+        self.weights = sp.csr_matrix((weights.astype(np.float32), self.tf.indices, self.tf.indptr), shape=self.tf.shape)
+
+    def query_matrix(self, queries):
+        # (num_queries, num_terms) boosts, a term repeated in the query is weighted by its count
+        rows, cols, boosts = [], [], []
+        for i, query in enumerate(queries):
+            for term, count in Counter(analyze(query)).items():
+                if term in self.vocab:
+                    rows.append(i)
+                    cols.append(self.vocab[term])
+                    boosts.append(count)
+        return sp.csr_matrix((np.array(boosts, dtype=np.float32), (rows, cols)), shape=(len(queries), len(self.vocab)))
+
+    def search(self, queries, k):
+        # [(document numbers, scores)] of every query, best first
+        scores = (self.query_matrix(queries) @ self.weights).tocsr()
+        results = []
+        for i in range(len(queries)):
+            row = slice(scores.indptr[i], scores.indptr[i + 1])
+            docs, row_scores = scores.indices[row], scores.data[row]
+            if len(docs) > k:
+                # every document scoring at least the k-th score, so that ties are broken by docid
+                kth = np.partition(row_scores, len(row_scores) - k)[len(row_scores) - k]
+                keep = row_scores >= kth
+                docs, row_scores = docs[keep], row_scores[keep]
+            order = np.lexsort((self.docid_rank[docs], -row_scores))[:k]
+            results.append((docs[order], row_scores[order]))
+        return results
+
+    def raw(self, doc):
+        if self._files is None:
+            self._files = []
+            for file_name in self.meta["document_files"]:
+                with open(os.path.join(self.meta["document_dir"], file_name), "rb") as rf:
+                    self._files.append(mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(rf.name) > 0 else b"")
+        file_number, offset = self.locations[doc]
+        data = self._files[file_number]
+        end = data.find(b"\n", offset)
+        return data[offset:end if end >= 0 else len(data)].decode("utf-8")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = None
+        return state
+
+
+if __name__ == '__main__':
+    from DecAF.Retrieval.Pyserini.utils import INDEX_DIR
+    parser = argparse.ArgumentParser(description='build a SciPy BM25 index')
+    parser.add_argument("--document_dir", type=str, default=f"{INDEX_DIR}/Freebase_sub/processed/document",
+                        help="jsonl documents of a sub-KB")
+    parser.add_argument("--index_dir", type=str, default=f"{INDEX_DIR}/Freebase_sub/processed/index/scipy_bm25")
+    args = parser.parse_args()
+    meta = build_index(args.document_dir, args.index_dir)
+    print("indexed {} documents, {} terms".format(meta["num_documents"], meta["num_terms"]))
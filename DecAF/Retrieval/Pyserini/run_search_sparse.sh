@@ -41,6 +41,9 @@ python search.py \
     --k1 0.4 \
     --b 0.4 \
     --num_process 10 \
+    --batch_size 1000 \
     --num_queries -1 \
     --eval \
-    --save
+    --save \
+    --sort_output \
+    --cache ${SAVE_DIR}/Retrieval/pyserini/search_cache.sqlite
@@ -1,71 +1,296 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.  
 # SPDX-License-Identifier: CC-BY-NC-4.0
 
-from pyserini.search.lucene import LuceneSearcher
 import json
-from tqdm import tqdm
 import os
 import argparse
-from DecAF.Retrieval.utils import eval_top_k
+from DecAF.Retrieval.utils import get_ignore_list, clean_query, run_search
 from DecAF.Retrieval.Pyserini.utils import INDEX_MAP_DICT
-import multiprocessing.pool
-from functools import partial
-
+from DecAF.Retrieval.Pyserini.client import SearchClient
+from DecAF.Retrieval.cache import ResultCache, index_fingerprint
+from DecAF.Retrieval.Pyserini.bm25 import GlobalBm25
+from DecAF.Retrieval.Pyserini.csr_index import CsrBm25Index, is_csr_index
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 def print_results(hits):
     for i in range(len(hits)):
         print(f'{i+1:2} {hits[i].docid:4} {hits[i].score:.5f} {hits[i].raw}')
 
 class Bm25Searcher:
+    # lucene returns the stored raw field with every hit, so it is read by the search, not by hydrate,
+    # unless the passages come from a passage store
+    raw_read_in_search = True
+
     def __init__(self, index_dir, args):
         self.index_dir = index_dir
         self.args = args
+        self.open_index(index_dir, args)
+        self.ignore_list = get_ignore_list(args.ignore_string)
+        # read passages from the zstd passage store instead of the raw field of the index
+        if args.passage_store is not None:
+            # imported here, the passage store needs zstandard
+            from DecAF.Knowledge.passage_store import PassageStore
+            self.passage_store = PassageStore(args.passage_store)
+        else:
+            self.passage_store = None
+        # results of earlier runs with the same index and BM25 parameters
+        if args.cache is not None:
+            self.cache = ResultCache(args.cache, index_fingerprint(index_dir), args.k1, args.b)
+        else:
+            self.cache = None
+    
+    def open_index(self, index_dir, args):
+        # imported here so that the search client does not start a JVM
+        from pyserini.search.lucene import LuceneSearcher
         try:
             self.searcher = LuceneSearcher(index_dir)
         except:
             print("index dir not found")
             self.searcher = LuceneSearcher.from_prebuilt_index(index_dir)
         self.searcher.set_bm25(args.k1, args.b)
-        if len(args.ignore_string) > 0:
-            self.ignore_list = args.ignore_string.split(',')
-            print(f'ignore list: {self.ignore_list}')
-        else:
-            self.ignore_list = []
-    
-    def perform_search(self, data_i, top_k):
-        
-        query = data_i["Question"]
-        for string in self.ignore_list:
-            query = query.replace(string, ' ')
-        query = query.strip()
-        results = self.searcher.search(query, k=top_k)
 
+    def set_bm25(self, k1, b):
+        # parameters of the following searches, e.g. for a sweep over one open index
+        self.set_index_bm25(k1, b)
+        # the cached results are keyed by k1 and b
+        if self.cache is not None:
+            self.cache.k1, self.cache.b = k1, b
+
+    def set_index_bm25(self, k1, b):
+        # the backend part of set_bm25, overridden by the other backends
+        self.searcher.set_bm25(k1, b)
+
+    def search_hits(self, query, top_k):
+        return self.searcher.search(query, k=top_k)
+
+    def batch_search_hits(self, queries, qids, top_k, threads):
+        return self.searcher.batch_search(queries, qids, k=top_k, threads=threads)
+
+    def clean_query(self, query):
+        return clean_query(query, self.ignore_list)
+
+    def hydrate(self, results):
         ctxs = []
         for result in results:
-            doc_dict = json.loads(result.raw)
+            if self.passage_store is not None:
+                doc_dict = self.passage_store[result.docid]
+            else:
+                doc_dict = json.loads(result.raw)
             ctx_text = doc_dict["contents"]
-            ctx = {"title": doc_dict["title"], "text": ctx_text, "score": result.score}
+            ctx = {"id": result.docid, "title": doc_dict["title"], "text": ctx_text, "score": result.score}
             ctxs.append(ctx)
+        return ctxs
+
+    def search_ctxs(self, query, top_k):
+        if self.cache is not None:
+            ctxs = self.cache.get(query, top_k)
+            if ctxs is not None:
+                return ctxs
+        ctxs = self.hydrate(self.search_hits(query, top_k))
+        if self.cache is not None:
+            self.cache.put(query, top_k, ctxs)
+        return ctxs
 
+    def perform_search(self, data_i, top_k):
         output_i = data_i.copy()
-        output_i["ctxs"] = ctxs
+        output_i["ctxs"] = self.search_ctxs(self.clean_query(data_i["Question"]), top_k)
         return output_i
 
-def search_all(process_idx, num_process, searcher, args):
+    def perform_batch_search(self, data, top_k, threads):
+        # one call for a block of queries, the queries are searched by java threads inside the JVM
+        queries = [self.clean_query(data_i["Question"]) for data_i in data]
+        if self.cache is not None:
+            ctxs_list = [self.cache.get(query, top_k) for query in queries]
+        else:
+            ctxs_list = [None] * len(queries)
+        missing = [i for i, ctxs in enumerate(ctxs_list) if ctxs is None]
+        if len(missing) > 0:
+            qids = [str(i) for i in missing]
+            results = self.batch_search_hits([queries[i] for i in missing], qids, top_k, threads)
+            for i, qid in zip(missing, qids):
+                ctxs_list[i] = self.hydrate(results[qid])
+            if self.cache is not None:
+                self.cache.put_many([(queries[i], top_k, ctxs_list[i]) for i in missing])
+        output_data = []
+        for data_i, ctxs in zip(data, ctxs_list):
+            output_i = data_i.copy()
+            output_i["ctxs"] = ctxs
+            output_data.append(output_i)
+        return output_data
+
+
+class ShardHit:
+    __slots__ = ("docid", "score", "raw")
+
+    def __init__(self, docid, score, raw):
+        self.docid = docid
+        self.score = score
+        self.raw = raw
+
+
+class CsrHit:
+    # the raw document is read from the document files when hydrate asks for it
+    __slots__ = ("docid", "score", "index", "doc")
 
-    with open(args.query_data_path, 'r') as rf:
-        data = json.load(rf)
+    def __init__(self, docid, score, index, doc):
+        self.docid = docid
+        self.score = score
+        self.index = index
+        self.doc = doc
 
-    output_data = []
-    for i, data_i in tqdm(enumerate(data)):
-        if i % num_process != process_idx:
-            continue
-        if i > args.num_queries and args.num_queries != -1:
-            break
+    @property
+    def raw(self):
+        return self.index.raw(self.doc)
 
-        output_i = searcher.perform_search(data_i, args.top_k)
-        output_data.append(output_i)
-    return output_data
+
+def get_shard_dirs(index_dir):
+    # a sharded index is a directory of lucene indexes listed in shards.json, see build_index_sharded.py
+    shards_path = os.path.join(index_dir, "shards.json")
+    if not os.path.exists(shards_path):
+        return None
+    with open(shards_path, "r") as rf:
+        return [os.path.join(index_dir, shard["name"]) for shard in json.load(rf)["shards"]]
+
+
+class ShardedBm25Searcher(Bm25Searcher):
+    # every shard is searched with its own statistics for candidates, which are then
+    # rescored with the document count, average length and document frequencies of the
+    # whole collection. A shard is searched deeper until none of its unseen documents can
+    # score above the k-th global score, so the results are those of the unsharded index.
+    def open_index(self, index_dir, args):
+        from pyserini.search.lucene import LuceneSearcher
+        from pyserini.index.lucene import IndexReader
+        from pyserini.analysis import Analyzer, get_lucene_analyzer
+        self.shard_dirs = get_shard_dirs(index_dir)
+        print("number of shards: ", len(self.shard_dirs))
+        self.shards = [LuceneSearcher(shard_dir) for shard_dir in self.shard_dirs]
+        for shard in self.shards:
+            shard.set_bm25(args.k1, args.b)
+        self.readers = [IndexReader(shard_dir) for shard_dir in self.shard_dirs]
+        self.analyzer = Analyzer(get_lucene_analyzer())
+        stats = [reader.stats() for reader in self.readers]
+        self.bm25 = GlobalBm25(sum(stat["non_empty_documents"] for stat in stats),
+                               sum(stat["total_terms"] for stat in stats), args.k1, args.b)
+        # statistics each shard scores with, only their idf and avgdl are used
+        self.shard_bm25 = [GlobalBm25(stat["non_empty_documents"], stat["total_terms"], args.k1, args.b) for stat in stats]
+        self.df_cache = {}
+        self.candidate_k = args.shard_candidate_k
+        self.num_deepened = 0
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    def set_index_bm25(self, k1, b):
+        for shard in self.shards:
+            shard.set_bm25(k1, b)
+        # the document frequencies do not depend on k1 and b, the df cache is kept
+        self.bm25 = GlobalBm25(self.bm25.doc_count, self.bm25.total_terms, k1, b)
+
+    def shard_dfs(self, term):
+        dfs = self.df_cache.get(term)
+        if dfs is None:
+            dfs = [reader.get_term_counts(term, analyzer=None)[0] for reader in self.readers]
+            self.df_cache[term] = dfs
+        return dfs
+
+    def query_weights(self, query):
+        # term boosts, global idfs and the score bound of every shard of a query, computed on the
+        # calling thread which owns the df cache
+        query_terms = Counter(self.analyzer.analyze(query))
+        dfs = {term: self.shard_dfs(term) for term in query_terms}
+        idfs = {term: self.bm25.idf(sum(dfs[term])) for term in query_terms}
+        return query_terms, idfs, [self.score_bound(shard_id, idfs, dfs) for shard_id in range(len(self.shards))]
+
+    def score_bound(self, shard_id, idfs, dfs):
+        # c such that global score <= c * shard score for every document of the shard:
+        # per term, the global idf is idf_ratio times the shard's, and the tf part
+        # tf * n / (1 + tf * n) grows at most by the ratio of the norms n, which is at
+        # most avgdl_global / avgdl_shard (both use the same quantized document length)
+        shard_bm25 = self.shard_bm25[shard_id]
+        idf_ratio = max([idfs[term] / shard_bm25.idf(term_dfs[shard_id])
+                         for term, term_dfs in dfs.items() if term_dfs[shard_id] > 0], default=0.0)
+        norm_ratio = max(1.0, float(self.bm25.avgdl) / float(shard_bm25.avgdl))
+        # margin for the single precision scores of lucene and bm25.py
+        return float(idf_ratio) * norm_ratio * (1 + 1e-4)
+
+    def search_shard(self, shard_id, queries, qids, weights, depth, num_seen, threads):
+        # lucene candidates of one shard rescored with the global statistics, runs in the executor
+        # so that the term vectors of the shards are read concurrently. The first num_seen[qid]
+        # candidates were rescored by a shallower search before.
+        reader = self.readers[shard_id]
+        results = self.shards[shard_id].batch_search(queries, qids, k=depth, threads=threads)
+        rescored = {}
+        for qid in qids:
+            query_terms, idfs, _ = weights[qid]
+            candidates = results[qid]
+            new_hits = [ShardHit(hit.docid, self.bm25.score(query_terms, idfs, reader.get_document_vector(hit.docid)), hit.raw)
+                        for hit in candidates[num_seen.get(qid, 0):]]
+            # lowest shard score seen, None once the shard has no more matching documents
+            last_score = candidates[-1].score if len(candidates) == depth else None
+            rescored[qid] = (new_hits, last_score)
+        return rescored
+
+    def search_hits(self, query, top_k):
+        return self.batch_search_hits([query], ["0"], top_k, 1)["0"]
+
+    def batch_search_hits(self, queries, qids, top_k, threads):
+        weights = {qid: self.query_weights(query) for query, qid in zip(queries, qids)}
+        query_of = dict(zip(qids, queries))
+        hits = {qid: [] for qid in qids}
+        # qids every shard still has to search, how many candidates were rescored and the lowest shard score
+        pending = [list(qids) for _ in self.shards]
+        num_seen = [{} for _ in self.shards]
+        last_scores = [{} for _ in self.shards]
+        depth = max(top_k, self.candidate_k or 0)
+        while any(len(shard_qids) > 0 for shard_qids in pending):
+            futures = {shard_id: self.executor.submit(self.search_shard, shard_id, [query_of[qid] for qid in shard_qids],
+                                                      shard_qids, weights, depth, num_seen[shard_id], threads)
+                       for shard_id, shard_qids in enumerate(pending) if len(shard_qids) > 0}
+            for shard_id, future in futures.items():
+                for qid, (new_hits, last_score) in future.result().items():
+                    hits[qid].extend(new_hits)
+                    num_seen[shard_id][qid] = num_seen[shard_id].get(qid, 0) + len(new_hits)
+                    last_scores[shard_id][qid] = last_score
+            for qid in qids:
+                # ties are broken by docid like in Anserini
+                hits[qid].sort(key=lambda hit: (-hit.score, hit.docid))
+            # an unseen document of a shard scores at most bound * its shard score <= bound * last_score
+            kth_scores = {qid: hits[qid][top_k - 1].score if len(hits[qid]) >= top_k else None for qid in qids}
+            pending = [[qid for qid in pending[shard_id]
+                        if last_scores[shard_id][qid] is not None
+                        and (kth_scores[qid] is None or kth_scores[qid] <= weights[qid][2][shard_id] * last_scores[shard_id][qid])]
+                       for shard_id in range(len(self.shards))]
+            if any(len(shard_qids) > 0 for shard_qids in pending):
+                self.num_deepened += 1
+            depth *= 2
+        return {qid: hits[qid][:top_k] for qid in qids}
+
+
+class CsrBm25Searcher(Bm25Searcher):
+    # BM25 with SciPy over an index built by csr_index.py, no JVM
+    raw_read_in_search = False
+
+    def open_index(self, index_dir, args):
+        self.index = CsrBm25Index(index_dir, args.k1, args.b)
+
+    def set_index_bm25(self, k1, b):
+        self.index.set_bm25(k1, b)
+
+    def search_hits(self, query, top_k):
+        return self.batch_search_hits([query], ["0"], top_k, 1)["0"]
+
+    def batch_search_hits(self, queries, qids, top_k, threads):
+        results = self.index.search(queries, top_k)
+        return {qid: [CsrHit(self.index.docids[doc], float(score), self.index, doc) for doc, score in zip(*result)]
+                for qid, result in zip(qids, results)}
+
+
+def load_bm25_searcher(index_dir, args):
+    # the index layout decides the backend: sharded lucene, SciPy or a single lucene index
+    if os.path.isdir(index_dir) and get_shard_dirs(index_dir) is not None:
+        return ShardedBm25Searcher(index_dir, args)
+    if os.path.isdir(index_dir) and is_csr_index(index_dir):
+        return CsrBm25Searcher(index_dir, args)
+    return Bm25Searcher(index_dir, args)
 
 
 # argparse for root_dir, index_dir, query_data_path, output_dir
@@ -73,11 +298,15 @@ parser = argparse.ArgumentParser(description='Search using pySerini')
 parser.add_argument("--index_name", type=str, default='Wikidata',
                     help="directory to store the search index")
 parser.add_argument("--query_data_path", type=str, default='/home/ubuntu/data/KBQA/WebQSP/data/WebQSP_processed.test.json',
-                    help="directory to store the queries")
+                    help="json or jsonl file of the queries, jsonl files are streamed")
 parser.add_argument("--output_dir", type=str, default='/home/ubuntu/data/KBQA/GeneralKB/Retrieval/pyserini/search_results',
                     help="directory to store the retrieved output")
 parser.add_argument("--num_process", type=int, default=10,
                     help="number of processes to use for multi-threading")
+parser.add_argument("--batch_size", type=int, default=0,
+                    help="number of queries sent to Lucene batch search at once, 0 searches one query per python thread")
+parser.add_argument("--threads", type=int, default=None,
+                    help="number of java threads of the batch search, defaults to --num_process")
 parser.add_argument("--top_k", type=int, default=150,
                     help="number of passages to be retrieved for each query")
 parser.add_argument("--ignore_string", type=str, default="",
@@ -86,51 +315,40 @@ parser.add_argument("--b", type=float, default=0.4,
                     help="parameter of BM25")
 parser.add_argument("--k1", type=float, default=0.9,
                     help="parameter of BM25")
+parser.add_argument("--shard_candidate_k", type=int, default=None,
+                    help="number of candidates first fetched from each shard of a sharded index, a shard is searched deeper when needed, defaults to --top_k")
+parser.add_argument("--passage_store", type=str, default=None,
+                    help="passage store directory from process_freebase --output_format zstd")
+parser.add_argument("--cache", type=str, default=None,
+                    help="sqlite file caching the results by index, query and BM25 parameters")
+parser.add_argument("--server_url", type=str, default=None,
+                    help="search through a running server.py instead of opening the index, e.g. http://127.0.0.1:8765")
 parser.add_argument("--num_queries", type=int, default=1000,
                     help="number of queries to test")
 parser.add_argument("--save", action="store_true",
                     help="whether to save the output")
+parser.add_argument("--sort_output", action="store_true",
+                    help="order the saved jsonl output by QuestionId instead of completion order")
+parser.add_argument("--compact", action="store_true",
+                    help="save only the id and score of the contexts, see DecAF/Retrieval/passages.py")
 parser.add_argument("--eval", action="store_true",
                     help="whether to evaluate the output")
-args = parser.parse_args()
+parser.add_argument("--eval_workers", type=int, default=1,
+                    help="number of processes matching the answers during evaluation")
+parser.add_argument("--eval_dedup", action="store_true",
+                    help="match every distinct passage of the split once against all answers, keeps the split in memory")
 
 
 if __name__ == '__main__':
-    if args.index_name in INDEX_MAP_DICT:
-        index_dir = INDEX_MAP_DICT[args.index_name]
+    args = parser.parse_args()
+    if args.server_url is not None:
+        searcher = SearchClient(args.server_url, args)
     else:
-        exit("no such index")
-    print("index dir: ", index_dir)
-    searcher = Bm25Searcher(index_dir, args)
-
-    num_process = args.num_process
-    pool = multiprocessing.pool.ThreadPool(processes=num_process)
-    sampleData = [x for x in range(num_process)]
-    search_all_part = partial(search_all, 
-                                searcher = searcher,
-                                num_process = num_process,
-                                args = args)
-    results = pool.map(search_all_part, sampleData)
-    pool.close()
-
-    output_data = []
-    for result in results:
-        output_data += result
-
-    # sort the output data by question id
-    output_data = sorted(output_data, key=lambda item: item['QuestionId'])
-    tokenizer = None
-    if args.eval:
-        eval_top_k(output_data, top_k_list=[5, 10, 20, 100], tokenizer=tokenizer)
-
-    # save output data
-    # create output dir recursively if not exist
-    if args.save:
-        os.makedirs(args.output_dir, exist_ok=True)
-        output_name = args.query_data_path.split('/')[-1]
-        output_name_split = output_name.split('.')
-        output_name = '.'.join(output_name_split[-2:])
-        output_path = os.path.join(args.output_dir, output_name)
-        print("saving output data to {}".format(output_path))
-        with open(output_path, "w") as wf:
-            json.dump(output_data, wf, indent=2)
+        if args.index_name in INDEX_MAP_DICT:
+            index_dir = INDEX_MAP_DICT[args.index_name]
+        else:
+            exit("no such index")
+        print("index dir: ", index_dir)
+        searcher = load_bm25_searcher(index_dir, args)
+
+    run_search(searcher, args)
@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+long-running BM25 search server on localhost
+
+The JVM is started and the index opened once, then batches of queries are
+answered over HTTP:
+    GET  /health    index name and BM25 parameters
+    POST /search    {"queries": [...], "top_k": 100} -> {"ctxs": [[...], ...]}
+The queries are expected to be cleaned by the client (see client.py).
+
+    python server.py --index_name Freebase --k1 0.4 --b 0.4 --port 8765 &
+    python search.py --server_url http://127.0.0.1:8765 --index_name Freebase --k1 0.4 --b 0.4 ...
+'''
+
+import os
+import json
+import time
+import argparse
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from DecAF.Retrieval.Pyserini.utils import INDEX_MAP_DICT
+from DecAF.Retrieval.Pyserini.search import load_bm25_searcher
+
+
+def preload_index(index_dir, block_size=1 << 24):
+    # read every index file once so that the first queries do not wait on the disk
+    if not os.path.isdir(index_dir):
+        return
+    start_time = time.time()
+    num_bytes = 0
+    for root, _, file_names in os.walk(index_dir):
+        for file_name in file_names:
+            with open(os.path.join(root, file_name), "rb", buffering=0) as rf:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(rf.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                while True:
+                    block = rf.read(block_size)
+                    if not block:
+                        break
+                    num_bytes += len(block)
+    print("preloaded {:.2f} GB of index files in {:.1f}s".format(num_bytes / 1e9, time.time() - start_time))
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    searcher = None
+    info = None
+    threads = 1
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, self.info)
+        else:
+            self._send(404, {"error": "unknown path " + self.path})
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send(404, {"error": "unknown path " + self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            queries, top_k = request["queries"], int(request["top_k"])
+        except (KeyError, TypeError, ValueError) as e:
+            self._send(400, {"error": "bad request: {}".format(e)})
+            return
+        try:
+            output_data = self.searcher.perform_batch_search([{"Question": query} for query in queries], top_k, self.threads)
+        except Exception as e:
+            # the server keeps running, the client gets the error instead of a dropped connection
+            traceback.print_exc()
+            self._send(500, {"error": "search failed: {!r}".format(e)})
+            return
+        self._send(200, {"ctxs": [output_i["ctxs"] for output_i in output_data]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BM25 search server')
+    parser.add_argument("--index_name", type=str, default='Freebase')
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--threads", type=int, default=10,
+                        help="number of java threads of each batch search")
+    parser.add_argument("--b", type=float, default=0.4,
+                        help="parameter of BM25")
+    parser.add_argument("--k1", type=float, default=0.9,
+                        help="parameter of BM25")
+    parser.add_argument("--shard_candidate_k", type=int, default=None,
+                        help="number of candidates first fetched from each shard of a sharded index, a shard is searched deeper when needed, defaults to top_k")
+    parser.add_argument("--passage_store", type=str, default=None,
+                        help="passage store directory from process_freebase --output_format zstd")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="sqlite file caching the results by index, query and BM25 parameters")
+    parser.add_argument("--no_preload", action="store_true",
+                        help="do not read the index files into the page cache at startup")
+    args = parser.parse_args()
+    # the client strips the ignore strings
+    args.ignore_string = ""
+
+    if args.index_name in INDEX_MAP_DICT:
+        index_dir = INDEX_MAP_DICT[args.index_name]
+    else:
+        exit("no such index")
+    print("index dir: ", index_dir)
+    if not args.no_preload:
+        preload_index(index_dir)
+    SearchHandler.searcher = load_bm25_searcher(index_dir, args)
+    SearchHandler.info = {"index_name": args.index_name, "index_dir": index_dir, "k1": args.k1, "b": args.b}
+    SearchHandler.threads = args.threads
+
+    server = ThreadingHTTPServer((args.host, args.port), SearchHandler)
+    print("serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if SearchHandler.searcher.cache is not None:
+        SearchHandler.searcher.cache.report()
@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+sweep of the BM25 parameters over one open index
+
+    python sweep.py --index_name Freebase --query_data_path ${DATA_DIR}/tasks/QA/WebQSP/dev.json \
+        --k1_list 0.4 0.6 0.9 1.2 --b_list 0.2 0.4 0.75 --output_path ${SAVE_DIR}/Retrieval/pyserini/sweep_WebQSP.tsv
+
+The JVM is started, the index opened and the queries read once. The query set
+is searched for every (k1, b) of the grid with set_bm25 in between, and each
+setting is evaluated in a worker process while the next one is searched. The
+Hits and Recall of all settings are printed as one table and saved as tsv.
+
+A grid of N settings still costs about N full search passes over the queries,
+BM25 scores depend on k1 and b so no candidates are shared between settings;
+what is saved is the JVM start, the index opening and the query reading of N
+separate runs, and the evaluation time, which overlaps the next search. Use
+--num_queries to screen a large grid on a sample first.
+'''
+
+import os
+import time
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from DecAF.Retrieval.utils import eval_top_k, iter_queries, search_queries
+from DecAF.Retrieval.Pyserini.utils import INDEX_MAP_DICT
+from DecAF.Retrieval.Pyserini.search import load_bm25_searcher
+
+
+def evaluate_setting(data, top_k_list, dedup):
+    return eval_top_k(data, top_k_list=top_k_list, tokenizer=None, dedup=dedup, verbose=False)["ctxs"]
+
+
+def format_table(rows, top_k_list):
+    header = ["k1", "b"] + ["Hits@{}".format(k) for k in top_k_list] + ["Recall@{}".format(k) for k in top_k_list]
+    lines = [header]
+    for k1, b, results in rows:
+        lines.append(["{:g}".format(k1), "{:g}".format(b)]
+                     + ["{:.1f}".format(results[k][0]) if k in results else "-" for k in top_k_list]
+                     + ["{:.1f}".format(results[k][1]) if k in results else "-" for k in top_k_list])
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BM25 parameter sweep')
+    parser.add_argument("--index_name", type=str, default='Freebase')
+    parser.add_argument("--query_data_path", type=str, required=True,
+                        help="json or jsonl file of the queries")
+    parser.add_argument("--k1_list", type=float, nargs="+", default=[0.4, 0.6, 0.9, 1.2])
+    parser.add_argument("--b_list", type=float, nargs="+", default=[0.2, 0.4, 0.75])
+    parser.add_argument("--top_k", type=int, default=100,
+                        help="number of passages retrieved for each query")
+    parser.add_argument("--top_k_list", type=int, nargs="+", default=[5, 10, 20, 100])
+    parser.add_argument("--num_queries", type=int, default=-1,
+                        help="number of queries to test")
+    parser.add_argument("--ignore_string", type=str, default="",
+                        help="string to ignore in the query, split by comma")
+    parser.add_argument("--num_process", type=int, default=10,
+                        help="number of python threads searching one query each with --batch_size 0, and the default of --threads")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of java threads of the batch search, defaults to --num_process")
+    parser.add_argument("--batch_size", type=int, default=1000,
+                        help="number of queries sent to the lucene batch search at a time, 0 searches one query per python thread")
+    parser.add_argument("--shard_candidate_k", type=int, default=None,
+                        help="number of candidates first fetched from each shard of a sharded index, a shard is searched deeper when needed, defaults to --top_k")
+    parser.add_argument("--passage_store", type=str, default=None,
+                        help="passage store directory from process_freebase --output_format zstd")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="sqlite file caching the results by index, query and BM25 parameters")
+    parser.add_argument("--eval_workers", type=int, default=4,
+                        help="number of settings evaluated at the same time")
+    parser.add_argument("--eval_dedup", action="store_true",
+                        help="match every distinct passage of a setting once against all answers")
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="tsv file of the table")
+    args = parser.parse_args()
+
+    if args.index_name in INDEX_MAP_DICT:
+        index_dir = INDEX_MAP_DICT[args.index_name]
+    else:
+        exit("no such index")
+    print("index dir: ", index_dir)
+    grid = list(itertools.product(args.k1_list, args.b_list))
+    args.k1, args.b = grid[0]
+    searcher = load_bm25_searcher(index_dir, args)
+    queries = list(iter_queries(args.query_data_path, args.num_queries))
+    print("{} queries, {} settings".format(len(queries), len(grid)))
+
+    start_time = time.time()
+    futures = []
+    # the workers are spawned, not forked from the process running the JVM
+    with ProcessPoolExecutor(max_workers=args.eval_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for k1, b in grid:
+            setting_time = time.time()
+            searcher.set_bm25(k1, b)
+            # only what the evaluation needs is sent to the worker
+            data = [{"Answers": output_i["Answers"],
+                     "ctxs": [{"title": ctx["title"], "text": ctx["text"]} for ctx in output_i["ctxs"]]}
+                    for output_i in search_queries(searcher, queries, args)]
+            print("k1={:g} b={:g}: searched in {:.1f}s".format(k1, b, time.time() - setting_time))
+            futures.append((k1, b, executor.submit(evaluate_setting, data, args.top_k_list, args.eval_dedup)))
+        rows = [(k1, b, future.result()) for k1, b, future in futures]
+    print("swept {} settings in {:.1f}s".format(len(grid), time.time() - start_time))
+
+    lines = format_table(rows, args.top_k_list)
+    widths = [max(len(line[i]) for line in lines) for i in range(len(lines[0]))]
+    for line in lines:
+        print("  ".join(value.rjust(width) for value, width in zip(line, widths)))
+    if args.output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+        with open(args.output_path, "w") as wf:
+            for line in lines:
+                wf.write("\t".join(line) + "\n")
+        print("saved the table to {}".format(args.output_path))
+    if searcher.cache is not None:
+        searcher.cache.report()
@@ -6,4 +6,7 @@ import os
 INDEX_DIR = os.environ["DATA_DIR"] + "/knowledge_source"
 INDEX_MAP_DICT = {
     "Freebase": f"{INDEX_DIR}/Freebase/processed/index/pyserini_bm25",
+    "Freebase_sharded": f"{INDEX_DIR}/Freebase/processed/index/pyserini_bm25_sharded",
+    # a sub-KB, e.g. the passages of the entities of one dataset, small enough for csr_index.py
+    "Freebase_sub_scipy": f"{INDEX_DIR}/Freebase_sub/processed/index/scipy_bm25",
 }
\ No newline at end of file
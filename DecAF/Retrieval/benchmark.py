@@ -0,0 +1,286 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+load test of the retrieval searchers
+
+    python DecAF/Retrieval/benchmark.py --searcher bm25 --index_name Freebase --query_data_path ${DATA_DIR}/tasks/QA/WebQSP/test.json \
+        --concurrency 8 --num_requests 2000 --output_path ${SAVE_DIR}/Retrieval/benchmark/bm25_c8.json
+
+The queries are replayed in requests of --request_size queries, either by
+--concurrency threads sending the next request as soon as the previous one
+returns, or at a fixed rate of --qps requests per second, where the latency is
+counted from the scheduled start so that queueing is included. Reported:
+throughput, latency percentiles, the split of every request between the search
+(Lucene, SciPy, or encoding and FAISS) and the hydration of the contexts
+(json.loads of the raw field or the passage store), the peak RSS and, when a
+JVM is running, its heap. Lucene returns the raw field with the hits, so its
+read counts as search time, while the SciPy index and the passage store read
+the documents during hydration; the report records which one applies. The report is saved as json to compare index builds and
+searcher settings. The result cache is not used.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from tqdm import tqdm
+from DecAF.Retrieval.utils import iter_queries
+
+
+def timed_request(searcher, kind, queries, top_k, threads=1):
+    # (search, hydration) seconds of one request, threads is the number of java threads of a bm25 batch
+    queries = [searcher.clean_query(query) for query in queries]
+    start_time = time.perf_counter()
+    if kind == "bm25":
+        if len(queries) == 1:
+            results = [searcher.search_hits(queries[0], top_k)]
+        else:
+            qids = [str(i) for i in range(len(queries))]
+            hits = searcher.batch_search_hits(queries, qids, top_k, threads)
+            results = [hits[qid] for qid in qids]
+        search_time = time.perf_counter()
+        for hits in results:
+            searcher.hydrate(hits)
+    elif kind == "dense":
+        scores, index_ids = searcher.index.search(searcher.encoder.encode(queries), top_k)
+        search_time = time.perf_counter()
+        for i in range(len(queries)):
+            searcher.hydrate(scores[i], index_ids[i])
+    else:
+        # the server returns hydrated contexts
+        searcher.search_ctxs(queries, top_k)
+        search_time = time.perf_counter()
+    return search_time - start_time, time.perf_counter() - search_time
+
+
+def rss_mb():
+    # current and peak resident set size of this process
+    try:
+        with open("/proc/self/status", "r") as rf:
+            status = dict(line.split(":", 1) for line in rf if ":" in line)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+
+def jvm_heap_mb():
+    # used and max heap of the JVM started by pyserini, None if there is none
+    if "jnius" not in sys.modules:
+        return None
+    from jnius import autoclass
+    runtime = autoclass("java.lang.Runtime").getRuntime()
+    return (runtime.totalMemory() - runtime.freeMemory()) / 2 ** 20, runtime.maxMemory() / 2 ** 20
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, interval=0.5):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.heap_used_peak = None
+        self.heap_max = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        heap = jvm_heap_mb()
+        if heap is not None:
+            self.heap_used_peak = max(self.heap_used_peak or 0.0, heap[0])
+            self.heap_max = heap[1]
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def summarize(seconds):
+    milliseconds = np.array(seconds) * 1000
+    return {"mean": float(milliseconds.mean()),
+            "p50": float(np.percentile(milliseconds, 50)),
+            "p95": float(np.percentile(milliseconds, 95)),
+            "p99": float(np.percentile(milliseconds, 99)),
+            "max": float(milliseconds.max())}
+
+
+def run_closed_loop(request_fn, requests, concurrency):
+    # every thread sends its next request when the previous one returns
+    latencies = [None] * len(requests)
+
+    def worker(i):
+        start_time = time.perf_counter()
+        split = request_fn(requests[i])
+        latencies[i] = (time.perf_counter() - start_time,) + split
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in tqdm(executor.map(worker, range(len(requests))), total=len(requests)):
+            pass
+    return latencies
+
+
+def run_open_loop(request_fn, requests, concurrency, qps):
+    # requests start at a fixed rate, a request waiting for a free thread counts as latency
+    latencies = [None] * len(requests)
+
+    def worker(i, scheduled_time):
+        split = request_fn(requests[i])
+        latencies[i] = (time.perf_counter() - scheduled_time,) + split
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start_time = time.perf_counter()
+        futures = []
+        for i in range(len(requests)):
+            scheduled_time = start_time + i / qps
+            delay = scheduled_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(worker, i, scheduled_time))
+        for future in tqdm(futures):
+            future.result()
+    return latencies
+
+
+def raw_read_in(searcher, kind):
+    # part of the request that reads the documents
+    if kind == "bm25":
+        # with a passage store the documents are read from it during hydration
+        return "search" if searcher.raw_read_in_search and searcher.passage_store is None else "hydration"
+    return "search" if kind == "server" else "hydration"
+
+
+def load_searcher(args):
+    if args.searcher == "server":
+        from DecAF.Retrieval.Pyserini.client import SearchClient
+        return SearchClient(args.server_url, args), None
+    if args.searcher == "dense":
+        from DecAF.Retrieval.Dense.utils import INDEX_MAP_DICT
+        from DecAF.Retrieval.Dense.search import DenseSearcher
+        index_dir = INDEX_MAP_DICT[args.index_name]
+        return DenseSearcher(index_dir, args), index_dir
+    from DecAF.Retrieval.Pyserini.utils import INDEX_MAP_DICT
+    from DecAF.Retrieval.Pyserini.search import load_bm25_searcher
+    index_dir = INDEX_MAP_DICT[args.index_name]
+    return load_bm25_searcher(index_dir, args), index_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='retrieval load test')
+    parser.add_argument("--searcher", type=str, default="bm25", choices=["bm25", "dense", "server"])
+    parser.add_argument("--index_name", type=str, default='Freebase',
+                        help="index in INDEX_MAP_DICT of Pyserini/utils.py (bm25, server) or Dense/utils.py (dense)")
+    parser.add_argument("--server_url", type=str, default="http://127.0.0.1:8765",
+                        help="url of server.py for --searcher server")
+    parser.add_argument("--query_data_path", type=str, required=True,
+                        help="json or jsonl file of the queries")
+    parser.add_argument("--num_queries", type=int, default=-1,
+                        help="number of queries read from the file")
+    parser.add_argument("--num_requests", type=int, default=None,
+                        help="number of timed requests, the queries are repeated if needed, defaults to one pass")
+    parser.add_argument("--request_size", type=int, default=1,
+                        help="number of queries of every request")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of requests in flight")
+    parser.add_argument("--qps", type=float, default=0,
+                        help="requests started per second, 0 for as fast as --concurrency allows")
+    parser.add_argument("--warmup", type=int, default=10,
+                        help="number of untimed requests before the timed ones")
+    parser.add_argument("--top_k", type=int, default=100)
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="json file of the report")
+    # BM25
+    parser.add_argument("--k1", type=float, default=0.9)
+    parser.add_argument("--b", type=float, default=0.4)
+    parser.add_argument("--shard_candidate_k", type=int, default=None,
+                        help="number of candidates first fetched from each shard of a sharded index, a shard is searched deeper when needed, defaults to --top_k")
+    # dense
+    parser.add_argument("--query_encoder", type=str, default="facebook/dpr-question_encoder-single-nq-base")
+    parser.add_argument("--nprobe", type=int, default=64)
+    parser.add_argument("--ef_search", type=int, default=128)
+    parser.add_argument("--no_mmap", action="store_true")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of faiss threads (dense, defaults to all CPUs), or of java threads "
+                             "of the batch search of a request (bm25, defaults to 1)")
+    parser.add_argument("--query_batch_size", type=int, default=64)
+    # shared
+    parser.add_argument("--passage_store", type=str, default=None,
+                        help="passage store directory, required by the dense searcher")
+    parser.add_argument("--ignore_string", type=str, default="",
+                        help="string to ignore in the query, split by comma")
+    args = parser.parse_args()
+    args.cache = None
+
+    load_time = time.perf_counter()
+    searcher, index_dir = load_searcher(args)
+    load_time = time.perf_counter() - load_time
+    queries = [data_i["Question"] for data_i in iter_queries(args.query_data_path, args.num_queries)]
+    num_requests = args.num_requests if args.num_requests is not None else -(-len(queries) // args.request_size)
+    query_cycle = itertools.cycle(queries)
+    requests = [list(itertools.islice(query_cycle, args.request_size)) for _ in range(args.warmup + num_requests)]
+    print("{} queries, {} warmup and {} timed requests of {} queries".format(
+        len(queries), args.warmup, num_requests, args.request_size))
+
+    def request_fn(request):
+        return timed_request(searcher, args.searcher, request, args.top_k, args.threads or 1)
+
+    for request in requests[:args.warmup]:
+        request_fn(request)
+    requests = requests[args.warmup:]
+
+    sampler = MemorySampler()
+    sampler.start()
+    start_time = time.perf_counter()
+    if args.qps > 0:
+        latencies = run_open_loop(request_fn, requests, args.concurrency, args.qps)
+    else:
+        latencies = run_closed_loop(request_fn, requests, args.concurrency)
+    wall_time = time.perf_counter() - start_time
+    sampler.stop()
+
+    latency, search, hydration = (list(values) for values in zip(*latencies))
+    rss, rss_peak = rss_mb()
+    report = {
+        "config": vars(args),
+        "index_dir": index_dir,
+        "host": socket.gethostname(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "load_seconds": load_time,
+        "num_requests": len(requests),
+        "num_queries": len(requests) * args.request_size,
+        "wall_seconds": wall_time,
+        "throughput_requests_per_second": len(requests) / wall_time,
+        "throughput_queries_per_second": len(requests) * args.request_size / wall_time,
+        "latency_ms": summarize(latency),
+        "search_ms": summarize(search),
+        "hydration_ms": summarize(hydration),
+        "search_fraction": sum(search) / max(sum(search) + sum(hydration), 1e-12),
+        "documents_read_in": raw_read_in(searcher, args.searcher),
+        "rss_mb": rss,
+        "rss_peak_mb": rss_peak,
+        "jvm_heap_used_peak_mb": sampler.heap_used_peak,
+        "jvm_heap_max_mb": sampler.heap_max,
+    }
+
+    print("throughput: {:.1f} queries/s".format(report["throughput_queries_per_second"]))
+    print("latency ms: " + " ".join("{} {:.2f}".format(name, value) for name, value in report["latency_ms"].items()))
+    print("search {:.1f}% / hydration {:.1f}% of the request time, documents read in the {}".format(
+        100 * report["search_fraction"], 100 * (1 - report["search_fraction"]), report["documents_read_in"]))
+    print("rss: {:.0f} MB (peak {:.0f} MB)".format(rss, rss_peak))
+    if sampler.heap_max is not None:
+        print("jvm heap: {:.0f} MB peak of {:.0f} MB".format(sampler.heap_used_peak, sampler.heap_max))
+    if args.output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+        with open(args.output_path, "w") as wf:
+            json.dump(report, wf, indent=2)
+        print("saved the report to {}".format(args.output_path))
@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+on-disk cache of retrieval results
+
+Results are stored in SQLite under (index fingerprint, normalized query, k1, b)
+together with the top_k they were retrieved with, a stored result serves any
+smaller top_k by truncation.
+'''
+
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+# bumped when the stored contexts change, older results are not served
+CACHE_VERSION = 2
+
+
+def index_fingerprint(index_dir):
+    # lucene segment files are immutable, their names and sizes change whenever the index is rebuilt
+    if not os.path.isdir(index_dir):
+        # name of a prebuilt index
+        return index_dir
+    digest = hashlib.sha1()
+    for root, _, file_names in sorted(os.walk(index_dir)):
+        for file_name in sorted(file_names):
+            stat = os.stat(os.path.join(root, file_name))
+            digest.update("{}\t{}\t{}\n".format(os.path.relpath(os.path.join(root, file_name), index_dir),
+                                                stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+
+class ResultCache:
+    def __init__(self, path, fingerprint, k1, b):
+        self.path = path
+        self.fingerprint = "{}:{}".format(CACHE_VERSION, fingerprint)
+        self.k1 = k1
+        self.b = b
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # sqlite connections can not be shared between threads
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                            fingerprint TEXT, query TEXT, k1 REAL, b REAL, top_k INTEGER, ctxs BLOB,
+                            PRIMARY KEY (fingerprint, query, k1, b))""")
+        conn.commit()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, query, top_k):
+        # contexts of the query, or None if it was not retrieved with at least top_k results
+        row = self._connect().execute(
+            "SELECT top_k, ctxs FROM results WHERE fingerprint=? AND query=? AND k1=? AND b=?",
+            (self.fingerprint, normalize_query(query), self.k1, self.b)).fetchone()
+        with self._lock:
+            if row is None or row[0] < top_k:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(zlib.decompress(row[1]))[:top_k]
+
+    def put_many(self, items):
+        # items are (query, top_k, ctxs), a result is only replaced by one with a larger top_k
+        conn = self._connect()
+        conn.executemany(
+            """INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (fingerprint, query, k1, b) DO UPDATE SET top_k=excluded.top_k, ctxs=excluded.ctxs
+               WHERE excluded.top_k > results.top_k""",
+            [(self.fingerprint, normalize_query(query), self.k1, self.b, top_k,
+              zlib.compress(json.dumps(ctxs).encode("utf-8"))) for query, top_k, ctxs in items])
+        conn.commit()
+
+    def put(self, query, top_k, ctxs):
+        self.put_many([(query, top_k, ctxs)])
+
+    def report(self):
+        total = self.hits + self.misses
+        print("cache hits: {} / {} ({:.1f}%)".format(self.hits, total, 100 * self.hits / max(total, 1)))
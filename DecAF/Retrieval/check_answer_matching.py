@@ -0,0 +1,143 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+check that AnswerMatcher and answer_ranks agree with has_answer
+
+    python DecAF/Retrieval/check_answer_matching.py --num_cases 2000
+    python DecAF/Retrieval/check_answer_matching.py --results_path ${SAVE_DIR}/Retrieval/pyserini/search_results/QA_WebQSP_Freebase_BM25/test.jsonl
+
+Every answer is matched on its own with has_answer(match_type="string"),
+without tokenizer and with a word tokenizer, and compared with the answers
+found by AnswerMatcher and the ranks of answer_ranks. The Hits and Recall of
+eval_top_k, with and without dedup, are compared with the per-cutoff has_answer
+loop, at cutoffs above the number of contexts of some questions. The cases are
+random answers and texts built to hit the corner cases (accents, case, empty,
+duplicated and overlapping answers), or the questions of saved results. Exits
+with status 1 on any difference.
+'''
+
+import random
+import argparse
+import unicodedata
+import regex as re
+from DecAF.Datasets.QA.utils import parse_answer
+from DecAF.Retrieval.utils import has_answer, AnswerMatcher, answer_ranks, eval_top_k, iter_queries, NOT_FOUND
+
+# the random cases have up to 8 contexts
+CUTOFFS = [1, 3, 5, 10, 20]
+WORDS = ["paris", "Paris", "new", "york", "New York", "café", "café", "CAFÉ", "a", "an", "ana", "banana",
+         "1984", "19", "84", "o'neil", "o", "neil", "-", ".", "x"]
+
+
+class WordTokenizer:
+    # words and single non-space characters, the interface of the DPR SimpleTokenizer used with has_answer
+    PATTERN = re.compile(r"[\p{L}\p{N}\p{M}]+|[^\p{Z}\p{C}]")
+
+    class Tokens:
+        def __init__(self, words):
+            self._words = words
+
+        def words(self, uncased=False):
+            return [word.lower() for word in self._words] if uncased else list(self._words)
+
+    def tokenize(self, text):
+        return self.Tokens(self.PATTERN.findall(text))
+
+
+def random_text(rng, max_words):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, max_words)))
+
+
+def random_case(rng):
+    answers = [random_text(rng, 3) for _ in range(rng.randint(1, 5))]
+    # duplicated answers, and answers differing only by normalization
+    if rng.random() < 0.3:
+        answers.append(rng.choice(answers))
+    if rng.random() < 0.3:
+        answers.append(unicodedata.normalize("NFC", rng.choice(answers)).upper())
+    return answers, [random_text(rng, 12) for _ in range(rng.randint(0, 8))]
+
+
+def iter_result_cases(results_path, num_cases):
+    for data_i in iter_queries(results_path, num_cases):
+        yield (parse_answer(data_i["Answers"], original_name=True),
+               [ctx["title"] + " " + ctx["text"] for ctx in data_i["ctxs"]])
+
+
+def check_case(answers, contexts, tokenizer):
+    # list of differences between the matcher, the ranks and has_answer
+    differences = []
+    matcher = AnswerMatcher(answers, tokenizer)
+    expected_ranks = [NOT_FOUND] * len(answers)
+    for rank, context in enumerate(contexts):
+        expected = {i for i, answer in enumerate(answers) if has_answer([answer], context, tokenizer, "string")}
+        if matcher.match(context) != expected:
+            differences.append("match {!r} in {!r}: {} != {}".format(answers, context, sorted(matcher.match(context)), sorted(expected)))
+        for i in expected:
+            expected_ranks[i] = min(expected_ranks[i], rank)
+    ranks = answer_ranks(answers, contexts, tokenizer).tolist()
+    if ranks != expected_ranks:
+        differences.append("ranks of {!r}: {} != {}".format(answers, ranks, expected_ranks))
+    return differences
+
+
+def top_k_one(answers, contexts, top_k, tokenizer):
+    # recall of the answers in the top_k contexts, the loop of the original eval_top_k_one
+    recall = 0
+    for answer in answers:
+        for context in contexts[:top_k]:
+            if has_answer([answer], context, tokenizer, "string"):
+                recall += 1
+                break
+    return recall / (len(answers) + 1e-8)
+
+
+def check_cutoffs(cases, tokenizer, dedup=False):
+    # list of differences between eval_top_k and the original per-cutoff loop
+    # the first question has a context for every cutoff, so that no cutoff is dropped
+    # and the cutoffs above the number of contexts of the other questions are counted
+    cases = [(["not an answer"], ["x"] * max(CUTOFFS))] + cases
+    output_data = [{"Answers": [{"text": answer, "freebaseId": None} for answer in answers],
+                    "ctxs": [{"title": "", "text": context} for context in contexts]}
+                   for answers, contexts in cases]
+    answers_list = [parse_answer(data_i["Answers"], original_name=True) for data_i in output_data]
+    contexts_list = [[" " + context for context in contexts] for _, contexts in cases]
+    expected = {}
+    for k in CUTOFFS:
+        recalls = [top_k_one(answers, contexts, k, tokenizer) for answers, contexts in zip(answers_list, contexts_list)]
+        expected[k] = (sum(recall > 0 for recall in recalls) * 100 / len(cases), sum(recalls) * 100 / len(cases))
+    results = eval_top_k(output_data, CUTOFFS, tokenizer, dedup=dedup, verbose=False)["ctxs"]
+    differences = []
+    for k in CUTOFFS:
+        if k not in results or any(abs(x - y) > 1e-6 for x, y in zip(results[k], expected[k])):
+            differences.append("{}top {}: {} != {}".format("dedup " if dedup else "", k, results.get(k), expected[k]))
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare AnswerMatcher with has_answer')
+    parser.add_argument("--results_path", type=str, default=None,
+                        help="json or jsonl file written by a search script, random cases if not given")
+    parser.add_argument("--num_cases", type=int, default=1000,
+                        help="number of random cases or of questions read from --results_path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.results_path is not None:
+        cases = list(iter_result_cases(args.results_path, args.num_cases))
+    else:
+        rng = random.Random(args.seed)
+        cases = [random_case(rng) for _ in range(args.num_cases)]
+    num_differences = 0
+    for tokenizer in [None, WordTokenizer()]:
+        differences = [difference for answers, contexts in cases for difference in check_case(answers, contexts, tokenizer)]
+        differences += check_cutoffs(cases, tokenizer)
+        differences += check_cutoffs(cases, tokenizer, dedup=True)
+        for difference in differences[:10]:
+            print(difference)
+        print("{}: {} differences in {} cases".format(
+            "substring" if tokenizer is None else "tokenized", len(differences), len(cases)))
+        num_differences += len(differences)
+    if num_differences > 0:
+        exit(1)
@@ -0,0 +1,35 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+evaluate saved retrieval results
+
+    python DecAF/Retrieval/evaluate.py --results_path ${SAVE_DIR}/Retrieval/pyserini/search_results/QA_WebQSP_Freebase_BM25/test.jsonl \
+        --passages Freebase
+
+Compact results (search.py --compact) are looked up in --passages, a passage
+store directory, a Lucene index directory or an index name of Pyserini/utils.py.
+'''
+
+import argparse
+from DecAF.Retrieval.utils import eval_top_k, iter_queries
+from DecAF.Retrieval.passages import open_passages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='evaluate retrieval results')
+    parser.add_argument("--results_path", type=str, required=True,
+                        help="json or jsonl file written by a search script")
+    parser.add_argument("--passages", type=str, default=None,
+                        help="passages of compact results")
+    parser.add_argument("--top_k_list", type=int, nargs="+", default=[5, 10, 20, 100])
+    parser.add_argument("--ctxs_keys", type=str, nargs="+", default=["ctxs"])
+    parser.add_argument("--eval_workers", type=int, default=1,
+                        help="number of processes matching the answers")
+    parser.add_argument("--eval_dedup", action="store_true",
+                        help="match every distinct passage of the split once against all answers, keeps the split in memory")
+    args = parser.parse_args()
+
+    passages = open_passages(args.passages) if args.passages is not None else None
+    eval_top_k(iter_queries(args.results_path), top_k_list=args.top_k_list, tokenizer=None, ctxs_keys=args.ctxs_keys,
+               num_workers=args.eval_workers, dedup=args.eval_dedup, passages=passages)
@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+
+'''
+passages by docid for compact retrieval results
+
+Results saved with --compact keep only the id and score of every context. The
+title and text are looked up when they are needed (FiD input, evaluation), from
+a zstd passage store (process_freebase --output_format zstd) or from the raw
+field stored in the Lucene index.
+'''
+
+import os
+import json
+
+
+class LucenePassages:
+    # passages from the stored raw field of a lucene index, or of every shard of a sharded one
+    def __init__(self, index_dir):
+        from pyserini.search.lucene import LuceneSearcher
+        from DecAF.Retrieval.Pyserini.search import get_shard_dirs
+        shard_dirs = get_shard_dirs(index_dir) if os.path.isdir(index_dir) else None
+        if shard_dirs is not None:
+            self.searchers = [LuceneSearcher(shard_dir) for shard_dir in shard_dirs]
+        elif os.path.isdir(index_dir):
+            self.searchers = [LuceneSearcher(index_dir)]
+        else:
+            self.searchers = [LuceneSearcher.from_prebuilt_index(index_dir)]
+
+    def get(self, docid):
+        for searcher in self.searchers:
+            doc = searcher.doc(docid)
+            if doc is not None:
+                return json.loads(doc.raw())
+        raise KeyError(docid)
+
+    def __getitem__(self, docid):
+        return self.get(docid)
+
+
+def open_passages(path):
+    # a passage store directory, a lucene index directory or an index name of Pyserini/utils.py
+    from DecAF.Retrieval.Pyserini.utils import INDEX_MAP_DICT
+    path = INDEX_MAP_DICT.get(path, path)
+    if os.path.isdir(path) and any(name.endswith(".offsets.npy") for name in os.listdir(path)):
+        # zstandard is only needed for a passage store
+        from DecAF.Knowledge.passage_store import PassageStore
+        return PassageStore(path)
+    return LucenePassages(path)
+
+
+def compact_ctxs(ctxs):
+    return [{"id": ctx["id"], "score": ctx["score"]} for ctx in ctxs]
+
+
+def hydrate_ctxs(ctxs, passages):
+    # contexts with title and text, compact contexts are looked up by id
+    hydrated = []
+    for ctx in ctxs:
+        if "text" in ctx:
+            hydrated.append(ctx)
+        else:
+            doc = passages.get(ctx["id"])
+            hydrated.append({"id": ctx["id"], "title": doc["title"], "text": doc["contents"], "score": ctx["score"]})
+    return hydrated
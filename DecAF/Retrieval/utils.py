@@ -6,15 +6,31 @@
 # LICENSE file in the root directory of this source tree.
 
 '''
-evaluation functions for retrieval
+evaluation functions for retrieval, and the query reading, search and result
+writing shared by the search scripts
 '''
 
+import os
+import json
+import itertools
 import unicodedata
-from collections import defaultdict
+import multiprocessing.pool
+from functools import partial
+from multiprocessing import Pool
+import jsonlines
 import numpy as np
 import regex as re
 from tqdm import tqdm
 from DecAF.Datasets.QA.utils import parse_answer
+from DecAF.Retrieval.passages import compact_ctxs
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# number of queries read and searched at a time by the thread pool
+QUERY_BLOCK_SIZE = 1000
 
 
 def has_answer(answers, text, tokenizer, match_type) -> bool:
@@ -63,16 +79,91 @@ def regex_match(text, pattern):
         return False
     return pattern.search(text) is not None
 
-def eval_top_k_one(data_i, top_k=100, tokenizer=None):
-    recall = 0
+class AnswerMatcher:
+    """Finds which of a list of answers occur in a text, with the semantics of has_answer
+    with match_type string (check_answer_matching.py compares the two). Without tokenizer
+    the normalized answers are compiled into one Aho-Corasick automaton (pyahocorasick, or one substring scan per answer if it is not
+    installed); with a tokenizer the answer token sequences are hashed by length and every
+    window of the text is looked up once per distinct length.
+    """
+    def __init__(self, answers, tokenizer=None):
+        self.tokenizer = tokenizer
+        self.num_answers = len(answers)
+        # empty answers are contained in every text
+        self.always = []
+        if tokenizer is None:
+            norm_answers = [_normalize(answer).lower() for answer in answers]
+        else:
+            norm_answers = [tuple(tokenizer.tokenize(_normalize(answer)).words(uncased=True)) for answer in answers]
+        # answer -> indices of the answers with that normalized form
+        self.index = {}
+        for i, norm_answer in enumerate(norm_answers):
+            if len(norm_answer) == 0:
+                self.always.append(i)
+            else:
+                self.index.setdefault(norm_answer, []).append(i)
+        self.automaton = None
+        if tokenizer is None and ahocorasick is not None and len(self.index) > 0:
+            self.automaton = ahocorasick.Automaton()
+            for norm_answer, indices in self.index.items():
+                self.automaton.add_word(norm_answer, indices)
+            self.automaton.make_automaton()
+        self.lengths = sorted(set(len(norm_answer) for norm_answer in self.index))
+
+    def match(self, text):
+        # indices of the answers found in the text
+        text = _normalize(text)
+        found = set(self.always)
+        if self.tokenizer is None:
+            text = text.lower()
+            if self.automaton is not None:
+                for _, indices in self.automaton.iter(text):
+                    found.update(indices)
+            else:
+                for norm_answer, indices in self.index.items():
+                    if norm_answer in text:
+                        found.update(indices)
+        else:
+            words = tuple(self.tokenizer.tokenize(text).words(uncased=True))
+            for length in self.lengths:
+                for i in range(0, len(words) - length + 1):
+                    indices = self.index.get(words[i : i + length])
+                    if indices is not None:
+                        found.update(indices)
+        return found
+
+# rank of an answer that is not found, above every cutoff even when there are fewer contexts
+NOT_FOUND = np.iinfo(np.int64).max
+
+def answer_ranks(answers, contexts, tokenizer=None):
+    """First rank at which each answer is found in the contexts, NOT_FOUND if it is not.
+    Every context is normalized and matched once for all answers, and the scan stops once
+    every answer is found.
+    """
+    ranks = np.full(len(answers), NOT_FOUND, dtype=np.int64)
+    matcher = AnswerMatcher(answers, tokenizer)
+    num_missing = len(answers)
+    for rank, context in enumerate(contexts):
+        if num_missing == 0:
+            break
+        for i in matcher.match(context):
+            if ranks[i] == NOT_FOUND:
+                ranks[i] = rank
+                num_missing -= 1
+    return ranks
+
+def _context_texts(ctxs, passages=None):
+    # compact contexts are looked up in passages, see DecAF/Retrieval/passages.py
+    if passages is not None:
+        # imported here, the passage store needs zstandard
+        from DecAF.Retrieval.passages import hydrate_ctxs
+        ctxs = hydrate_ctxs(ctxs, passages)
+    return [ctx['title'] + " " + ctx['text'] for ctx in ctxs]
+
+def eval_top_k_one(data_i, top_k=100, tokenizer=None, ctxs_key='ctxs'):
     answers = parse_answer(data_i['Answers'], original_name=True)
-    for answer in answers:
-        for ctx in data_i['ctxs'][:top_k]:
-            context = ctx['title'] + " " + ctx['text']
-            if has_answer([answer], context, tokenizer, "string"):
-                recall += 1
-                break
-    return recall / (len(answers) + 1e-8)
+    ranks = answer_ranks(answers, _context_texts(data_i[ctxs_key][:top_k]), tokenizer)
+    return np.sum(ranks < top_k) / (len(answers) + 1e-8)
 
 def recall_ctx(ctx, answers, tokenizer=None):
     context = ctx['title'] + " " + ctx['text']
@@ -82,20 +173,240 @@ def recall_ctx(ctx, answers, tokenizer=None):
             recall += 1
     return recall / (len(answers) + 1e-8)
 
-def eval_top_k(output_data, top_k_list=[1, 20, 50, 100, 200, 500], tokenizer=None):
-    print("Evaluation")
-    hits_dict = defaultdict(int)
-    recall_dict = defaultdict(float)
-    num_tokens_dict = defaultdict(list)
-    top_k_list = [k for k in top_k_list if k <= len(output_data[0]['ctxs'])]
-    for data_i in tqdm(output_data):
-        for k in top_k_list:
-            recall = eval_top_k_one(data_i, top_k=k, tokenizer=tokenizer)
-            if recall > 0:
-                hits_dict[k] += 1
-            recall_dict[k] += recall
-            num_tokens_dict[k].append(sum([len(ctx["text"].split(" "))+len(ctx["title"].split(" ")) for ctx in data_i['ctxs'][:k]]))
-    for k in top_k_list:
-        print("Top {}".format(k), 
-              "Hits: ", round(hits_dict[k] * 100 / len(output_data), 1), 
-              "Recall: ", round(recall_dict[k] * 100 / len(output_data), 1))
+def _answer_ranks_of_item(item, tokenizer=None):
+    answers, contexts_list = item
+    return [answer_ranks(answers, contexts, tokenizer) for contexts in contexts_list]
+
+def _match_passages(answers, passages, tokenizer=None):
+    matcher = AnswerMatcher(answers, tokenizer)
+    return [tuple(matcher.match(passage)) for passage in passages]
+
+def dedup_answer_ranks(items, tokenizer=None, pool=None, num_workers=1, verbose=True):
+    """answer_ranks of every (answers, [contexts, ...]) item, with every distinct context
+    normalized and matched only once, against the union of the answers of all items.
+    The ranks of each question are then looked up from the matches of its contexts.
+    """
+    answer_index = {}
+    passage_index = {}
+    indexed = []
+    for answers, contexts_list in items:
+        indexed.append(([answer_index.setdefault(answer, len(answer_index)) for answer in answers],
+                        [[passage_index.setdefault(context, len(passage_index)) for context in contexts]
+                         for contexts in contexts_list]))
+    passages = list(passage_index)
+    del passage_index
+    num_chunks = 4 * num_workers if pool is not None else 1
+    chunk_size = max(1, -(-len(passages) // num_chunks))
+    chunks = [passages[i:i + chunk_size] for i in range(0, len(passages), chunk_size)]
+    match_fn = partial(_match_passages, list(answer_index), tokenizer=tokenizer)
+    matches = []
+    for chunk_matches in (pool.imap(match_fn, chunks) if pool is not None else map(match_fn, chunks)):
+        matches.extend(chunk_matches)
+    if verbose:
+        print("matched {} distinct passages of {} retrieved".format(
+            len(passages), sum(len(ids) for _, ids_list in indexed for ids in ids_list)))
+
+    ranks_list = []
+    for answer_ids, passage_ids_list in indexed:
+        ranks_i = []
+        for passage_ids in passage_ids_list:
+            ranks = np.full(len(answer_ids), NOT_FOUND, dtype=np.int64)
+            # positions of every union answer in the answers of the question
+            positions = {}
+            for j, answer_id in enumerate(answer_ids):
+                positions.setdefault(answer_id, []).append(j)
+            for rank, passage_id in enumerate(passage_ids):
+                if len(positions) == 0:
+                    break
+                for answer_id in matches[passage_id]:
+                    found = positions.pop(answer_id, None)
+                    if found is not None:
+                        ranks[found] = rank
+            ranks_i.append(ranks)
+        ranks_list.append(ranks_i)
+    return ranks_list
+
+def eval_top_k(output_data, top_k_list=[1, 20, 50, 100, 200, 500], tokenizer=None, ctxs_keys=['ctxs'],
+               num_workers=1, block_size=1000, dedup=False, passages=None, verbose=True):
+    # output_data can be any iterable of results, e.g. a stream of search results
+    # every key of ctxs_keys is a list of contexts to evaluate, e.g. fused and individual retrievers
+    # the rank of every answer is found once per question, all cutoffs are then counted from it;
+    # with num_workers > 1 the ranks of each block of questions are found by a process pool
+    # with dedup the whole split is one block and each distinct passage is matched once (see dedup_answer_ranks)
+    # returns {ctxs_key: {k: (hits, recall)}} in percent, {ctxs_key: {}} if there is no result
+    if verbose:
+        print("Evaluation")
+    if dedup:
+        block_size = None
+    top_k_arrays = {}
+    hits = {}
+    recall = {}
+    num_data = 0
+    pool = Pool(num_workers) if num_workers > 1 else None
+    rank_fn = partial(_answer_ranks_of_item, tokenizer=tokenizer)
+    data_iter = iter(tqdm(output_data, disable=not verbose))
+    while True:
+        block = list(itertools.islice(data_iter, block_size))
+        if len(block) == 0:
+            break
+        if num_data == 0:
+            top_k_arrays = {key: np.array([k for k in top_k_list if k <= len(block[0][key])], dtype=np.int64)
+                            for key in ctxs_keys}
+            hits = {key: np.zeros(len(top_k_arrays[key]), dtype=np.int64) for key in ctxs_keys}
+            recall = {key: np.zeros(len(top_k_arrays[key])) for key in ctxs_keys}
+        num_data += len(block)
+        # only the contexts up to the largest cutoff are searched
+        items = ((parse_answer(data_i['Answers'], original_name=True),
+                  [_context_texts(data_i[key][:top_k_arrays[key].max(initial=0)], passages) for key in ctxs_keys])
+                 for data_i in block)
+        if dedup:
+            ranks_list = dedup_answer_ranks(items, tokenizer, pool, num_workers, verbose)
+        elif pool is not None:
+            ranks_list = pool.map(rank_fn, items, chunksize=max(1, len(block) // (4 * num_workers)))
+        else:
+            ranks_list = map(rank_fn, items)
+        for ranks_i in ranks_list:
+            for key, ranks in zip(ctxs_keys, ranks_i):
+                # number of answers found within each cutoff
+                num_found = np.sum(ranks[:, None] < top_k_arrays[key][None, :], axis=0)
+                hits[key] += num_found > 0
+                recall[key] += num_found / (len(ranks) + 1e-8)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if num_data == 0:
+        if verbose:
+            print("no results to evaluate")
+        return {key: {} for key in ctxs_keys}
+    results = {key: {int(k): (float(hits[key][i] * 100 / num_data), float(recall[key][i] * 100 / num_data))
+                     for i, k in enumerate(top_k_arrays.get(key, []))} for key in ctxs_keys}
+    if verbose:
+        for key in ctxs_keys:
+            if len(ctxs_keys) > 1:
+                print(key)
+            for k, (hits_k, recall_k) in results[key].items():
+                print("Top {}".format(k), 
+                      "Hits: ", round(hits_k, 1), 
+                      "Recall: ", round(recall_k, 1))
+    return results
+
+
+def get_ignore_list(ignore_string):
+    # strings removed from the queries, --ignore_string is split by comma
+    if len(ignore_string) > 0:
+        ignore_list = ignore_string.split(',')
+        print(f'ignore list: {ignore_list}')
+        return ignore_list
+    return []
+
+def clean_query(query, ignore_list):
+    for string in ignore_list:
+        query = query.replace(string, ' ')
+    return query.strip()
+
+def iter_queries(query_data_path, num_queries=-1):
+    # jsonl query files are streamed, json files are loaded once
+    if query_data_path.endswith(".jsonl"):
+        rf = jsonlines.open(query_data_path, "r")
+        queries = iter(rf)
+    else:
+        rf = None
+        with open(query_data_path, 'r') as json_file:
+            queries = iter(json.load(json_file))
+    try:
+        yield from (queries if num_queries == -1 else itertools.islice(queries, num_queries))
+    finally:
+        if rf is not None:
+            rf.close()
+
+def iter_blocks(iterable, block_size):
+    iterator = iter(iterable)
+    while True:
+        block = list(itertools.islice(iterator, block_size))
+        if len(block) == 0:
+            return
+        yield block
+
+def search_queries(searcher, queries, args):
+    # yields the results in completion order, only one block of queries is in flight at a time
+    if args.batch_size > 0:
+        threads = args.threads if args.threads is not None else args.num_process
+        for block in iter_blocks(queries, args.batch_size):
+            yield from searcher.perform_batch_search(block, args.top_k, threads)
+    else:
+        with multiprocessing.pool.ThreadPool(processes=args.num_process) as pool:
+            perform_search = partial(searcher.perform_search, top_k=args.top_k)
+            for block in iter_blocks(queries, QUERY_BLOCK_SIZE):
+                yield from pool.imap_unordered(perform_search, block)
+
+class ResultWriter:
+    # writes one json line per result, and optionally reorders the file by QuestionId when closed
+    # compact results keep only the id and score of the contexts, see DecAF/Retrieval/passages.py,
+    # and drop_keys are left out of the file, e.g. the individual contexts of a hybrid search
+    def __init__(self, output_path, sort_output=False, compact=False, drop_keys=()):
+        self.output_path = output_path
+        self.sort_output = sort_output
+        self.compact = compact
+        self.drop_keys = frozenset(drop_keys)
+        self.write_path = output_path + ".unsorted" if sort_output else output_path
+        self.wf = open(self.write_path, "wb")
+        # (QuestionId, offset, length) of every line, the contexts are not kept in memory
+        self.lines = []
+        self.offset = 0
+
+    def write(self, output_i):
+        if len(self.drop_keys) > 0:
+            output_i = {key: value for key, value in output_i.items() if key not in self.drop_keys}
+        if self.compact:
+            output_i = {key: compact_ctxs(value) if key.startswith("ctxs") else value for key, value in output_i.items()}
+        line = (json.dumps(output_i) + "\n").encode("utf-8")
+        self.wf.write(line)
+        if self.sort_output:
+            self.lines.append((output_i["QuestionId"], self.offset, len(line)))
+        self.offset += len(line)
+
+    def write_through(self, results):
+        for output_i in results:
+            self.write(output_i)
+            yield output_i
+
+    def close(self):
+        self.wf.close()
+        if not self.sort_output:
+            return
+        self.lines.sort(key=lambda line: line[0])
+        with open(self.write_path, "rb") as rf, open(self.output_path, "wb") as wf:
+            for _, offset, length in self.lines:
+                rf.seek(offset)
+                wf.write(rf.read(length))
+        os.remove(self.write_path)
+
+def get_output_path(output_dir, query_data_path):
+    # e.g. WebQSP_processed.test.json -> test.jsonl
+    output_name = '.'.join(os.path.basename(query_data_path).split('.')[-2:])
+    output_name = output_name.rsplit('.', 1)[0]
+    return os.path.join(output_dir, output_name + ".jsonl")
+
+def run_search(searcher, args, ctxs_keys=["ctxs"], drop_keys=()):
+    # main of the search scripts: searches the queries of --query_data_path, writes the results
+    # as they complete with --save and evaluates every key of ctxs_keys with --eval
+    results = search_queries(searcher, iter_queries(args.query_data_path, args.num_queries), args)
+
+    writer = None
+    if args.save:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output_path = get_output_path(args.output_dir, args.query_data_path)
+        print("saving output data to {}".format(output_path))
+        writer = ResultWriter(output_path, args.sort_output, args.compact, drop_keys)
+        results = writer.write_through(results)
+
+    if args.eval:
+        eval_top_k(results, top_k_list=[5, 10, 20, 100], tokenizer=None, ctxs_keys=ctxs_keys,
+                   num_workers=args.eval_workers, dedup=args.eval_dedup)
+    else:
+        for _ in tqdm(results):
+            pass
+    if writer is not None:
+        writer.close()
+    if searcher.cache is not None:
+        searcher.cache.report()